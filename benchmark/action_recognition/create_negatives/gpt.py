@@ -1,4 +1,5 @@
 import argparse
+import asyncio
 import json
 import os
 import sys
@@ -7,7 +8,7 @@ from typing import List, Dict, Optional, Any
 from loguru import logger
 
 from benchmark.prompts import ActionPrompt, get_prompt, list_prompts, list_categories
-from src.utils.openai_api import OpenaiAPI
+from src.utils.openai_api import OpenaiAPI, AsyncOpenaiAPI
 
 def load_text_file(file_path) -> list:
     """
@@ -109,6 +110,91 @@ def generate_hard_negatives(
     return responses
 
 
+async def generate_hard_negatives_async(
+    api: AsyncOpenaiAPI, 
+    action: str,
+    action_list: List[str], 
+    action_definition: List[str], 
+    prompt_name: str,
+    save_path: Optional[str] = None,
+    model_overrides: Optional[Dict[str, Any]] = None,
+) -> Dict:
+    """
+    Async `generate_hard_negatives`, so that many actions can share one process, connection pool and rate limit.
+    The steps of a single action still run one after another, since each builds on the previous responses.
+    """
+    prompt: ActionPrompt = get_prompt(prompt_name)
+    sys_prompt, user_prompts =  prompt.get_prompt_data(action, action_list, action_definition)
+    
+    messages = []
+    responses = []
+    for i, usr_prompt_obj in enumerate(user_prompts):
+        api_params = usr_prompt_obj.api_params
+        if model_overrides:
+            api_params.update(model_overrides)
+        logger.info(f"[{action}] Running step {i+1}/{len(user_prompts)} with parameters: {api_params}")
+
+        output = await api.call_chatgpt_async(
+            sys_prompt=sys_prompt,
+            usr_prompt=usr_prompt_obj.content,
+            examples=messages,
+            **api_params,
+        )
+        if output is None:
+            raise RuntimeError(f"[{action}] step {i+1}/{len(user_prompts)} failed")
+        response, usage = output
+        logger.debug(f"[{action}] Response:\n{response}")
+
+        responses.append({
+            "response": response,
+            "usage": usage.model_dump() if hasattr(usage, "model_dump") else usage,
+            **api_params,
+        })
+        messages.append({"role": "user", "content": usr_prompt_obj.content})
+        messages.append({"role": "assistant", "content": response})
+    
+    if save_path:
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        with open(save_path, 'w') as f:
+            json.dump(responses, f, indent=2)
+    
+    return responses
+
+
+async def run_actions(args, actions: List[str], overrides: Optional[Dict[str, Any]]) -> List[str]:
+    """
+    Generates hard negatives for the given actions, at most `args.max_concurrent_actions` at a time, through one shared async client.
+    Returns the actions that failed.
+    """
+    failed = []
+    semaphore = asyncio.Semaphore(args.max_concurrent_actions)
+    async with AsyncOpenaiAPI(max_tries=args.max_tries, requests_per_minute=args.requests_per_minute,
+                              tokens_per_minute=args.tokens_per_minute, limiter_path=args.limiter_path) as api:
+        async def run(action):
+            save_path = args.output_file.format(action=action)
+            async with semaphore:
+                try:
+                    await generate_hard_negatives_async(
+                        api=api,
+                        action=action,
+                        action_list=load_text_file(args.action_list.format(action=action)),
+                        action_definition=load_text_file(args.action_definition.format(action=action)),
+                        prompt_name=args.prompt,
+                        save_path=save_path,
+                        model_overrides=overrides,
+                    )
+                    logger.info(f"Generated hard negatives for {action} saved to {save_path}")
+                except Exception as e:
+                    logger.error(f"Failed to generate hard negatives for {action}: {e}")
+                    failed.append(action)
+
+        await asyncio.gather(*(run(action) for action in actions))
+        logger.info(f"Total cost: ${api.total_cost:.4f} over {api.usage_totals['requests']} requests")
+    if failed:
+        logger.error(f"{len(failed)} of {len(actions)} actions failed: {', '.join(failed)}")
+    return failed
+
+
 if __name__ == '__main__':
     """
     python -m benchmark.action_recognition.create_negatives.gpt \
@@ -117,13 +203,26 @@ if __name__ == '__main__':
         --action_list benchmark/data/action_lists/football.txt \
         --action_definition benchmark/data/action_definitions/football.txt \
         --output_file benchmark/output/action_recognition/random_negatives_gpt4_5_o4_refinement/football.json
+
+    Several actions can run concurrently in one process, with `{action}` in the paths standing for each action's name:
+    python -m benchmark.action_recognition.create_negatives.gpt \
+        --prompt random_negatives_gpt4_5_o4_refinement \
+        --action football ballet tennis \
+        --action_list benchmark/data/action_lists/{action}.txt \
+        --action_definition benchmark/data/action_definitions/{action}.txt \
+        --output_file benchmark/output/action_recognition/random_negatives_gpt4_5_o4_refinement/{action}.json
     """
     parser = argparse.ArgumentParser(description="Create hard negatives from gpt.")
     parser.add_argument('--prompt', type=str, required=True, help='Prompt name to use for generating hard negatives.')
-    parser.add_argument('--action', type=str, required=True, help='Type of action.')
-    parser.add_argument('--action_list', type=str, required=True, help='Path to the action list file.')
-    parser.add_argument('--action_definition', type=str, required=True, help='Path to the action definition file.')
-    parser.add_argument('--output_file', type=str, required=True, help='Path to the output file.')
+    parser.add_argument('--action', type=str, nargs='+', required=True, help='Type(s) of action. Several actions run concurrently.')
+    parser.add_argument('--action_list', type=str, required=True, help='Path to the action list file ({action} is replaced by the action).')
+    parser.add_argument('--action_definition', type=str, required=True, help='Path to the action definition file ({action} is replaced by the action).')
+    parser.add_argument('--output_file', type=str, required=True, help='Path to the output file ({action} is replaced by the action).')
+    parser.add_argument('--requests_per_minute', type=int, help='Request budget shared by all actions.')
+    parser.add_argument('--tokens_per_minute', type=int, help='Token budget shared by all actions.')
+    parser.add_argument('--limiter_path', type=str, help='Share the budgets with other processes using the same path.')
+    parser.add_argument('--max_concurrent_actions', type=int, default=16, help='Maximum number of actions generated at once.')
+    parser.add_argument('--max_tries', type=int, default=6, help='Maximum number of tries per request when running several actions.')
 
     parser.add_argument('--list_prompts', action='store_true', help='List all available prompts')
     parser.add_argument('--list_categories', action='store_true', help='List all available prompt categories')
@@ -165,11 +264,6 @@ if __name__ == '__main__':
             print(f"  - {prompt}")
         exit(0)
 
-    api = OpenaiAPI()
-    
-    action_list = load_text_file(args.action_list)
-    action_definition = load_text_file(args.action_definition)
-    
     # Build override dict from command line arguments
     model_overrides = {}
     if args.model:
@@ -181,17 +275,29 @@ if __name__ == '__main__':
     
     overrides = model_overrides if model_overrides else None
     
+    if len(args.action) > 1:
+        failed = asyncio.run(run_actions(args, args.action, overrides))
+        exit(1 if failed else 0)
+
+    api = OpenaiAPI()
+    
+    action = args.action[0]
+    action_list = load_text_file(args.action_list.format(action=action))
+    action_definition = load_text_file(args.action_definition.format(action=action))
+    output_file = args.output_file.format(action=action)
+    
     results = generate_hard_negatives(
         api=api,
-        action=args.action,
+        action=action,
         action_list=action_list,
         action_definition=action_definition,
         prompt_name=args.prompt,
-        save_path=args.output_file,
+        save_path=output_file,
         model_overrides=overrides
     )
     
-    print(f"Generated hard negatives saved to {args.output_file}")
+    print(f"Generated hard negatives saved to {output_file}")
+    print(f"Total cost: ${api.total_cost:.4f}")
 
     print("Results:")
     for result in results:
@@ -43,31 +43,12 @@ ACTION_NAMES=(
     yoyo
 )
 
-# Maximum number of parallel processes
-MAX_PARALLEL=16
-
-# Counter for active processes
-count=0
-
-# Function to run a command for a single action
+# Actions run concurrently in a single process (at most MAX_CONCURRENT at a time), sharing one connection pool and these budgets;
+# set them to your account's limits for the model in the prompt
+MAX_CONCURRENT=16
+REQUESTS_PER_MINUTE=500
+TOKENS_PER_MINUTE=200000
 OUTPUT="benchmark/output/action_recognition/hard_negatives_gpt4_5_o3_refinement_v4/"
-run_action() {
-    local action_name=$1
-    echo "Running action: $action_name"
-    
-    python -m benchmark.action_recognition.create_negatives.gpt \
-        --prompt hard_negatives_gpt4_5_o3_refinement \
-        --action "$action_name" \
-        --action_list "benchmark/data/action_lists/${action_name}.txt" \
-        --action_definition "benchmark/data/action_definitions/${action_name}.txt" \
-        --debug \
-        --output_file "${OUTPUT}/${action_name}.json" &
-    
-    # Store the PID of the last background process
-    local pid=$!
-    echo "Started process for $action_name with PID: $pid"
-    return $pid
-}
 
 # Make sure output directory exists
 mkdir -p "$OUTPUT"
@@ -75,28 +56,21 @@ mkdir -p "$OUTPUT"
 # Enable command echoing
 set -x
 
-# Array to keep track of PIDs
-pids=()
-
-# Process all actions
-for action_name in "${ACTION_NAMES[@]}"; do
-    # Check if we're at the max parallel limit
-    if [ $count -ge $MAX_PARALLEL ]; then
-        # Wait for any process to finish
-        wait -n
-        # Decrement counter
-        ((count--))
-    fi
-    
-    # Run the action and capture its PID
-    run_action "$action_name"
-    pids+=($!)
-    
-    # Increment counter
-    ((count++))
-done
-
-# Wait for all remaining processes to complete
-wait
+python -m benchmark.action_recognition.create_negatives.gpt \
+    --prompt hard_negatives_gpt4_5_o3_refinement \
+    --action "${ACTION_NAMES[@]}" \
+    --action_list "benchmark/data/action_lists/{action}.txt" \
+    --action_definition "benchmark/data/action_definitions/{action}.txt" \
+    --max_concurrent_actions "$MAX_CONCURRENT" \
+    --requests_per_minute "$REQUESTS_PER_MINUTE" \
+    --tokens_per_minute "$TOKENS_PER_MINUTE" \
+    --debug \
+    --output_file "${OUTPUT}/{action}.json"
+STATUS=$?
+set +x
 
-echo "All actions completed!"
\ No newline at end of file
+if [ $STATUS -ne 0 ]; then
+    echo "Some actions failed; see the log above."
+    exit $STATUS
+fi
+echo "All actions completed!"
@@ -1,11 +1,13 @@
-import argparse, os, json, subprocess
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse, os, json
 from datetime import datetime
 from tqdm import tqdm
 
+from src.utils import media_probe
+from src.utils.clip_cache import ClipCache
+
 parser = argparse.ArgumentParser()
 parser.add_argument('-f', '--dlfile', type=str, required=True, help='Path to outfile generated by prep_benchmark.py')
-parser.add_argument('-t', '--tmpdir', type=str, required=True, help='Temporary directory where videos are downloaded')
+parser.add_argument('-t', '--tmpdir', type=str, required=True, help='Directory where the clips are placed (as links into the machine-wide clip cache)')
 parser.add_argument('-fps', '--output-fps', action='store_true', required=False, help='If provided, will write a JSON file with FPS info to `fps.json`. Useful for Qwen.')
 args = parser.parse_args()
 dlfile, tmp_dir = args.dlfile, args.tmpdir
@@ -22,32 +24,19 @@ if not (len(uuids) == len(uuids_list) == len(urls)):
     raise Exception('ERROR: duplicate UUIDs or misformatted URL.')
 uuid_to_url_tail: dict[str, tuple[str, str]] = {uuids_list[i]: (urls[i], tails[i]) for i in range(len(uuids))}
 
-# download the clips
-#   core logic
-def download_clip(unique: str) -> tuple[str, str]:
-    url, tail = uuid_to_url_tail[unique]
-    vid_path = os.path.join(tmp_dir, tail)
-    if not os.path.isfile(vid_path): 
-        gcs_url = "gs://" + url.split('https://storage.googleapis.com/')[-1]
-        subprocess.run(['gcloud', 'storage', 'cp', gcs_url, vid_path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    return unique, vid_path
-
-#   parallelization logic
-with ThreadPoolExecutor() as executor:
-    futures = [executor.submit(download_clip, u) for u in uuids]
-    results = [future.result() for future in tqdm(as_completed(futures), total=len(futures), desc='downloading clips')]
-vid_paths: dict[str, str] = dict(results)
+# download the clips (in-process, through the machine-wide clip cache)
+paths, errors = ClipCache().fetch_many(urls, [os.path.join(tmp_dir, t) for t in tails], desc='downloading clips')
+if errors:
+    print(f"\nERROR: unable to download the following {len(errors)} clips:")
+    for url, err in errors.items():
+        print(f"\t{url}: {err}")
+vid_paths: dict[str, str] = {unique: paths[url] for unique, (url, _) in uuid_to_url_tail.items() if url in paths}
 
 # output FPS for each video if asked to; used for Qwen
 fps_info: dict[str, float] = {}
 if args.output_fps:
-    for unique in tqdm(uuids, desc="extracting fps info"):
-        cmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=avg_frame_rate', '-of', 'json', vid_paths[unique]]
-        res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        data = json.loads(res.stdout)
-        fps_fraction = data['streams'][0]['avg_frame_rate']
-        num, denom = map(int, fps_fraction.split('/'))
-        fps = round(num / denom, 2) if denom else 0.
+    for unique in tqdm(vid_paths, desc="extracting fps info"):
+        fps = media_probe.get_fps(vid_paths[unique])
         fps_info[unique] = fps
     now = datetime.now().strftime("%m-%d_%H-%M-%S")
     with open(f'fps_{now}.json', 'w') as f:
@@ -1,10 +1,11 @@
 import cv2, base64, os, argparse, json, threading, math, time, random
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from google.cloud import storage
 from openai import OpenAI
 from tqdm import tqdm
 import numpy as np
 
+from src.utils.gcs import get_client, list_blob_names
+
 MAX_FRAMES = 100
 NUM_ATTEMPTS = 3
 SLEEP_LENGTH = 5
@@ -87,8 +88,8 @@ def extract_frames(vid_paths: list[str]) -> list[tuple[list[str], float]]:
 # initialize Google Cloud Storage client
 frames_to_urls: dict[str, str] = {}
 frames_lock = threading.Lock()
-storage_client = storage.Client()
-bucket = storage_client.bucket(GCS_BUCKET)
+bucket = get_client(GCS_BUCKET).bucket(GCS_BUCKET)
+existing_blobs = list_blob_names(GCS_BUCKET, GCS_SUBBUCKETS)   # one listing instead of an exists() request per frame
 os.makedirs(IMG_DIR, exist_ok=True)
 
 # optionally load in cached GCS URLs
@@ -113,7 +114,7 @@ def frame_to_url(uuid: str, b64_frame: str, frame_idx: int) -> str:
     new_blob_path = os.path.join(GCS_SUBBUCKETS, frame_filename)
     blob = bucket.blob(new_blob_path)
     blob_public_url = os.path.join('https://storage.googleapis.com/', GCS_BUCKET, new_blob_path) 
-    if blob.exists():
+    if new_blob_path in existing_blobs:
         with frames_lock:
             frames_to_urls[f'{uuid}@{frame_idx}'] = blob_public_url
         return blob_public_url
@@ -124,8 +125,7 @@ def frame_to_url(uuid: str, b64_frame: str, frame_idx: int) -> str:
         img_data: bytes = base64.b64decode(b64_frame)
         with open(frame_filepath, 'wb') as f:
             f.write(img_data)
-    blob.upload_from_filename(frame_filepath)
-    blob.make_public()
+    blob.upload_from_filename(frame_filepath, predefined_acl='publicRead')
     
     with frames_lock:
         frames_to_urls[f'{uuid}@{frame_idx}'] = blob_public_url
@@ -0,0 +1,120 @@
+"""
+Reconciles the inputs and outputs of a batch run, so that retries only cost the requests that failed.
+
+Expects a directory laid out by `gpt_batch_prep.py` and `gpt_batch_retrieve.py`, i.e. with a `batchin.jsonl` and a `batchout.jsonl`.
+Each run of this script:
+    1. merges the outputs of earlier retries (`retry_<k>/batchout.jsonl`) into `batchout.jsonl`: every request keeps its successful
+       response if it has one (or else its latest failure), in the order of `batchin.jsonl`. Merging is idempotent;
+    2. writes the requests that are still missing or failed, as-is, to `retry_<k>/batchin.jsonl`;
+    3. with `--submit`, submits that file (see `OpenaiAPI.submit_tasks_in_batches`), logging the batch ids to `retry_<k>/batch_info.jsonl`.
+Once those batches finish, retrieve them with `python gpt_batch_retrieve.py -l <dir>/retry_<k>/batch_info.jsonl -o <dir>/retry_<k> -w`,
+then run this script again to merge them, and finally `python gpt_batch_analyze.py -o <dir>`.
+"""
+import os, argparse, json
+from pathlib import Path
+from src.utils.openai_api import OpenaiAPI, BATCH_REQUEST_LIMIT
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-d', '--dir', type=str, required=True, help='Local path to **DIRECTORY** containing batchin.jsonl and batchout.jsonl')
+parser.add_argument('-s', '--submit', action='store_true', help='submit the requests that are missing or failed as a new batch')
+args = parser.parse_args()
+run_dir = Path(args.dir)
+
+in_file, out_file = run_dir / 'batchin.jsonl', run_dir / 'batchout.jsonl'
+for f in (in_file, out_file):
+    if not f.is_file():
+        print(f'Could not find a file at {f} ... Exiting!')
+        exit(1)
+
+def succeeded(line: dict) -> bool:
+    """ Whether a line of batch output holds a usable response (for both the Chat Completions and the Responses endpoints). """
+    response = line.get('response') or {}
+    if line.get('error') or response.get('status_code') != 200:
+        return False
+    return response.get('body', {}).get('status', 'completed') == 'completed'
+
+# Index every output by custom ID: (file, byte offset of its line, whether it succeeded).
+# Earlier successes win over everything; otherwise the latest failure is kept, since it is the most informative.
+retry_dirs = sorted((d for d in run_dir.glob('retry_*') if d.is_dir() and d.name[6:].isdigit()), key=lambda d: int(d.name[6:]))
+output_files = [out_file] + [d / 'batchout.jsonl' for d in retry_dirs if (d / 'batchout.jsonl').is_file()]
+index: dict[str, tuple[Path, int, bool]] = {}
+for output_file in output_files:
+    with open(output_file, 'rb') as f:
+        offset = 0
+        for raw in f:
+            if raw.strip():
+                line = json.loads(raw)
+                custom_id, ok = line['custom_id'], succeeded(line)
+                if custom_id not in index or not index[custom_id][2]:
+                    index[custom_id] = (output_file, offset, ok)
+            offset += len(raw)
+
+# Walk the inputs once, collecting the ones without a successful output
+input_ids, retry_lines = [], []
+with open(in_file, 'rb') as f:
+    for raw in f:
+        if raw.strip():
+            custom_id = json.loads(raw)['custom_id']
+            input_ids.append(custom_id)
+            if custom_id not in index or not index[custom_id][2]:
+                retry_lines.append(raw if raw.endswith(b'\n') else raw + b'\n')
+num_missing = sum(1 for custom_id in input_ids if custom_id not in index)
+print(f"UPDATE: {len(input_ids)} requests: {len(input_ids) - len(retry_lines)} succeeded, "
+      f"{len(retry_lines) - num_missing} failed, {num_missing} missing")
+
+# Merge retried outputs back into batchout.jsonl, in input order
+if len(output_files) > 1:
+    input_id_set = set(input_ids)
+    merged_ids = [custom_id for custom_id in input_ids if custom_id in index] + [custom_id for custom_id in index if custom_id not in input_id_set]
+    handles = {output_file: open(output_file, 'rb') for output_file in output_files}
+    temp_file = out_file.with_name(f'.{out_file.name}.{os.getpid()}.tmp')
+    try:
+        with open(temp_file, 'wb') as f:
+            for custom_id in merged_ids:
+                output_file, offset, _ = index[custom_id]
+                handles[output_file].seek(offset)
+                raw = handles[output_file].readline()
+                f.write(raw if raw.endswith(b'\n') else raw + b'\n')
+    finally:
+        for handle in handles.values():
+            handle.close()
+    os.replace(temp_file, out_file)
+    print(f"UPDATE: merged the outputs of {len(output_files) - 1} retries into {out_file}")
+
+if not retry_lines:
+    print(f"UPDATE: nothing left to retry. try running `python gpt_batch_analyze.py -o {run_dir}`")
+    exit(0)
+
+# Pick the retry directory: reuse the last one if it was never submitted, wait if it is still in flight, otherwise start a new one
+retry_dir = run_dir / f'retry_{int(retry_dirs[-1].name[6:]) + 1 if retry_dirs else 1}'
+if retry_dirs and not (retry_dirs[-1] / 'batchout.jsonl').is_file():
+    if (retry_dirs[-1] / 'batch_info.jsonl').is_file():
+        print(f"UPDATE: {retry_dirs[-1]} was submitted but its outputs have not been retrieved yet. retrieve them with")
+        print(f"         `python gpt_batch_retrieve.py -l {retry_dirs[-1] / 'batch_info.jsonl'} -o {retry_dirs[-1]} -w`, then rerun this script.")
+        exit(0)
+    retry_dir = retry_dirs[-1]
+retry_dir.mkdir(parents=True, exist_ok=True)
+retry_file = retry_dir / 'batchin.jsonl'
+with open(retry_file, 'wb') as f:
+    f.writelines(retry_lines)
+print(f"UPDATE: wrote the {len(retry_lines)} requests to retry to {retry_file}")
+
+if not args.submit:
+    print("         rerun with `--submit` to submit them.")
+    exit(0)
+
+# get api key
+api_file = os.environ.get("OPENAI_API", "/gscratch/raivn/tanush/credentials/openai.txt")
+try:
+    with open(api_file, 'r') as f:
+        api_key = f.read().strip()
+except Exception as e:
+    print("ERROR: unable to read OpenAI API Key at ", api_file)
+    raise e
+api = OpenaiAPI(api_key=api_key)
+
+batch_info_log = retry_dir / 'batch_info.jsonl'
+tasks = [json.loads(raw) for raw in retry_lines]
+api.submit_tasks_in_batches(tasks, str(retry_dir / 'shards' / 'batchin.jsonl'), str(batch_info_log), batch_size=BATCH_REQUEST_LIMIT, overwrite_batch_info=True)
+print(f"UPDATE: submitted; batch IDs logged to {batch_info_log}")
+print(f"         once they finish, run `python gpt_batch_retrieve.py -l {batch_info_log} -o {retry_dir} -w`, then rerun this script.")
@@ -1,11 +1,18 @@
-import os, argparse
-from openai import OpenAI
+import os, argparse, shutil
+from src.utils.openai_api import OpenaiAPI, BATCH_TERMINAL_STATUSES
 
 parser = argparse.ArgumentParser()
-parser.add_argument('-b', '--batchid', type=str, required=True, help='ID of batch given by `gpt_batch_launch.py`')
+parser.add_argument('-b', '--batchid', type=str, nargs='+', required=False, help='ID(s) of batch(es) given by `gpt_batch_launch.py`')
+parser.add_argument('-l', '--batchlog', type=str, required=False, help='batch info log written by `OpenaiAPI.submit_tasks_in_batches`; retrieves every batch in it')
 parser.add_argument('-o', '--outdir', type=str, required=True, help='Local path to **DIRECTORY** where results from this batch will be stored')
+parser.add_argument('-w', '--wait', action='store_true', help='keep polling until every batch has finished, downloading each as soon as it does')
+parser.add_argument('--poll', type=float, default=30, help='initial seconds between polls when waiting; backs off to 10 minutes while nothing changes')
 args = parser.parse_args()
-batch_id, out_dir = args.batchid, args.outdir
+batch_ids, batch_log, out_dir = args.batchid, args.batchlog, args.outdir
+
+if bool(batch_ids) == bool(batch_log):
+    print('You must provide either batch ID(s) via `-b` or a batch info log via `-l`, but not both. Exiting!')
+    exit(1)
 
 # get api key
 api_file = os.environ.get("OPENAI_API", "/gscratch/raivn/tanush/credentials/openai.txt")
@@ -15,24 +22,32 @@ try:
 except Exception as e:
     print("ERROR: unable to read OpenAI API Key at ", api_file)
     raise e
-client = OpenAI(api_key=api_key)
+api = OpenaiAPI(api_key=api_key)
+
+# poll every batch, streaming the outputs (and errors) of finished ones to `out_dir`
+rows = api.monitor_batches(batch_log or batch_ids, out_dir, wait=args.wait, poll_seconds=args.poll)
+print(f"\nUPDATE: status of every batch written to {os.path.join(out_dir, 'batch_status.tsv')}")
+for row in rows:
+    if row['error_file']:
+        print(f"         batch {row['batch_id']} ({row['status']}) has errors in {row['error_file']}")
 
-# first check if the batch is done
-batch = client.batches.retrieve(batch_id)
-if batch.status != 'completed':
-    print(batch, '\n\n')
-    print(f"UPDATE: batch is not completed yet. instead, it is in the {batch.status} stage.")
+unfinished = [row for row in rows if row['status'] not in BATCH_TERMINAL_STATUSES]
+if unfinished:
+    for row in unfinished:
+        print(f"UPDATE: batch {row['batch_id']} is not completed yet. instead, it is in the {row['status']} stage.")
     print("         please check again later!")
     exit(0)
 
-file_response = client.files.content(batch.output_file_id)
-os.makedirs(out_dir, exist_ok=True)
+# merge the outputs of every batch into one file, in batch order
 outfile = os.path.join(out_dir, 'batchout.jsonl')
 try:
-    with open(outfile, 'w') as f:
-        f.write(file_response.text)
+    with open(outfile, 'wb') as f:
+        for row in rows:
+            if row['output_file']:
+                with open(row['output_file'], 'rb') as batch_f:
+                    shutil.copyfileobj(batch_f, f)
     print(f"UPDATE: outputs written to {outfile}")
     print(f"         try running `python gpt_batch_analyze.py -o {out_dir}`")
 except Exception as e:
     print("ERROR: unable to write output to outfile")
-    raise e
\ No newline at end of file
+    raise e
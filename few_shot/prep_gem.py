@@ -1,4 +1,4 @@
-import argparse, os, json, subprocess, time, pytz
+import argparse, os, json, time, pytz
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from collections import deque
@@ -7,9 +7,11 @@ from copy import deepcopy
 from google import genai
 from tqdm import tqdm
 
+from src.utils.clip_cache import ClipCache
+
 parser = argparse.ArgumentParser()
 parser.add_argument('-d', '--dlfile', type=str, required=True, help='Path to outfile generated by prep_benchmark.py')
-parser.add_argument('-t', '--tmpdir', type=str, required=True, help='Temporary directory where videos are downloaded from GCS before uploading to Gemini File API')
+parser.add_argument('-t', '--tmpdir', type=str, required=True, help='Directory where videos are placed (as links into the machine-wide clip cache) before uploading to Gemini File API')
 parser.add_argument('-r', '--rfile', type=str, required=True, help='Path where JSON file with UUID --> file name mapping will be written.')
 parser.add_argument('--hours', type=int, required=False, default=2, help='Videos that are currently on the Gemini File API but will expire in this many hours will be re-uploaded.')
 args = parser.parse_args()
@@ -62,14 +64,13 @@ to_upload = uuids.difference(set(uuid_to_gfilename.keys()))
 print(f"\nThis benchmark requires {len(uuids)} files. {len(uuid_to_gfilename)} files are already in the Gemini File API. We will now upload the remaining {len(to_upload)} ones.\n")
 
 # download the clips that must be uploaded to Gemini File API
-vid_paths: dict[str, str] = {}
-for unique in tqdm(uuids, desc="downloading clips"):
-    url, tail = uuid_to_url_tail[unique]
-    vid_path = os.path.join(tmp_dir, tail)
-    vid_paths[unique] = vid_path
-    if os.path.isfile(vid_path): continue
-    gcs_url = "gs://" + url.split('https://storage.googleapis.com/')[-1]
-    subprocess.run(['gcloud', 'storage', 'cp', gcs_url, vid_path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+paths, errors = ClipCache().fetch_many(urls, [os.path.join(tmp_dir, t) for t in tails], desc="downloading clips")
+if errors:
+    print(f"\nERROR: unable to download the following {len(errors)} clips, so they will not be uploaded:")
+    for url, err in errors.items():
+        print(f"\t{url}: {err}")
+vid_paths: dict[str, str] = {unique: paths[url] for unique, (url, _) in uuid_to_url_tail.items() if url in paths}
+to_upload = to_upload.intersection(vid_paths)
 
 # upload those clips to Gemini File API
 uuid_lock = Lock()
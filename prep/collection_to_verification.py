@@ -6,12 +6,17 @@ Given a Sqlite3 database from the clip collection stage and a JSONL file contain
     (4) uploads clips to GCS
     (5) creates Sqlite3 database for clip verification stage
 """
-import argparse, os, json, sqlite3, subprocess, uuid, re, shutil, subprocess, concurrent.futures
+import argparse, os, json, sqlite3, subprocess, uuid, re, shutil, subprocess
 import multiprocessing as mp
+from collections import defaultdict
 from datetime import datetime
 from tqdm import tqdm
 from pathlib import Path
-from google.cloud import storage
+
+from src.utils.clipping import cut_clips
+from src.utils import media_probe
+from src.utils.gcs import upload_blob_composite
+from src.utils.clip_cache import ClipCache
 
 print()     # space out CLI output nicely
 
@@ -22,6 +27,7 @@ parser.add_argument('-i', '--jsonl', required=True, type=str, help='Local path t
 parser.add_argument('-g', '--gcs', required=True, type=str, help='GCS folder where trimmed clips are uploaded. Should begin with "gs://" and end with "/".')
 parser.add_argument('-t', '--tmpdir', required=False, type=str, help='Directory where videos are staged for download, trim, upload. Results are stored here.')
 parser.add_argument('-y', '--overwrite', required=False, action='store_true', help='If trimmed clips already exists, chooses to overrwrite them instead of skipping them. Same goes for if converted videos already exist.')
+parser.add_argument('-k', '--keyframe-cut', required=False, action='store_true', help='Stream-copy the keyframe-aligned middle of each clip and only re-encode its head and tail. Much faster, still frame-accurate.')
 args = parser.parse_args()
 args.gcs = os.path.join(args.gcs, 'exact/')
 if args.gcs[:5] != 'gs://':
@@ -87,39 +93,33 @@ if missing:
         shutil.rmtree(tmp_dir)
     exit()
 
-# Download videos from GCS, skipping those that have already been downloaded
-#   core download logic
-def download_video(i):    
-    vid_path = f'{tmp_dir}/videos/{tails[i]}'
-    if Path(vid_path).is_file():
-        return False
-    subprocess.run(['curl', '-s', f'https://storage.googleapis.com/{urls[i][5:]}', '--output', vid_path])
-    return True
-#   parallelization logic
-threads = int(1.7 * os.cpu_count())
-with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
-    futures = [executor.submit(download_video, i) for i in range(num_vids)]
-    for _ in tqdm(concurrent.futures.as_completed(futures), total=num_vids, desc="    Downloading videos"):
-        pass
+# Download videos from GCS through the machine-wide clip cache, so videos fetched by earlier runs are reused
+# (each video is itself fetched as a few range requests streamed to disk; kept small to fit in the job's memory and cores)
+_, download_errors = ClipCache().fetch_many(urls, [f'{tmp_dir}/videos/{t}' for t in tails], max_workers=4, slice_workers=2,
+                                            chunk_size=16 * 1024 * 1024, desc="    Downloading videos")
 
 # Ensure all videos are browser-compatible
 err_str = []
 err_yts = []
+for i in range(num_vids):
+    if urls[i] in download_errors:
+        err = f"ERROR: unable to download {urls[i]}: {download_errors[urls[i]]}"
+        err_str.append(err)
+        err_yts.append(yt_ids[i])
+        print(err)
 defacto_compatible = set(['mp4', 'webm'])
 acceptable_codecs = set(['h264', 'vp9', 'av1'])
 for i in tqdm(range(num_vids), desc="    Converting videos"):
-    if exts[i] in defacto_compatible:
+    if exts[i] in defacto_compatible or urls[i] in download_errors:
         continue
     
     vid_path = f'{tmp_dir}/videos/{tails[i]}'
     # check encoding
-    vcmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=codec_name', '-of', 'default=nokey=1:noprint_wrappers=1', vid_path]
-    acmd = ['ffprobe', '-v', 'error', '-select_streams', 'a:0', '-show_entries', 'stream=codec_name', '-of', 'default=noprint_wrappers=1:nokey=1', vid_path]
-    vres = subprocess.run(vcmd, capture_output=True, text=True)
-    ares = subprocess.run(acmd, capture_output=True, text=True)
-    if vres.returncode or ares.returncode:
+    try:
+        video_coding, audio_coding = media_probe.get_codec_name(vid_path, 'video'), media_probe.get_codec_name(vid_path, 'audio')
+    except (subprocess.CalledProcessError, FileNotFoundError):
         print(f"ERROR: unable to get encoding of {urls[i]}")
-    video_coding, audio_coding = vres.stdout.strip(), ares.stdout.strip()
+        video_coding, audio_coding = '', ''
     cmd = ['ffmpeg', '-i', vid_path]
     cmd.extend(['-c:v', 'copy'] if exts[i] == 'mkv' and video_coding in acceptable_codecs else ['-c:v', 'libx264'])
     cmd.extend(['-c:a', 'copy'] if audio_coding == 'aac' or audio_coding == 'opus' else ['-c:a', 'aac'])
@@ -141,24 +141,34 @@ for i in tqdm(range(num_vids), desc="    Converting videos"):
 
 # Trim into clips and upload to GCS
 #   core logic for trimming and uploading
-def trim_and_upload(clip_data) -> tuple[str | None, str | None, str | None, str | None]:
+def trim_and_upload(video_data) -> list[tuple[str | None, str | None, str | None, str | None]]:
     """
-    Returns 4 tuple of,
+    Trims every clip of a single YouTube video (decoding that video only once) and uploads the clips.
+
+    Returns a list with one 4 tuple per clip of,
         0. UUID of processed clip
         1. Trimmed Tail of processed clip (so uuid.ext where uuid is clip's UUID and ext is clip's file extension)
         2. Error message as a string
         3. ID of YouTube video for which error occured
     Note that [0] and [1] are set IFF operation is successful, meanwhile [2] and [3] are set IFF an error occurs.
     """
-    clip, bucket_name, subbuckets, tmp_dir, args = clip_data
-    start, end, unique, yt_id = clip['start'], clip['end'], clip['uuid'], clip['yt_id']
+    video_clips, bucket_name, subbuckets, tmp_dir, args = video_data
+    yt_id = video_clips[0]['yt_id']
+    results, to_trim = [], []
     
     # skip if already trimmed
-    if not args.overwrite:
-        if Path(f'{tmp_dir}/clips/{unique}.mp4').is_file():
-            return unique, f"{unique}.mp4", None, None
-        if Path(f'{tmp_dir}/clips/{unique}.webm').is_file():
-            return unique, f"{unique}.webm", None, None
+    for clip in video_clips:
+        unique = clip['uuid']
+        if not args.overwrite:
+            if Path(f'{tmp_dir}/clips/{unique}.mp4').is_file():
+                results.append((unique, f"{unique}.mp4", None, None))
+                continue
+            if Path(f'{tmp_dir}/clips/{unique}.webm').is_file():
+                results.append((unique, f"{unique}.webm", None, None))
+                continue
+        to_trim.append(clip)
+    if not to_trim:
+        return results
     
     # determine if we working with a mp4 or webm file
     if Path(f'{tmp_dir}/videos/{yt_id}.mp4').is_file():
@@ -168,51 +178,60 @@ def trim_and_upload(clip_data) -> tuple[str | None, str | None, str | None, str
     else:
         err = f"ERROR: unable to locate a video with MP4 or WEBM extension at {tmp_dir}/videos/{yt_id}"
         print(err)
-        return None, None, err, yt_id
+        return results + [(None, None, err, yt_id) for _ in to_trim]
     og_path = f"{tmp_dir}/videos/{yt_id}.{ext}"
     
-    # ensure start point of trim is during video
-    length_cmd = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', og_path]
-    res = subprocess.run(length_cmd, capture_output=True, text=True)
-    if res.returncode:
-        print(res.returncode)
+    # ensure start point of each trim is during video
+    try:
+        duration = media_probe.get_duration(og_path)
+    except (subprocess.CalledProcessError, KeyError, ValueError):
         err = f"ERROR: ffprobe could not determine duration of video with yt id {yt_id}"
-        # print(err)
-        return None, None, err, yt_id
-    duration = float(res.stdout.strip())
-    if start > duration:
-        err = f"ERROR: clip with UUID {unique} and yt id {yt_id} had duration {duration} but clip start time {start}"
-        print(err)
-        return None, None, err, yt_id
+        return results + [(None, None, err, yt_id) for _ in to_trim]
+    cuts = []
+    for clip in to_trim:
+        start, end, unique = clip['start'], clip['end'], clip['uuid']
+        if start > duration:
+            err = f"ERROR: clip with UUID {unique} and yt id {yt_id} had duration {duration} but clip start time {start}"
+            print(err)
+            results.append((None, None, err, yt_id))
+            continue
+        cuts.append((start, end + 1, f"{tmp_dir}/clips/{unique}.{ext}"))
     
-    # trim
-    trimmed_path = f"{tmp_dir}/clips/{unique}.{ext}"
-    trimmed_tail = f"{unique}.{ext}"
-    res = subprocess.run(['ffmpeg', '-loglevel', 'quiet', '-i', og_path, '-ss', str(start), '-to', str(end + 1), trimmed_path, '-y'])
-    if res.returncode:
-        # trimming failure
-        err = f"ERROR: ffmpeg trimming from {start} to {end + 1} failed for uuid {unique} and yt id {yt_id}"
-        print(err)
-        return None, None, err, yt_id
-    else:
-        # upload
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(os.path.join(subbuckets, trimmed_tail))
-        blob.upload_from_filename(trimmed_path)
-        blob.make_public()
-        return unique, trimmed_tail, None, None
+    # trim all clips of this video in one pass
+    trim_errors = cut_clips(og_path, cuts, mode='keyframe' if args.keyframe_cut else 'accurate', overwrite=True)
+    
+    # upload
+    for start, stop, trimmed_path in cuts:
+        trimmed_tail = os.path.basename(trimmed_path)
+        unique = trimmed_tail.split('.')[0]
+        if trim_errors[trimmed_path]:
+            # trimming failure
+            err = f"ERROR: ffmpeg trimming from {start} to {stop} failed for uuid {unique} and yt id {yt_id}"
+            print(err)
+            results.append((None, None, err, yt_id))
+            continue
+        blob_name = os.path.join(subbuckets, trimmed_tail)
+        if upload_blob_composite(bucket_name, trimmed_path, blob_name, predefined_acl='publicRead') == -1:
+            err = f"ERROR: upload to GCS failed for uuid {unique} and yt id {yt_id}"
+            print(err)
+            results.append((None, None, err, yt_id))
+            continue
+        results.append((unique, trimmed_tail, None, None))
+    return results
 
 #   GCS logic
 gcs_without_prefix = args.gcs[5:]           # ex: args.gcs is 'gs://action-atlas/public/skateboarding/', so this removes 'gs://'
 gcs_parts = gcs_without_prefix.split('/')   # ex: ['action-atlas', 'public', 'skateboarding', '']
 bucket_name, subbuckets = gcs_parts[0], "/".join(gcs_parts[1:]).strip() # ex: 'action-atlas', 'public/skateboarding/'
 
-#   parallelization logic
-pinputs = [(clip, bucket_name, subbuckets, tmp_dir, args) for clip in clips]
+#   parallelization logic (one task per YouTube video, so each video is only decoded once)
+clips_by_video = defaultdict(list)
+for clip in clips:
+    clips_by_video[clip['yt_id']].append(clip)
+pinputs = [(video_clips, bucket_name, subbuckets, tmp_dir, args) for video_clips in clips_by_video.values()]
 cores = int((os.cpu_count() - 2) * 0.8)
 with mp.Pool(processes=cores) as pool:
-    pres = list(tqdm(pool.imap(trim_and_upload, pinputs), total=len(clips), desc="    Trimming & Uploading clips"))
+    pres = [r for rs in tqdm(pool.imap(trim_and_upload, pinputs), total=len(pinputs), desc="    Trimming & Uploading clips") for r in rs]
 new_tails, uuids = {}, []
 for r in pres:
     if r[0]:    # success
@@ -6,11 +6,16 @@ Given a Sqlite3 database from the clip verification stage and a JSONL file conta
 Since trimming is I/O bound, parallelizing across nodes is optimal for this task. 
 Accordingly, this script is meant to be run via a Job Arary on Hyak (or any other server that uses the SLURM Workload Manager). 
 """
-import sqlite3, json, os, subprocess, concurrent.futures, random, time
+import sqlite3, json, os, subprocess, random, time
 import multiprocess as mp
+from collections import defaultdict
 from tqdm import tqdm
 from pathlib import Path
-from google.cloud import storage
+
+from src.utils.clipping import cut_clips
+from src.utils import media_probe
+from src.utils.gcs import upload_blob_composite
+from src.utils.clip_cache import ClipCache
 
 CUSHION = 2.0
 
@@ -20,6 +25,7 @@ time.sleep(7 * task_id + random.uniform(1, 5))
 
 # Config
 vdb, jsonl, gcs, tmp_dir, overwrite = os.environ.get('DATABASE'), os.environ.get('JSONL'), os.environ.get('GCS'), os.environ.get('TMPDIR'), int(os.environ.get('OVERWRITE'))
+cut_mode = 'keyframe' if int(os.environ.get('KEYFRAME_CUT', 0)) else 'accurate'
 if gcs[:5] != 'gs://':
     print("ERROR: GCS bucket given via -g flag must begin with 'gs://'")
     exit()
@@ -105,39 +111,33 @@ assert len(video_urls) == len(tails) == len(yt_ids) == len(exts), 'size mismatch
 # and `video_urls` storing strings of where on GCS the entire YouTube video is stored.
 # Both of these lists only store information on the clips **WE** are in charge of processing.
 
-# Download videos from GCS, skipping those that have already been downloaded
-#   core download logic
-def download_video(i):    
-    vid_path = f'{tmp_dir}/videos/{tails[i]}'
-    if Path(vid_path).is_file():
-        return False
-    subprocess.run(['curl', '-s', f'https://storage.googleapis.com/{video_urls[i][5:]}', '--output', vid_path])
-    return True
-#   parallelization logic
-threads = int(1.7 * os.cpu_count())
-with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
-    futures = [executor.submit(download_video, i) for i in range(num_vids)]
-    for _ in tqdm(concurrent.futures.as_completed(futures), total=num_vids, desc="    Downloading videos"):
-        pass
+# Download videos from GCS through the machine-wide clip cache, so videos fetched by earlier runs are reused
+# (each video is itself fetched as a few range requests streamed to disk; kept small to fit in the job's memory and cores)
+_, download_errors = ClipCache().fetch_many(video_urls, [f'{tmp_dir}/videos/{t}' for t in tails], max_workers=4, slice_workers=2,
+                                            chunk_size=16 * 1024 * 1024, desc="    Downloading videos")
 
 # Ensure all videos are browser-compatible
 err_str = []
 err_yts = []
+for i in range(num_vids):
+    if video_urls[i] in download_errors:
+        err = f"ERROR: unable to download {video_urls[i]}: {download_errors[video_urls[i]]}"
+        err_str.append(err)
+        err_yts.append(yt_ids[i])
+        print(err)
 defacto_compatible = set(['mp4', 'webm'])
 acceptable_codecs = set(['h264', 'vp9', 'av1'])
 for i in tqdm(range(num_vids), desc="    Converting videos"):
-    if exts[i] in defacto_compatible:
+    if exts[i] in defacto_compatible or video_urls[i] in download_errors:
         continue
     
     vid_path = f'{tmp_dir}/videos/{tails[i]}'
     # check encoding
-    vcmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=codec_name', '-of', 'default=nokey=1:noprint_wrappers=1', vid_path]
-    acmd = ['ffprobe', '-v', 'error', '-select_streams', 'a:0', '-show_entries', 'stream=codec_name', '-of', 'default=noprint_wrappers=1:nokey=1', vid_path]
-    vres = subprocess.run(vcmd, capture_output=True, text=True)
-    ares = subprocess.run(acmd, capture_output=True, text=True)
-    if vres.returncode or ares.returncode:
+    try:
+        video_coding, audio_coding = media_probe.get_codec_name(vid_path, 'video'), media_probe.get_codec_name(vid_path, 'audio')
+    except (subprocess.CalledProcessError, FileNotFoundError):
         print(f"ERROR: unable to get encoding of {video_urls[i]}")
-    video_coding, audio_coding = vres.stdout.strip(), ares.stdout.strip()
+        video_coding, audio_coding = '', ''
     cmd = ['ffmpeg', '-i', vid_path]
     cmd.extend(['-c:v', 'copy'] if exts[i] == 'mkv' and video_coding in acceptable_codecs else ['-c:v', 'libx264'])
     cmd.extend(['-c:a', 'copy'] if audio_coding == 'aac' or audio_coding == 'opus' else ['-c:a', 'aac'])
@@ -158,16 +158,18 @@ for i in tqdm(range(num_vids), desc="    Converting videos"):
         print(err)
 
 # Trim into clips **WITH CUSHION** and upload to GCS
-def trim_and_upload(clip_data) -> tuple[str | None, str | None, str | None, str | None]:
+def trim_and_upload(video_data) -> list[tuple[str | None, str | None, str | None]]:
     """
-    Returns 3 tuple of,
+    Trims every clip of a single YouTube video (decoding that video only once) and uploads the clips.
+
+    Returns a list with one 3 tuple per clip of,
         0. UUID of processed clip
         1. Error message as a string
         2. ID of YouTube video for which error occured
     Note that [0] is set IFF operation is successful, meanwhile [1] and [2] are set IFF an error occurs.
     """
-    clip, gcs_without_prefix, tmp_dir = clip_data
-    start, end, unique, yt_id = clip['start'], clip['end'], clip['uuid'], clip['yt_id']
+    video_clips, gcs_without_prefix, tmp_dir = video_data
+    yt_id = video_clips[0]['yt_id']
 
     # ex: gcs_without_prefix is 'action-atlas/public/skateboarding/cushion/'
     gcs_parts = gcs_without_prefix.split('/')   # ex: ['action-atlas', 'public', 'skateboarding', 'cushion', '']
@@ -181,52 +183,62 @@ def trim_and_upload(clip_data) -> tuple[str | None, str | None, str | None, str
     else:
         err = f"ERROR: unable to locate a video with MP4 or WEBM extension at {tmp_dir}/videos/{yt_id}"
         print(err)
-        return None, err, yt_id
+        return [(None, err, yt_id) for _ in video_clips]
     og_path = f"{tmp_dir}/videos/{yt_id}.{ext}"
     
-    # ensure start point of trim is during video
-    length_cmd = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', og_path]
-    res = subprocess.run(length_cmd, capture_output=True, text=True)
-    if res.returncode:
-        print(res.returncode)
+    # ensure start point of each trim is during video
+    try:
+        duration = media_probe.get_duration(og_path)
+    except (subprocess.CalledProcessError, KeyError, ValueError):
         err = f"ERROR: ffprobe could not determine duration of video with yt id {yt_id}"
-        return None, err, yt_id
-    duration = float(res.stdout.strip())
-    if start > duration:
-        err = f"ERROR: clip with UUID {unique} and yt id {yt_id} had duration {duration} but clip start time {start}"
-        print(err)
-        return None, err, yt_id
+        return [(None, err, yt_id) for _ in video_clips]
+    results, cuts, cut_clips_data = [], [], []
+    for clip in video_clips:
+        start, end, unique = clip['start'], clip['end'], clip['uuid']
+        if start > duration:
+            err = f"ERROR: clip with UUID {unique} and yt id {yt_id} had duration {duration} but clip start time {start}"
+            print(err)
+            results.append((None, err, yt_id))
+            continue
     
-    # compute cushioned start and end times
-    cushion_start = max(0, start - CUSHION)
-    cushion_end = min(duration, end + CUSHION)
+        # compute cushioned start and end times
+        cushion_start = max(0, start - CUSHION)
+        cushion_end = min(duration, end + CUSHION)
+        cuts.append((cushion_start, cushion_end + 1, f"{tmp_dir}/clips/{unique}.{ext}"))
+        cut_clips_data.append((clip, cushion_start, cushion_end))
     
-    # trim
-    trimmed_path = f"{tmp_dir}/clips/{unique}.{ext}"
-    trimmed_tail = f"{unique}.{ext}"
-    res = subprocess.run(['ffmpeg', '-loglevel', 'quiet', '-i', og_path, '-ss', str(cushion_start), '-to', str(cushion_end + 1), trimmed_path, '-y'])
-    if res.returncode:
-        # trimming failure
-        err = f"ERROR: ffmpeg trimming from {cushion_start} to {cushion_end + 1} failed for uuid {unique} and yt id {yt_id}"
-        print(err)
-        return None, err, yt_id
-    else:
-        # upload
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(os.path.join(subbuckets, trimmed_tail))
-        blob.upload_from_filename(trimmed_path)
-        blob.make_public()
+    # trim all clips of this video in one pass
+    trim_errors = cut_clips(og_path, cuts, mode=cut_mode, overwrite=True)
+
+    # upload
+    for (_, _, trimmed_path), (clip, cushion_start, cushion_end) in zip(cuts, cut_clips_data):
+        unique, trimmed_tail = clip['uuid'], os.path.basename(trimmed_path)
+        if trim_errors[trimmed_path]:
+            # trimming failure
+            err = f"ERROR: ffmpeg trimming from {cushion_start} to {cushion_end + 1} failed for uuid {unique} and yt id {yt_id}"
+            print(err)
+            results.append((None, err, yt_id))
+            continue
+        blob_name = os.path.join(subbuckets, trimmed_tail)
+        if upload_blob_composite(bucket_name, trimmed_path, blob_name, predefined_acl='publicRead') == -1:
+            err = f"ERROR: upload to GCS failed for uuid {unique} and yt id {yt_id}"
+            print(err)
+            results.append((None, err, yt_id))
+            continue
         public_url = 'https://storage.googleapis.com/' + os.path.join(gcs_without_prefix, trimmed_tail)
         clip['cushion_start'], clip['cushion_end'], clip['cushion_url'] = cushion_start, cushion_end, public_url
-        return unique, None, None
+        results.append((unique, None, None))
+    return results
 
-#   parallelization logic
+#   parallelization logic (one task per YouTube video, so each video is only decoded once)
 gcs_without_prefix = gcs_cushion[5:]        # ex: gcs_cushion is 'gs://action-atlas/public/skateboarding/cushion/', so this removes 'gs://'
-pinputs = [(clip, gcs_without_prefix, tmp_dir) for clip in clips]
+clips_by_video = defaultdict(list)
+for clip in clips:
+    clips_by_video[clip['yt_id']].append(clip)
+pinputs = [(video_clips, gcs_without_prefix, tmp_dir) for video_clips in clips_by_video.values()]
 cores = int((os.cpu_count() - 2) * 0.8)
 with mp.Pool(processes=cores) as pool:
-    pres = list(tqdm(pool.imap(trim_and_upload, pinputs), total=len(clips), desc="    Trimming & Uploading clips"))
+    pres = [r for rs in tqdm(pool.imap(trim_and_upload, pinputs), total=len(pinputs), desc="    Trimming & Uploading clips") for r in rs]
 uuids = []  # list of UUIDs that were successfully trimmed and uploaded to GCS
 for r in pres:
     if r[0]:    # success
@@ -17,6 +17,7 @@ export JSONL="${DOMAIN}.jsonl"
 export GCS="gs://action-atlas/public/${DOMAIN}/"
 export TMPDIR="tmp_$(date '+%m%d_%H%M%S')"          # change this if you want to continue an old run
 export OVERWRITE=0  # boolean
+export KEYFRAME_CUT=0   # boolean; opt in to stream-copying the keyframe-aligned middle of each clip instead of re-encoding all of it
 
 # Basic logging
 echo "My Task ID: " $SLURM_ARRAY_TASK_ID
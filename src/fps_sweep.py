@@ -0,0 +1,38 @@
+"""
+Sweeps the fps at which Qwen verifies clips and reports the accuracy and latency at each fps, so that the pipeline's verification fps
+can be chosen from data. Replaces the old `Qwen25VL.bin_search`.
+
+Takes a JSON file mapping the absolute path of each labelled clip to whether the action occurs in it, e.g.
+    {"/data/clips/laser_flip_1.mp4": true, "/data/clips/laser_flip_2.mp4": false}
+"""
+import argparse, json
+from datetime import datetime
+
+from src.models import Qwen25VL
+from src.prompts import QWEN_FALSE_POSITIVE_VERIFICATION
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure Qwen's verification accuracy and latency across sampling rates.")
+    parser.add_argument('labels', help="JSON file mapping clip paths to true/false labels")
+    parser.add_argument('--fps', type=float, nargs='+', default=[1, 2, 4, 8, 16], help="fps values to evaluate; clips are decoded once at the highest")
+    parser.add_argument('--batch-size', type=int, default=8, help="number of clips Qwen verifies per forward pass")
+    parser.add_argument('--max-pixels', type=int, default=360 * 420, help="maximum number of pixels per decoded frame")
+    parser.add_argument('-o', '--output', help="where to save the full results (including raw outputs) as JSON")
+    args = parser.parse_args()
+
+    with open(args.labels, 'r') as f:
+        labels: dict[str, bool] = json.load(f)
+
+    qwen = Qwen25VL()
+    results = qwen.fps_sweep(QWEN_FALSE_POSITIVE_VERIFICATION, list(labels.keys()), list(labels.values()), args.fps, args.batch_size, args.max_pixels)
+
+    print("------------------------------------------------------------------------------------")
+    print(f"\t{'FPS':>6}  {'ACCURACY':>8}  {'SEC/CLIP':>8}  {'FRAMES/CLIP':>11}")
+    for res in results:
+        print(f"\t{res['fps']:>6g}  {res['accuracy']:>8.3f}  {res['latency']:>8.3f}  {res['num_frames']:>11.1f}")
+    print("------------------------------------------------------------------------------------\n")
+
+    output = args.output or f'fps_sweep_{datetime.now().strftime("%m-%d_%H-%M-%S")}.json'
+    with open(output, 'w') as f:
+        json.dump({'clips': list(labels.keys()), 'labels': list(labels.values()), 'results': results}, f, indent=2)
+    print(f"Saved full results to {output}")
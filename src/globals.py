@@ -3,6 +3,7 @@ Global constants used by various files.
 Everything that a developer must change to run this codebase on their machine should be stored here.
 """
 from pathlib import Path
+import os
 
 # you will need to CHANGE these
 # the following must end with '/'
@@ -13,6 +14,8 @@ CREDENTIALS_DIR = "/gscratch/raivn/tanush/credentials/"
 REPO_DIR = Path(__file__).parent.parent
 DATA_DIR = REPO_DIR / 'data'
 ORIGINALS_DIR, CLIPS_DIR = DATA_DIR / 'originals', DATA_DIR / 'clips'
+# on-disk caches (probe results, model responses, downloads, ...) shared by every tool on this machine
+CACHE_DIR = Path(os.environ.get('VIDEONET_CACHE_DIR', Path.home() / '.cache' / 'videonet'))
 
 # these files should live inside `CREDENTIALS_DIR`
 GCLOUD_API_KEY_FILENAME = "google_genai.txt"
\ No newline at end of file
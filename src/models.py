@@ -10,27 +10,49 @@ from src.globals import MODELS_DIR, CREDENTIALS_DIR, GCLOUD_API_KEY_FILENAME
 
 # Qwen2.5-VL-7B Instruct
 from transformers import Qwen2_5_VLForConditionalGeneration, AutoProcessor
-from qwen_vl_utils import process_vision_info
+from qwen_vl_utils import process_vision_info, smart_resize
+from src.utils.common import decode_video_frames, get_video_resolution, subsample_frames
+from src.utils.inference_cache import InferenceCache
 
 # Gemini
 import google.generativeai as genai     # note that we use the older google-generativeai SDK, not the newer google-genai one; see https://ai.google.dev/gemini-api/docs/migrate
-import mimetypes, time
+import mimetypes, time, asyncio
+from src.utils.rate_limiter import TokenBucket
 
 class Qwen25VL:
-    def __init__(self):
+    MODEL_ID = "Qwen/Qwen2.5-VL-7B-Instruct"
+
+    def __init__(self, cache: InferenceCache | None = None):
         """
         Initializes model and processor from Hugging Face transformers library.
+
+        If a `cache` is provided, every `*_inference*` call first looks its request up there and only generates on a miss.
         """
         print()
         self.model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
-            "Qwen/Qwen2.5-VL-7B-Instruct", torch_dtype=torch.bfloat16, device_map="auto", 
+            Qwen25VL.MODEL_ID, torch_dtype=torch.bfloat16, device_map="auto", 
             attn_implementation="flash_attention_2", cache_dir=MODELS_DIR
         )
         print()
-        self.processor = AutoProcessor.from_pretrained("Qwen/Qwen2.5-VL-7B-Instruct")
+        self.processor = AutoProcessor.from_pretrained(Qwen25VL.MODEL_ID)
+        self.processor.tokenizer.padding_side = "left"     # required for batched generation with a decoder-only model
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.cache = cache
+
+    def _cache_lookup(self, text: str, media: list, **settings) -> tuple[str | None, list[str] | str | None]:
+        """
+        Returns the cache key of a request and its cached response (None on a miss); (None, None) if this instance has no cache.
+        """
+        if not self.cache:
+            return None, None
+        key = self.cache.key(Qwen25VL.MODEL_ID, text, media, generation_config=self.model.generation_config.to_dict(), **settings)
+        return key, self.cache.get(key)
 
     def text_inference(self, text :str, max_tokens: int = 256):
+        key, cached = self._cache_lookup(text, [], max_tokens=max_tokens)
+        if cached is not None:
+            return cached
+
         messages = [
             {
                 "role": "user",
@@ -51,6 +73,8 @@ class Qwen25VL:
             generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
         )
 
+        if key:
+            self.cache.put(key, output_text)
         return output_text
 
     def images_inference(self, text: str, images: list[str], are_paths: list[bool] | None, max_tokens: int = 256) -> list[str]:
@@ -70,6 +94,9 @@ class Qwen25VL:
         for idx, is_path in enumerate(are_paths):
             if is_path:
                 images[idx] = f"file://{images[idx]}"
+        key, cached = self._cache_lookup(text, images, max_tokens=max_tokens)
+        if cached is not None:
+            return cached
 
         # prepare model input
         messages = [
@@ -94,6 +121,8 @@ class Qwen25VL:
         # postprocessing
         generated_ids_trimmed = [out_ids[len(in_ids) : ] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)]
         output_text = self.processor.batch_decode(generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+        if key:
+            self.cache.put(key, output_text)
         return output_text
 
     def video_inference(self, text: str, video: str, is_path: bool = False, max_pixels: int = 360 * 420, fps: float = 1.0, max_tokens: int = 4096) -> list[str]:
@@ -105,6 +134,10 @@ class Qwen25VL:
         # Prepare message for model
         if is_path:
             video = f"file://{video}"
+        # namespaced by method, since `video_inference_batch` caches one string per video rather than a list
+        key, cached = self._cache_lookup(text, [video], method='video_inference', fps=fps, max_pixels=max_pixels, max_tokens=max_tokens)
+        if cached is not None:
+            return cached
         messages = [
             {
                 "role": "user",
@@ -144,36 +177,148 @@ class Qwen25VL:
             generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
         )
 
+        if key:
+            self.cache.put(key, output_text)
         return output_text
-    
-    def second_pass(self, name: str, num: int, fps: int):
-        prompt = 'Your job is to determine if a skateboarding trick is performed in the video clip. If one is performed, return YES. If one is not performed, return NO.'
+
+    def load_video_frames(self, video_path: str | Path, fps: float, max_pixels: int = 360 * 420) -> torch.Tensor:
+        """
+        Decodes the local video at `video_path` once at `fps`, resized the same way `qwen_vl_utils` resizes videos
+        (each side a multiple of 28, at most `max_pixels` pixels per frame).
+
+        Returns a uint8 tensor of shape (T, C, H, W); segments of it can be cut out with `src.utils.common.slice_frames`
+        and passed straight to `video_inference_batch` without writing them to disk.
+        """
+        width, height = get_video_resolution(video_path)
+        resized_height, resized_width = smart_resize(height, width, max_pixels=max_pixels)
+        frames = decode_video_frames(video_path, fps, size=(resized_width, resized_height))
+        return torch.from_numpy(frames).permute(0, 3, 1, 2)
+
+    def video_inference_batch(self, text: str, videos: list[str | torch.Tensor], are_paths: bool = False, fps: float = 1.0, batch_size: int = 8,
+                              max_pixels: int = 360 * 420, max_tokens: int = 4096) -> list[str]:
+        """
+        Model generation with the same text prompt applied to many videos, batching them through `model.generate`.
+
+        Returns one output string per entry in `videos`, in the same order. Videos are padded together into groups of at most
+        `batch_size`, so verifying N clips costs ceil(N / `batch_size`) generate calls instead of N.
+        Lower `batch_size` if the GPU runs out of memory on long clips or high `fps`.
+
+        Each entry of `videos` is either a string or an already-decoded (T, C, H, W) frame tensor sampled at `fps` (see `load_video_frames`).
+        Strings are decoded at `fps` and resized to at most `max_pixels` pixels per frame, the same way `load_video_frames` resizes, so a clip
+        gets the same input whether it is passed as a path or as frames decoded with the same `fps` and `max_pixels`.
+        Strings are assumed to be URLs by default. If they are local files, they should be absolute paths and the `are_paths` flag should be turned on.
+
+        With a cache, each video is looked up on its own and only the misses are batched through the model.
+        """
+        if batch_size < 1:
+            raise ValueError('`batch_size` must be a positive integer.')
+
+        outputs: list[str | None] = [None] * len(videos)
+        keys: list[str | None] = [None] * len(videos)
+        for i, video in enumerate(videos):
+            keys[i], outputs[i] = self._cache_lookup(text, [video], method='video_inference_batch', fps=fps, max_pixels=max_pixels, max_tokens=max_tokens)
+        misses = [i for i, output in enumerate(outputs) if output is None]
+
+        for idx in range(0, len(misses), batch_size):
+            batch_idxs = misses[idx : idx + batch_size]
+            batch = [videos[i] for i in batch_idxs]
+
+            # Prepare one conversation per video; decoded frames skip `process_vision_info` and go straight to the processor
+            text_inputs, video_inputs = [], []
+            for video in batch:
+                if isinstance(video, torch.Tensor):
+                    content, frames = {"type": "video"}, [video]
+                else:
+                    if are_paths:
+                        video = f"file://{video}"
+                    content = {"type": "video", "video": video, "fps": fps, "max_pixels": max_pixels}
+                    _, frames = process_vision_info([[{"role": "user", "content": [content]}]])
+                conversation = [
+                    {
+                        "role": "user",
+                        "content": [
+                            content,
+                            { "type": "text",  "text": text }
+                        ]
+                    }
+                ]
+                text_inputs.append(self.processor.apply_chat_template(conversation, tokenize=False, add_generation_prompt=True))
+                video_inputs += frames
+
+            # Prepare inputs; prompts are left-padded so that generation starts at the same position for every sequence
+            inputs = self.processor(
+                text=text_inputs,
+                videos=video_inputs,
+                fps=fps,
+                padding=True,
+                return_tensors="pt",
+            )
+            inputs = inputs.to(self.device)
+
+            # Inference
+            generated_ids = self.model.generate(**inputs, max_new_tokens=max_tokens)
+
+            # Prepare outputs
+            generated_ids_trimmed = [
+                out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
+            ]
+            batch_outputs = self.processor.batch_decode(
+                generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
+            )
+            for i, output in zip(batch_idxs, batch_outputs):
+                outputs[i] = output
+                if keys[i]:
+                    self.cache.put(keys[i], output)
+
+        return outputs
+
+    def fps_sweep(self, text: str, clip_paths: list[str | Path], labels: list[bool], fps_values: list[float] = (1, 2, 4, 8, 16),
+                  batch_size: int = 8, max_pixels: int = 360 * 420, max_tokens: int = 4096, positive: str = 'YES') -> list[dict]:
+        """
+        Measures how the accuracy and cost of a yes/no video prompt `text` depend on the fps that clips are sampled at,
+        so that the cheapest fps that holds accuracy can be picked from data.
+
+        Each local clip in `clip_paths` is decoded once, at the highest of `fps_values`; the input at every lower fps is a strided
+        subsample of those frames (see `src.utils.common.subsample_frames`), so no clip is decoded more than once.
+        For each fps, all clips go through `video_inference_batch` in batches of `batch_size`. An output counts as a positive
+        prediction if it starts with `positive`, and is compared with the matching entry of `labels`.
+
+        Returns one dict per fps, in ascending order of fps, with keys 'fps', 'accuracy', 'latency' (seconds spent generating, per clip),
+        'num_frames' (average per clip) and 'outputs'. The cache, if any, is bypassed so that latencies are real.
+        """
+        if len(clip_paths) != len(labels):
+            raise ValueError('`labels` must have exactly as many entries as `clip_paths`.')
+        if not clip_paths:
+            raise ValueError('`clip_paths` must not be empty.')
+
+        max_fps = max(fps_values)
+        clips = [self.load_video_frames(clip_path, max_fps, max_pixels) for clip_path in clip_paths]
+
         results = []
-        for i in range(1, num + 1):
-            vid_path = f"/gscratch/raivn/tanush/VideoNet/data/{name}_{i}.mp4"
-            res = self.video_inference(prompt, vid_path, is_path=True, fps=fps)
-            results.append(res[0])
+        cache, self.cache = self.cache, None
+        try:
+            for fps in sorted(set(fps_values)):
+                videos = [subsample_frames(clip, max_fps, fps) for clip in clips]
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                begin = time.perf_counter()
+                outputs = self.video_inference_batch(text, videos, fps=fps, batch_size=batch_size, max_tokens=max_tokens)
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                latency = (time.perf_counter() - begin) / len(videos)
+
+                predictions = [output.strip().upper().startswith(positive.upper()) for output in outputs]
+                results.append({
+                    'fps': fps,
+                    'accuracy': sum(pred == label for pred, label in zip(predictions, labels)) / len(labels),
+                    'latency': latency,
+                    'num_frames': sum(video.shape[0] for video in videos) / len(videos),
+                    'outputs': outputs,
+                })
+        finally:
+            self.cache = cache
         return results
     
-    def bin_search(self, name: str, gt: list[bool]):
-        l, r, num = 2.0, 30.0, len(gt)
-        best_fps = float('inf')
-        best_acc = float('-inf')
-        while l < r:
-            m = l + (r - l) // 2
-            res = self.second_pass(name, num, m)
-            res = [True if r == 'YES' else False for r in res]
-            curr_acc = 0
-            for i in range(num):
-                curr_acc += int(gt[i] == res[i])
-            if curr_acc >= best_acc:
-                best_acc = curr_acc
-                best_fps = min(best_fps, m)
-                r = m - 1
-            else:
-                l = m + 1
-        return best_fps, best_acc
-    
 class Gemini:
     # variables that *YOU* might need to change
     _MODEL_INFO = {
@@ -183,11 +328,24 @@ class Gemini:
         "flash-lite": {"name": "gemini-2.0-flash-lite-preview-02-05", "rpm": 30, "rpd": 1500}
     }
 
-    def __init__(self, model_id: str, sys_instr: str | None = None):
+    # how long to wait between checks on whether an uploaded file has finished processing; the delay doubles after every check
+    _POLL_INITIAL_DELAY, _POLL_MAX_DELAY, _POLL_TIMEOUT = 1.0, 30.0, 600.0
+
+    # (requests-per-minute, requests-per-day) limiters for each model, shared by every instance in this process
+    _LIMITERS: dict[str, tuple[TokenBucket, TokenBucket]] = {}
+
+    def __init__(self, model_id: str, sys_instr: str | None = None, cache: InferenceCache | None = None):
+        """
+        If a `cache` is provided, `inference` and `inference_async` first look their request up there (by the contents of the media),
+        so a cache hit skips both the uploads and the request to Gemini.
+        """
         # get model info
         if model_id not in Gemini._MODEL_INFO:
             raise ValueError(f"`model_id` must be a key in the `{Gemini.__name__}._MODEL_INFO` map.")
         name, rpm, rpd = [*Gemini._MODEL_INFO[model_id].values()]
+        if name not in Gemini._LIMITERS:
+            Gemini._LIMITERS[name] = (TokenBucket(rpm, 60), TokenBucket(rpd, 24 * 60 * 60))
+        self.rpm_limiter, self.rpd_limiter = Gemini._LIMITERS[name]
 
         # get api key
         api_file = CREDENTIALS_DIR + GCLOUD_API_KEY_FILENAME
@@ -212,11 +370,15 @@ class Gemini:
             generation_config = config,
             system_instruction = sys_instr if sys_instr else "Be concise."
         )
+        self.cache = cache
+        self._cache_settings = {'generation_config': config, 'system_instruction': sys_instr if sys_instr else "Be concise."}
+        self.name = name
 
-    def upload_media(self, media: list[tuple[str | Path, str | None]]) -> list:
-        if not media:
-            return None
-
+    @staticmethod
+    def _sanitize_media(media: list[tuple[str | Path, str | None] | Path | str]) -> list[tuple[str, str | None]]:
+        """
+        Validates `media` and returns it as a list of (local path, MIME type or None) tuples.
+        """
         if not isinstance(media, list):
             raise TypeError("`media` must be a list.")
 
@@ -243,19 +405,37 @@ class Gemini:
                 raise FileNotFoundError(f"`media` included a path to the following file, but no such file exists: {local_path}")
 
             media_sanitized.append((str(local_path), mime_type))
+        return media_sanitized
+
+    @classmethod
+    def _poll_delays(cls):
+        """
+        Yields how long to sleep before each successive check on a processing file: exponential backoff, capped at `_POLL_MAX_DELAY`,
+        until a total of `_POLL_TIMEOUT` seconds has been spent waiting.
+        """
+        delay, waited = cls._POLL_INITIAL_DELAY, 0.
+        while waited < cls._POLL_TIMEOUT:
+            delay = min(delay, cls._POLL_TIMEOUT - waited)
+            yield delay
+            waited += delay
+            delay = min(delay * 2, cls._POLL_MAX_DELAY)
+
+    def upload_media(self, media: list[tuple[str | Path, str | None]]) -> list:
+        if not media:
+            return None
+        media_sanitized = self._sanitize_media(media)
 
         files = [genai.upload_file(local_path, mime_type=mime_type) for local_path, mime_type in media_sanitized]
 
         print("\n\tMedia files have been uploaded to Gemini. \n\tCurrently waiting for them to be processed...", end="")
-        # code from Google AI Studio demo
         for name in (file.name for file in files):
             file = genai.get_file(name)
-            i = 0
-            while file.state.name == 'PROCESSING' and i < 4:
+            for delay in self._poll_delays():
+                if file.state.name != 'PROCESSING':
+                    break
                 print(".", end="", flush=True)
-                time.sleep(5)
+                time.sleep(delay)
                 file = genai.get_file(name)
-                i += 1
             if file.state.name != 'ACTIVE':
                 raise Exception(f"File {file.name} failed to process")
         print("\n\tAll files are now ready!")
@@ -263,9 +443,37 @@ class Gemini:
 
         return files
 
+    async def upload_media_async(self, media: list[tuple[str | Path, str | None] | Path | str]) -> list:
+        """
+        Same as `upload_media`, but all files are uploaded concurrently and their processing state is polled
+        concurrently (with exponential backoff) without blocking the event loop.
+        """
+        if not media:
+            return None
+        media_sanitized = self._sanitize_media(media)
+
+        # the SDK is synchronous, so each upload/poll runs in a worker thread
+        files = await asyncio.gather(*(asyncio.to_thread(genai.upload_file, local_path, mime_type=mime_type) for local_path, mime_type in media_sanitized))
+        await asyncio.gather(*(self._wait_until_active_async(file.name) for file in files))
+        return files
+
+    async def _wait_until_active_async(self, name: str) -> None:
+        file = await asyncio.to_thread(genai.get_file, name)
+        for delay in self._poll_delays():
+            if file.state.name != 'PROCESSING':
+                break
+            await asyncio.sleep(delay)
+            file = await asyncio.to_thread(genai.get_file, name)
+        if file.state.name != 'ACTIVE':
+            raise Exception(f"File {file.name} failed to process")
+
     def inference(self, prompt, media: list[tuple[Path | str, str | None] | Path | str]):
         # to avoid annoying warning message: https://github.com/grpc/grpc/issues/38490#issuecomment-2604775087
         # prompt = "You have been given a video that shows multiple skateboarding tricks. Your job is to help segment the different tricks. Provide a list of the start and end times of each trick that is performed. You do not need to name the trick, focus on providing the start and stop times.\n\nFormat your response as a list of segments. Each segment should be denoted MM:SS-MM:SS."
+        key = self.cache.key(self.name, prompt, media, **self._cache_settings) if self.cache else None
+        if key and (cached := self.cache.get(key)) is not None:
+            return cached
+
         try:
             files = self.upload_media(media)
         except Exception as e:
@@ -275,6 +483,37 @@ class Gemini:
         chat_session = self.model.start_chat(
             history = [ {'role': "user", 'parts': files} ]
         )
+        self.rpd_limiter.acquire()
+        self.rpm_limiter.acquire()
         response = chat_session.send_message(prompt)
         
-        return response.text
\ No newline at end of file
+        if key:
+            self.cache.put(key, response.text)
+        return response.text
+
+    async def inference_async(self, prompt, media: list[tuple[Path | str, str | None] | Path | str]) -> str:
+        """
+        Same as `inference`, but can be awaited alongside other calls; e.g., `asyncio.gather(*(gem.inference_async(prompt, [v]) for v in videos))`.
+        Uploads overlap freely, while requests to the model wait on the `rpm`/`rpd` limits declared in `_MODEL_INFO`.
+        """
+        # hashing media and querying SQLite both block, so they run off the event loop
+        key = await asyncio.to_thread(self.cache.key, self.name, prompt, media, **self._cache_settings) if self.cache else None
+        if key and (cached := await asyncio.to_thread(self.cache.get, key)) is not None:
+            return cached
+
+        try:
+            files = await self.upload_media_async(media)
+        except Exception as e:
+            print("ERROR: unable to upload the provided media files to Gemini.")
+            raise e
+
+        chat_session = self.model.start_chat(
+            history = [ {'role': "user", 'parts': files} ]
+        )
+        await self.rpd_limiter.acquire_async()
+        await self.rpm_limiter.acquire_async()
+        response = await chat_session.send_message_async(prompt)
+
+        if key:
+            await asyncio.to_thread(self.cache.put, key, response.text)
+        return response.text
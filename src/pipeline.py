@@ -1,8 +1,10 @@
-import os, argparse, logging
+import os, argparse, logging, asyncio, threading, queue
 from pathlib import Path
+import torch
 
 from src.models import Qwen25VL, Gemini
-from src.utils.common import cut_video, parse_segments, sanitize_segments
+from src.utils.inference_cache import InferenceCache
+from src.utils.common import cut_video, parse_segments, sanitize_segments, slice_frames
 from src.globals import ORIGINALS_DIR, CLIPS_DIR
 from src.prompts import GEMINI_TEMPORAL_LOCALIZATION, QWEN_FALSE_POSITIVE_VERIFICATION
 
@@ -13,7 +15,7 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-def main(video_name: str, overwrite=False, gem: Gemini | None = None, qwen: Qwen25VL | None = None) -> list[Path]:
+def main(video_name: str, overwrite=False, gem: Gemini | None = None, qwen: Qwen25VL | None = None, batch_size: int = 8, in_memory: bool = False) -> list[Path]:
     """
     Given a video -- located in `data/originals/` with name `{video_name}.mp4` -- 
     finds all instances of an action occuring and saves clips of those instances in `data/clips/`.
@@ -29,14 +31,15 @@ def main(video_name: str, overwrite=False, gem: Gemini | None = None, qwen: Qwen
 
     For efficiency purposes, client can choose to pass in instances of Gemini and Qwen2.5-VL in `gem` and `qwen`.
     This allows this function be called multiple times in succession by client while only loading checkpoints onto GPU once.
+
+    Qwen verifies up to `batch_size` clips per forward pass; lower it if the GPU runs out of memory.
+
+    If `in_memory` is set, the original video is decoded once into a frame buffer and each segment is handed to Qwen
+    as a slice of that buffer; only segments that pass verification are ever cut and written to disk.
     """
-    video_path = ORIGINALS_DIR / f'{video_name}.mp4'
+    video_path = _original_path(video_name)
     logger.info(f"Kicking off pipeline to localize actions in {video_path}")
 
-    # STEP 0: Verify that the provided video exists.
-    if not video_path.exists() and not video_path.is_file():
-        raise FileNotFoundError(f"Attempting to run pipeline on a video file that doesn't exist: {video_path}")
-
     # STEP 1: Query Gemini on when the action occurs in the video
     logger.info("Asking Gemini to identify segments where action occured")
     if not gem:
@@ -48,31 +51,160 @@ def main(video_name: str, overwrite=False, gem: Gemini | None = None, qwen: Qwen
     segments = sanitize_segments(segments)
     logger.info("Segments identified by Gemini")
 
-    # STEP 3: Extract clips corresponding to each segment found by Gemini; save them as '{video_name}_clip_i.mp4'
+    real_clip_paths = _verify_segments(video_name, video_path, segments, overwrite, qwen, batch_size, in_memory)
+    logger.info("Done :)")
+    print()
+    return real_clip_paths
+
+def localize_videos(video_names: list[str], overwrite=False, gem: Gemini | None = None, qwen: Qwen25VL | None = None, batch_size: int = 8, in_memory: bool = False,
+                    gemini_concurrency: int = 4, queue_size: int | None = None) -> dict[str, list[Path]]:
+    """
+    Runs the pipeline of `main` on many videos and returns a map from each video name to the clips saved for it.
+
+    The videos flow through three stages that run at the same time, connected by queues holding at most `queue_size` videos each:
+        1. Gemini localization (network-bound), with up to `gemini_concurrency` videos in flight within the model's `rpm`/`rpd` limits;
+        2. cutting each segment to a clip with FFmpeg, or decoding the original into memory if `in_memory` is set (CPU-bound);
+        3. Qwen verification and saving of the clips (GPU-bound), on the calling thread.
+    Gemini can thus work on video k+1 while video k is being cut and verified, so throughput is limited by the slowest stage
+    rather than by the sum of all three. The bounded queues keep a fast stage from racing ahead (and, in particular, cap how many
+    decoded videos sit in memory at once).
+
+    `queue_size` defaults to 2, or to 1 if `in_memory` is set: up to `queue_size` + 2 decoded originals (one being decoded, those
+    queued, one being verified) are then held at once, at about 7 MB per second of video (26 GB per hour) at 16 fps.
+
+    A video that fails at any stage is logged and left out of the returned map rather than aborting the others.
+    """
+    video_paths = {video_name: _original_path(video_name) for video_name in video_names}
+    if not gem:
+        gem = Gemini('thinking')
+    if not qwen:
+        qwen = Qwen25VL()
+    fps = 16
+    if queue_size is None:
+        queue_size = 1 if in_memory else 2
+    segments_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    prepared_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+
+    # STAGE 1 (STEPS 1-2): localize with Gemini
+    def localize():
+        try:
+            asyncio.run(_localize_stage(gem, video_paths, segments_queue, gemini_concurrency))
+        finally:
+            segments_queue.put(_DONE)
+
+    # STAGE 2 (STEP 3): cut the segments into clips, or decode the original into memory
+    def prepare():
+        try:
+            while (item := segments_queue.get()) is not _DONE:
+                video_name, segments = item
+                try:
+                    if in_memory:
+                        prepared = qwen.load_video_frames(video_paths[video_name], fps)
+                    else:
+                        prepared = _cut_segments(video_name, segments, overwrite)
+                except Exception as e:
+                    logger.error(f"Failed to prepare the segments of {video_paths[video_name]} for verification: {e}")
+                    continue
+                prepared_queue.put((video_name, segments, prepared))
+        finally:
+            prepared_queue.put(_DONE)
+
+    stages = [threading.Thread(target=localize, daemon=True), threading.Thread(target=prepare, daemon=True)]
+    for stage in stages:
+        stage.start()
+
+    # STAGE 3 (STEPS 4-5): verify with Qwen and save the clips
+    results: dict[str, list[Path]] = {}
+    while (item := prepared_queue.get()) is not _DONE:
+        video_name, segments, prepared = item
+        logger.info(f"Verifying {len(segments)} segments identified by Gemini in {video_paths[video_name]}")
+        try:
+            if in_memory:
+                results[video_name] = _verify_frames(video_name, prepared, segments, overwrite, qwen, batch_size, fps)
+            else:
+                results[video_name] = _verify_cut_clips(video_name, prepared, overwrite, qwen, batch_size)
+        except Exception as e:
+            logger.error(f"Failed to verify the segments of {video_paths[video_name]}: {e}")
+        del item, prepared
+        logger.info(f"Finished {len(results)} of {len(video_paths)} videos")
+
+    for stage in stages:
+        stage.join()
+    logger.info("Done :)")
+    print()
+    return results
+
+# marks the end of the stream of videos passed between the stages of `localize_videos`
+_DONE = object()
+
+async def _localize_stage(gem: Gemini, video_paths: dict[str, Path], segments_queue: queue.Queue, concurrency: int) -> None:
+    """
+    Stage 1 of `localize_videos`: queues (video name, segments) for every video as soon as Gemini has localized it.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def localize_one(video_name: str, video_path: Path) -> None:
+        async with semaphore:
+            try:
+                output = await gem.inference_async(GEMINI_TEMPORAL_LOCALIZATION, [video_path])
+                segments = sanitize_segments(parse_segments(output))
+            except Exception as e:
+                logger.error(f"Gemini failed to localize actions in {video_path}: {e}")
+                return
+            logger.info(f"Gemini identified {len(segments)} segments in {video_path}")
+            # hold on to the semaphore while the queue is full, so that Gemini never gets too far ahead of the other stages
+            await asyncio.to_thread(segments_queue.put, (video_name, segments))
+
+    await asyncio.gather(*(localize_one(video_name, video_path) for video_name, video_path in video_paths.items()))
+
+def _original_path(video_name: str) -> Path:
+    """
+    STEP 0: Verify that the provided video exists in `data/originals/` and return its path.
+    """
+    video_path = ORIGINALS_DIR / f'{video_name}.mp4'
+    if not video_path.exists() and not video_path.is_file():
+        raise FileNotFoundError(f"Attempting to run pipeline on a video file that doesn't exist: {video_path}")
+    return video_path
+
+def _verify_segments(video_name: str, video_path: Path, segments: list[tuple[int, int]], overwrite: bool, qwen: Qwen25VL | None, batch_size: int, in_memory: bool) -> list[Path]:
+    if in_memory:
+        return _verify_in_memory(video_name, video_path, segments, overwrite, qwen, batch_size)
+    return _verify_clip_files(video_name, segments, overwrite, qwen, batch_size)
+
+def _verify_clip_files(video_name: str, segments: list[tuple[int, int]], overwrite: bool, qwen: Qwen25VL | None, batch_size: int) -> list[Path]:
+    """
+    Steps 3-5 of `main` when every segment is first cut to its own file and Qwen reads the clips back from disk.
+    """
+    temp_clip_paths = _cut_segments(video_name, segments, overwrite)
+    if not qwen:
+        qwen = Qwen25VL()
+    return _verify_cut_clips(video_name, temp_clip_paths, overwrite, qwen, batch_size)
+
+def _cut_segments(video_name: str, segments: list[tuple[int, int]], overwrite: bool) -> list[Path]:
+    """
+    STEP 3: Extract clips corresponding to each segment found by Gemini; save them as '{video_name}_clip_i.mp4'
+    """
     cut_video(video_name, segments, overwrite=overwrite)
-    logger.info("Clips of segments extracted")
+    logger.info(f"Clips of segments of {video_name} extracted")
+    return [CLIPS_DIR / f"{video_name}_clip_{i}.mp4" for i in range(1, len(segments) + 1)]
 
+def _verify_cut_clips(video_name: str, temp_clip_paths: list[Path], overwrite: bool, qwen: Qwen25VL, batch_size: int) -> list[Path]:
+    """
+    Steps 4-5 of `main` for the clips written by `_cut_segments`.
+    """
     # STEP 4: Verify via Qwen if *an* action occured in each segment (i.e., filter out false positives)
     logger.info("Begginning second pass using Qwen to identify false positive clips")
     print()
-    if not qwen:
-        qwen = Qwen25VL()
-    verified_segments = set()
-    for i in range(1, len(segments) + 1):
-        temp_clip_path = CLIPS_DIR / f"{video_name}_clip_{i}.mp4"
-        retval = qwen.video_inference(QWEN_FALSE_POSITIVE_VERIFICATION, str(temp_clip_path), is_path=True, fps=16)[0]
-        if retval == 'YES':
-            verified_segments.add(i)
+    retvals = qwen.video_inference_batch(QWEN_FALSE_POSITIVE_VERIFICATION, [str(p) for p in temp_clip_paths], are_paths=True, fps=16, batch_size=batch_size)
     print()
 
     # STEP 5: Filter clips so only those of verified segments remain.
     #         For each temp clip from step 3, save it as a real clip if it was verified by Qwen; otherwise, delete it.
     logger.info("Removing false positives")
     real_clip_paths, j = [], 1
-    for i in range(1, len(segments) + 1):
+    for temp_clip_path, retval in zip(temp_clip_paths, retvals):
         # false positive; remove it
-        temp_clip_path = CLIPS_DIR / f'{video_name}_clip_{i}.mp4'
-        if i not in verified_segments:
+        if retval != 'YES':
             os.remove(temp_clip_path)
             continue
 
@@ -89,24 +221,96 @@ def main(video_name: str, overwrite=False, gem: Gemini | None = None, qwen: Qwen
         real_clip_paths.append(real_clip_path)
         j += 1
 
-    logger.info("Done :)")
+    return real_clip_paths
+
+def _verify_in_memory(video_name: str, video_path: Path, segments: list[tuple[int, int]], overwrite: bool, qwen: Qwen25VL | None, batch_size: int, fps: float = 16) -> list[Path]:
+    """
+    Steps 3-5 of `main` when the original is decoded once and segments are verified from in-memory frames.
+    Only verified segments are cut from the original and saved as `{video_name}_i.mp4`.
+    """
+    # STEP 3: Decode the original video once; each segment is a view into this shared frame buffer
+    if not qwen:
+        qwen = Qwen25VL()
+    frames = qwen.load_video_frames(video_path, fps)
+    logger.info("Original video decoded into memory")
+    return _verify_frames(video_name, frames, segments, overwrite, qwen, batch_size, fps)
+
+def _verify_frames(video_name: str, frames: torch.Tensor, segments: list[tuple[int, int]], overwrite: bool, qwen: Qwen25VL, batch_size: int, fps: float) -> list[Path]:
+    """
+    Steps 4-5 of `main` for an original decoded by `Qwen25VL.load_video_frames` at `fps`.
+    """
+    # STEP 4: Verify via Qwen if *an* action occured in each segment (i.e., filter out false positives)
+    logger.info("Begginning second pass using Qwen to identify false positive segments")
     print()
+    clips = [slice_frames(frames, fps, start, stop) for start, stop in segments]
+    retvals = qwen.video_inference_batch(QWEN_FALSE_POSITIVE_VERIFICATION, clips, fps=fps, batch_size=batch_size)
+    verified_segments = [segment for segment, retval in zip(segments, retvals) if retval == 'YES']
+    del clips, frames
+    print()
+
+    # STEP 5: Cut only the verified segments, then give them their final names
+    logger.info("Saving verified segments")
+    cut_video(video_name, verified_segments, overwrite=overwrite)
+    real_clip_paths = []
+    for j in range(1, len(verified_segments) + 1):
+        temp_clip_path = CLIPS_DIR / f'{video_name}_clip_{j}.mp4'
+        real_clip_path = CLIPS_DIR / f'{video_name}_{j}.mp4'
+        if real_clip_path.exists() and not overwrite:
+            raise FileExistsError(f'Attempted to save a clip that already exists: {real_clip_path}')
+        os.replace(temp_clip_path, real_clip_path)
+        real_clip_paths.append(real_clip_path)
+
     return real_clip_paths
 
+def read_manifest(manifest_path: str | Path) -> list[str]:
+    """
+    Reads a manifest of originals to localize: one video name (or path to an MP4 in `data/originals/`) per line.
+    Blank lines and lines starting with '#' are ignored.
+    """
+    video_names = []
+    with open(manifest_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                video_names.append(Path(line).stem if line.endswith('.mp4') else line)
+    return video_names
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="A pipeline to localize action occurences in a video and extract clips of said occurences.")
-    parser.add_argument('video', help="name of MP4 video in `data/originals/` to be localized")
+    parser.add_argument('videos', nargs='*', help="names of MP4 videos in `data/originals/` to be localized")
+    parser.add_argument('--manifest', help="text file listing the videos in `data/originals/` to localize, one per line")
+    parser.add_argument('--all', action='store_true', help="localize every MP4 video in `data/originals/`")
     parser.add_argument('--overwrite', action='store_true', help="if clips of same name already exist, overwrite them")
+    parser.add_argument('--batch-size', type=int, default=8, help="number of clips Qwen verifies per forward pass")
+    parser.add_argument('--in-memory', action='store_true', help="verify segments from frames decoded in memory; only verified clips are written to disk. "
+                        "Each decoded original takes about 7 MB of RAM per second of video (26 GB per hour), and up to `--queue-size` + 2 are held at once")
+    parser.add_argument('--gemini-concurrency', type=int, default=4, help="number of videos Gemini localizes at once when localizing several videos")
+    parser.add_argument('--cache', action='store_true', help="reuse Gemini and Qwen responses from earlier runs on identical clips and prompts")
+    parser.add_argument('--queue-size', type=int, help="number of videos that may wait between stages when localizing several videos (default: 2, or 1 with `--in-memory`)")
     args = parser.parse_args()
 
+    video_names: list[str] = list(args.videos)
+    if args.manifest:
+        video_names += read_manifest(args.manifest)
+    if args.all:
+        video_names += sorted(p.stem for p in ORIGINALS_DIR.glob('*.mp4'))
+    video_names = list(dict.fromkeys(video_names))
+    if not video_names:
+        parser.error("provide at least one video, a `--manifest`, or `--all`")
+
     print()
     logger.info("Initializing Qwen on this device")
-    qwen = Qwen25VL()
-    gem = Gemini('thinking')
-    clips: list[Path] = main(args.video, args.overwrite, gem, qwen)
+    cache = InferenceCache() if args.cache else None
+    qwen = Qwen25VL(cache=cache)
+    gem = Gemini('thinking', cache=cache)
+    if len(video_names) == 1:
+        results: dict[str, list[Path]] = {video_names[0]: main(video_names[0], args.overwrite, gem, qwen, args.batch_size, args.in_memory)}
+    else:
+        results = localize_videos(video_names, args.overwrite, gem, qwen, args.batch_size, args.in_memory, args.gemini_concurrency, args.queue_size)
 
     print("------------------------------------------------------------------------------------")
     print("\t RESULTING CLIPS:\n")
-    for clip in clips:
-        print("\t", str(clip))
+    for clips in results.values():
+        for clip in clips:
+            print("\t", str(clip))
     print("------------------------------------------------------------------------------------\n")
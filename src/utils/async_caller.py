@@ -1,27 +1,67 @@
 import multiprocessing as mp
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Callable, List, Literal
-import json
+from typing import Any, Callable, List, Literal
+import asyncio, functools, inspect, json, os, pickle, random
 
 import time
 from tqdm import tqdm
 
 
+class CompletionIndex:
+    """
+    Append-only sidecar file listing the key of every datum whose result has already been saved, one per line,
+    so that an interrupted job can skip completed data in O(1) each when it resumes. Every key is fsync'd as it is added.
+    """
+    def __init__(self, path: str, truncate: bool = False):
+        self.path = path
+        self.keys: set[str] = set()
+        if os.path.isfile(path) and not truncate:
+            with open(path, 'r') as f:
+                self.keys = set(line.rstrip('\n') for line in f if line.strip())
+        self._file = open(path, 'w' if truncate else 'a')
+
+    def __contains__(self, key) -> bool:
+        return str(key) in self.keys
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def add(self, key) -> None:
+        key = str(key)
+        if '\n' in key:
+            raise ValueError('Keys in a completion index cannot contain newlines.')
+        self._file.write(key + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.keys.add(key)
+
+    def close(self) -> None:
+        self._file.close()
+
+
 class BatchCaller:
 
     @classmethod
-    def call_batch(cls, fn: Callable, data: List, **kwargs) -> List:
+    def call_batch(cls, fn: Callable, data: List, on_result: Callable | None = None, **kwargs) -> List:
         """
         Calls a function on a batch of data.
 
         Args:
             fn (Callable): The function to call.
             data (List): The data to process.
+            on_result (Callable, optional): If provided, called with (datum, result) as each non-None result becomes available,
+                and results are not collected in memory.
 
         Returns:
-            List: The results of the function calls.
+            List: The results of the function calls (empty if `on_result` is provided).
         """
-        return [fn(d) for d in tqdm(data)]
+        if on_result is None:
+            return [fn(d) for d in tqdm(data)]
+        for d in tqdm(data):
+            res = fn(d)
+            if res is not None:
+                on_result(d, res)
+        return []
     
     @classmethod
     def batch_process_save(cls, 
@@ -32,10 +72,20 @@ class BatchCaller:
                            sort_key: str=None, 
                            write_mode:Literal['a','w']='a',
                            max_workers=None,
+                           stream=False,
+                           key: Callable | None = None,
+                           keep_results=True,
                            **kwargs):
         """
         Processes data in batches and saves the results to a file.
 
+        In streaming mode (`stream`, implied by `key`), results are instead appended to the file and fsync'd one by one as they
+        arrive, so a crash loses at most the calls in flight. If `key` is provided, the key of each datum whose result was saved is
+        recorded in a sidecar index (`{output_file}.done`, see `CompletionIndex`), and data whose keys are already in it are skipped,
+        so re-running the same command resumes the job. With `keep_results` set to False, no results are kept in memory,
+        so arbitrarily large jobs run in constant memory. Data whose result is None are not recorded, so they are retried on resume.
+        Streamed results are written as UTF-8 JSON lines, with non-ASCII text (e.g., transcripts) kept as-is rather than escaped.
+
         Args:
             data (List): The list of data to process.
             fn (Callable): The function to call on each batch.
@@ -43,15 +93,21 @@ class BatchCaller:
             batch_size (int, optional): The size of each batch. Defaults to 1000.
             sort_key (str, optional): The key to sort the results by. If None, no sorting is done. Defaults to None.
             write_mode (Literal['a','w'], optional): The mode to open the file in. 'a' for append and 'w' for write. Defaults to 'a'.
+            stream (bool, optional): Save each result as soon as it arrives, rather than once per batch. Defaults to False.
+            key (Callable, optional): Maps a datum to the string identifying it in the completion index. Defaults to None.
+            keep_results (bool, optional): Whether to keep and return the results. Defaults to True.
 
         Returns:
-            List: The results of the function calls.
+            List: The results of the function calls (None if `keep_results` is False).
         """
+        if stream or key is not None:
+            return cls._stream_process_save(data, fn, output_file, batch_size, write_mode, max_workers, key, keep_results, **kwargs)
+
         all_result: List = []
         for idx in tqdm(range(0, len(data), batch_size)):
             
             # Process in batches
-            batch_result: list = cls.call_batch(fn, data[idx:idx+batch_size], **kwargs)
+            batch_result: list = cls.call_batch(fn, data[idx:idx+batch_size], max_workers=max_workers, **kwargs)
             batch_result = [r for r in batch_result if r is not None]
 
             # Sort if a key is provided
@@ -67,9 +123,42 @@ class BatchCaller:
                     f.write(json.dumps(r) + '\n')
                 print(f'Save {len(batch_result)} batch data to {output_file}')
 
-            all_result += batch_result
+            if keep_results:
+                all_result += batch_result
         
-        return all_result
+        return all_result if keep_results else None
+
+    @classmethod
+    def _stream_process_save(cls, data, fn, output_file, batch_size, write_mode, max_workers, key, keep_results, **kwargs):
+        index = CompletionIndex(output_file + '.done', truncate=write_mode == 'w') if key is not None else None
+        if index is not None and len(index):
+            num_data = len(data)
+            data = [d for d in data if key(d) not in index]
+            print(f'Skipping {num_data - len(data)} data already saved to {output_file}')
+
+        all_result: List = []
+        count = 0
+        with open(output_file, write_mode, encoding='utf-8') as f:
+            def save(datum, res):
+                nonlocal count
+                # the result is durable before its key is, so a crash in between can only cause a duplicate line, never a lost result
+                f.write(json.dumps(res, ensure_ascii=False) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+                if index is not None:
+                    index.add(key(datum))
+                if keep_results:
+                    all_result.append(res)
+                count += 1
+                if count % batch_size == 0:
+                    print(f'Saved {count} results to {output_file}')
+            try:
+                cls.call_batch(fn, data, max_workers=max_workers, on_result=save, **kwargs)
+            finally:
+                if index is not None:
+                    index.close()
+        print(f'Saved {count} results to {output_file}')
+        return all_result if keep_results else None
     
     @staticmethod
     def _retry_wrapper(fn, datum, retry_delay, max_retries):
@@ -91,7 +180,7 @@ class FutureThreadCaller(BatchCaller):
     Updates a tqdm progress bar as each future completes.
     """
     @classmethod
-    def call_batch(cls, fn, data, max_workers=None, retry_delay=3, max_retries=3):
+    def call_batch(cls, fn, data, max_workers=None, retry_delay=3, max_retries=3, on_result=None):
         results = []
         with ThreadPoolExecutor(max_workers=max_workers) as executor:
             # Submit all the tasks
@@ -101,23 +190,217 @@ class FutureThreadCaller(BatchCaller):
                                desc="Processing (Threads)"):
                 try:
                     res = future.result()
-                    if res is not None:
+                    if res is not None and on_result is not None:
+                        on_result(future_to_data[future], res)
+                    elif res is not None:
                         results.append(res)
                 except Exception as e:
                     print("Error processing data:", e)
         return results
 
+# object built by the `initializer` of `MultiProcessCaller.call_batch` in the current worker process (e.g., a model loaded once per worker)
+_worker_resource: Any = None
+
+def get_worker_resource() -> Any:
+    """
+    Returns the object built by the `initializer` passed to `MultiProcessCaller.call_batch` for the current worker process,
+    or None if there was no initializer (or when called outside of a worker).
+    """
+    return _worker_resource
+
+def _init_worker(initializer: Callable | None, initargs: tuple) -> None:
+    global _worker_resource
+    _worker_resource = initializer(*initargs) if initializer else None
+
+def _call_with_datum(call: Callable, datum) -> tuple:
+    return datum, call(datum)
+
 class MultiProcessCaller(BatchCaller):
     """
+    Uses a multiprocessing pool to call a function on a dataset across all cores, for CPU-bound work (e.g., frame extraction).
     Uses native multiprocessing instead of concurrent.futures to support tqdm progress bar
     """
+    @staticmethod
+    def _check_picklable(**objs) -> None:
+        """
+        Raises a `TypeError` naming any of `objs` that cannot be sent to worker processes, instead of letting the pool fail obscurely.
+        """
+        for name, obj in objs.items():
+            try:
+                pickle.dumps(obj)
+            except Exception as e:
+                raise TypeError(f"`{name}` must be picklable to be run in worker processes (e.g., a function defined at the top level "
+                                f"of a module, not a lambda, closure or bound method of an unpicklable object): {e}") from e
+
+    @staticmethod
+    def _chunksize(num_data: int, num_workers: int) -> int:
+        """
+        Same heuristic as `multiprocessing.Pool.map`: about four chunks per worker, which amortizes the inter-process overhead
+        of cheap calls while still balancing the load when some calls are slow.
+        """
+        chunksize, extra = divmod(num_data, num_workers * 4)
+        return max(1, chunksize + bool(extra))
+
     @classmethod
-    def call_batch(cls, fn, data, max_workers=None, retry_delay=3, max_retries=3):
+    def call_batch(cls, fn, data, max_workers=None, retry_delay=3, max_retries=3, ordered=False, chunksize=None,
+                   initializer=None, initargs=(), start_method=None, on_result=None):
+        """
+        Calls `fn` on every datum in `data` in a pool of `max_workers` processes (one per core by default), retrying failures
+        like the other callers. Failed calls and calls that return None are dropped from the results.
+
+        Args:
+            ordered (bool, optional): If True, results come back in the order of `data`; otherwise, in the order they finish. Defaults to False.
+            chunksize (int, optional): Number of data sent to a worker at once. Defaults to about four chunks per worker.
+            initializer (Callable, optional): Called once in each worker with `initargs`; its return value (e.g., a loaded model)
+                can be fetched by `fn` with `get_worker_resource()`, so heavy setup is paid once per worker rather than once per datum.
+            start_method (str, optional): Multiprocessing start method ('fork', 'spawn' or 'forkserver'). Defaults to the platform's default.
+            on_result (Callable, optional): If provided, called with (datum, result) for each non-None result, instead of collecting it.
+        """
+        if not data:
+            return []
+        cls._check_picklable(fn=fn, initializer=initializer, initargs=initargs)
+        num_workers = max_workers or os.cpu_count() or 1
+        chunksize = chunksize or cls._chunksize(len(data), num_workers)
+
         results = []
-        with mp.Pool(processes=max_workers) as pool:
+        call = functools.partial(_call_with_datum, functools.partial(cls._retry_wrapper, fn, retry_delay=retry_delay, max_retries=max_retries))
+        with mp.get_context(start_method).Pool(processes=num_workers, initializer=_init_worker, initargs=(initializer, initargs)) as pool:
+            imap = pool.imap if ordered else pool.imap_unordered
             # Use tqdm to wrap the iterable
-            for res in tqdm(pool.imap_unordered(cls._retry_wrapper, [(fn, d, retry_delay, max_retries) for d in data]), 
-                            total=len(data), desc="Processing (Processes)"):
-                if res is not None:
+            for datum, res in tqdm(imap(call, data, chunksize=chunksize), total=len(data), desc="Processing (Processes)"):
+                if res is not None and on_result is not None:
+                    on_result(datum, res)
+                elif res is not None:
                     results.append(res)
-        return results
\ No newline at end of file
+        return results
+
+
+def _is_rate_limited(e: Exception) -> bool:
+    """
+    Whether `e` signals that the server is rate limiting us (HTTP 429), for the OpenAI SDK, requests/httpx and Google API errors alike.
+    Only the status code is checked; the message is not, since it can contain "429" for unrelated reasons (an ID, a path, a size, ...).
+    """
+    return 429 in (getattr(e, 'status_code', None), getattr(e, 'code', None), getattr(getattr(e, 'response', None), 'status_code', None))
+
+class AdaptiveConcurrency:
+    """
+    A semaphore whose limit adapts AIMD-style (like TCP congestion control): every call that succeeds quickly adds 1/limit to the limit
+    (i.e., +1 per "round" of calls), while a rate-limit error, or a call slower than `latency_target` seconds, halves it.
+    Other failures (timeouts, server errors, ...) leave the limit unchanged.
+    Only the first slow-down signal of a round halves the limit; calls that were already in flight when it was halved cannot halve it again.
+    """
+    def __init__(self, initial: int = 8, minimum: int = 1, maximum: int = 64, latency_target: float | None = None):
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.minimum, self.maximum, self.latency_target = minimum, maximum, latency_target
+        self.in_flight = 0
+        self._last_decrease = 0.
+        self._condition = asyncio.Condition()
+
+    async def acquire(self) -> float:
+        """
+        Waits for a free slot and returns the time at which it was taken; pass it back to `release`.
+        """
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return time.monotonic()
+
+    async def release(self, started: float, rate_limited: bool = False, succeeded: bool = True) -> None:
+        """
+        Frees the slot taken at `started`, adapting the limit to how the call went: whether the server rate-limited it, and whether it succeeded.
+        """
+        latency = time.monotonic() - started
+        async with self._condition:
+            self.in_flight -= 1
+            if rate_limited or (self.latency_target and latency > self.latency_target):
+                if started > self._last_decrease:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self._last_decrease = time.monotonic()
+            elif succeeded:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+class AsyncCaller(BatchCaller):
+    """
+    Runs an API-bound function over a dataset on an asyncio event loop, with as many calls in flight as the server tolerates
+    (see `AdaptiveConcurrency`). Unlike `FutureThreadCaller`, new calls start the moment others finish (no idle tail at batch boundaries),
+    retries back off without tying up a worker, and `batch_process_save` writes each result as soon as it completes.
+
+    `fn` may be a coroutine function or a regular (blocking) one; the latter runs on a single thread pool kept for the whole job,
+    so connection pools and other per-thread state stay warm.
+    """
+    @classmethod
+    def call_batch(cls, fn, data, max_workers=None, retry_delay=3, max_retries=3, initial_workers=None, latency_target=None, on_result=None):
+        """
+        Calls `fn` on every datum in `data` and returns the results (in order of completion); failed calls and None results are dropped.
+
+        Args:
+            max_workers (int, optional): Upper bound on concurrent calls. Defaults to 64.
+            retry_delay (float, optional): Base delay of the exponential, jittered backoff between retries. Defaults to 3.
+            initial_workers (int, optional): Concurrency to start at before adapting. Defaults to `max_workers`, so callers start
+                as concurrent as they were with a fixed pool, and only back off if the server pushes back.
+            latency_target (float, optional): Calls slower than this many seconds are treated like rate-limit errors. Defaults to None.
+            on_result (Callable, optional): If provided, called with (datum, result) as soon as each non-None result is available,
+                instead of collecting the results.
+        """
+        results = []
+        collect = on_result or (lambda datum, res: results.append(res))
+        asyncio.run(cls._run(fn, data, max_workers or 64, retry_delay, max_retries, initial_workers, latency_target, collect))
+        return results
+
+    @classmethod
+    async def _run(cls, fn, data, max_workers, retry_delay, max_retries, initial_workers, latency_target, on_result):
+        limiter = AdaptiveConcurrency(initial=initial_workers or max_workers, maximum=max_workers, latency_target=latency_target)
+        is_async = inspect.iscoroutinefunction(fn)
+        with ThreadPoolExecutor(max_workers=None if is_async else max_workers) as executor:
+            async def call(datum):
+                for attempt in range(max_retries):
+                    started = await limiter.acquire()
+                    try:
+                        if is_async:
+                            res = await fn(datum)
+                        else:
+                            res = await asyncio.get_running_loop().run_in_executor(executor, functools.partial(fn, datum))
+                    except Exception as e:
+                        await limiter.release(started, rate_limited=_is_rate_limited(e), succeeded=False)
+                        if attempt == max_retries - 1:
+                            print(f"Error: {e} on datum: {datum}.")
+                            break
+                        print(f"Error: {e} on datum: {datum}. Retrying {attempt+1}/{max_retries}...")
+                        await asyncio.sleep(retry_delay * 2 ** attempt * random.uniform(0.5, 1.5))
+                        continue
+                    await limiter.release(started)
+                    return datum, res
+                print(f"Failed after {max_retries} retries for datum: {datum}")
+                return datum, None
+
+            # keep at most `max_workers` calls scheduled at once, so huge datasets do not become huge numbers of tasks
+            pending = set()
+            progress = tqdm(total=len(data), desc="Processing (Async)")
+            for datum in data:
+                if len(pending) >= max_workers:
+                    pending = await cls._drain(pending, on_result, progress, asyncio.FIRST_COMPLETED)
+                pending.add(asyncio.create_task(call(datum)))
+            await cls._drain(pending, on_result, progress, asyncio.ALL_COMPLETED)
+            progress.close()
+
+    @staticmethod
+    async def _drain(pending, on_result, progress, return_when):
+        done, pending = await asyncio.wait(pending, return_when=return_when)
+        for task in done:
+            datum, res = task.result()
+            if res is not None:
+                on_result(datum, res)
+            progress.update(1)
+        return pending
+
+    @classmethod
+    def batch_process_save(cls, data, fn, output_file, batch_size=1000, sort_key=None, write_mode: Literal['a','w']='a', max_workers=None, **kwargs):
+        """
+        Same as `BatchCaller.batch_process_save`, but always in streaming mode: every result is saved as soon as it completes,
+        and `batch_size` only sets how often progress is reported. `sort_key` is not supported, since results are written in the order they finish.
+        """
+        if sort_key is not None:
+            raise ValueError(f'{cls.__name__} writes results as they complete, so it cannot sort them by `sort_key`.')
+        kwargs['stream'] = True
+        return super().batch_process_save(data, fn, output_file, batch_size, None, write_mode, max_workers, **kwargs)
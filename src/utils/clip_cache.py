@@ -0,0 +1,183 @@
+"""
+Read-through cache of media hosted on GCS (clips, original videos, ...), shared by every tool using the same cache directory, so that
+each object is downloaded once no matter how many scripts or eval runs use it.
+
+Entries are keyed by the object's GCS URL *and generation*, so overwriting an object on GCS invalidates its entry. Downloads go to a
+temporary file that only replaces the entry once its CRC32C matches the object's, so a crashed or interrupted download can never be
+mistaken for a cached file. Concurrent processes coordinate through file locks: only one of them downloads a given object while the
+others wait for it. Once the cache grows past its byte budget, the least recently used entries are evicted.
+"""
+from pathlib import Path
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
+import hashlib, threading, shutil, fcntl, time, os
+
+from src.utils.gcs import get_client, download_blob_sliced, parse_gcs_url, file_crc32c, DEFAULT_CHUNK_SIZE, DEFAULT_TRANSFER_WORKERS
+
+# relative to the working directory by default, which is where the scripts put their tmpdirs: files are only hard-linked into a tmpdir
+# on the same filesystem as the cache, and copied (so stored twice) anywhere else
+CLIP_CACHE_DIR = Path(os.environ.get('CLIP_CACHE_DIR', '.clip_cache'))
+CLIP_CACHE_MAX_BYTES = int(os.environ.get('CLIP_CACHE_MAX_BYTES', 20 << 30))
+
+PUBLIC_URL_PREFIX = 'https://storage.googleapis.com/'
+
+def to_gcs_url(url: str) -> str:
+    """
+    Returns the 'gs://bucket/blob' form of a GCS URL given as either 'gs://bucket/blob' or 'https://storage.googleapis.com/bucket/blob'.
+    """
+    if url.startswith('gs://'):
+        return url
+    if url.startswith(PUBLIC_URL_PREFIX):
+        return 'gs://' + url.removeprefix(PUBLIC_URL_PREFIX)
+    raise ValueError(f"Not a GCS URL: {url}")
+
+@contextmanager
+def _locked(lock_path: Path, blocking: bool = True):
+    """
+    Holds an exclusive lock on `lock_path` (created if needed), yielding whether it was acquired; it always is when `blocking`.
+    Lock files are never deleted, since deleting one while another process waits on it would let two processes hold "the" lock.
+    """
+    with open(lock_path, 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+class ClipCache:
+    def __init__(self, root: str | Path = CLIP_CACHE_DIR, max_bytes: int = CLIP_CACHE_MAX_BYTES, min_age: float = 300.):
+        """
+        Opens (creating, if needed) the clip cache at `root`; put it on the same filesystem as the `dest`s passed to `fetch`.
+        Once its entries exceed `max_bytes`, the least recently used ones are evicted, except those used in the last `min_age` seconds,
+        so that a path just handed out without a `dest` stays valid while the caller opens it. Hard-linked `dest`s outlive eviction.
+        """
+        self.root, self.max_bytes, self.min_age = Path(root), max_bytes, min_age
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._warned_copy = False
+
+    def _entry_dir(self, gcs_url: str, generation: int) -> Path:
+        digest = hashlib.sha256(f'{gcs_url}#{generation}'.encode()).hexdigest()
+        return self.root / digest[:2] / digest
+
+    def fetch(self, url: str, dest: str | Path | None = None, verify: bool = False,
+              slice_workers: int = DEFAULT_TRANSFER_WORKERS, chunk_size: int = DEFAULT_CHUNK_SIZE) -> str:
+        """
+        Returns the path of a local copy of the object at `url` ('gs://...' or 'https://storage.googleapis.com/...'), downloading it
+        into the cache first if needed; the file keeps the object's name (and so its extension). Every call costs one metadata request,
+        which is what lets the cache notice objects that were overwritten.
+
+        Entries are checksummed when downloaded and their size is checked on every hit; pass `verify` to also re-checksum them on hits.
+        If `dest` is given, the cached file is also hard-linked (or, across filesystems, copied) to `dest`, which is returned instead;
+        use this for tools that expect their inputs in a particular directory. Never modify the returned files in place.
+        Downloads use up to `slice_workers` concurrent range requests of `chunk_size` bytes (see `download_blob_sliced`).
+
+        Raises FileNotFoundError if the object does not exist, and the reason for the failure if it cannot be downloaded.
+        """
+        gcs_url = to_gcs_url(url)
+        bucket_name, blob_name = parse_gcs_url(gcs_url)
+        blob = get_client(bucket_name).bucket(bucket_name).get_blob(blob_name)
+        if blob is None:
+            raise FileNotFoundError(f"{gcs_url} does not exist")
+
+        entry_dir = self._entry_dir(gcs_url, blob.generation)
+        entry_dir.parent.mkdir(parents=True, exist_ok=True)
+        path = entry_dir / os.path.basename(blob_name)
+        downloaded = False
+        with _locked(entry_dir.with_suffix('.lock')):
+            if path.is_file() and path.stat().st_size == blob.size and (not verify or not blob.crc32c or file_crc32c(str(path)) == blob.crc32c):
+                os.utime(path)      # mark as recently used
+            else:
+                entry_dir.mkdir(exist_ok=True)
+                download_blob_sliced(bucket_name, blob_name, str(path), chunk_size=chunk_size, max_workers=slice_workers,
+                                     generation=blob.generation, raise_errors=True)
+                downloaded = True
+        if downloaded:
+            self.evict()
+
+        if dest is None:
+            return str(path)
+        return self._place(path, Path(dest))
+
+    def fetch_many(self, urls: list[str], dests: list[str | Path] | None = None, max_workers: int = 8,
+                   desc: str | None = None, slice_workers: int = DEFAULT_TRANSFER_WORKERS,
+                   chunk_size: int = DEFAULT_CHUNK_SIZE) -> tuple[dict[str, str], dict[str, str]]:
+        """
+        Fetches every URL in `urls` (see `fetch`), at most `max_workers` at a time; each large object is itself downloaded as several
+        concurrent range requests (`slice_workers` of `chunk_size` bytes) over the shared connection pool. If given, `dests[i]` is where `urls[i]` is placed. Shows a progress
+        bar labelled `desc`, if given.
+
+        Returns two dicts: the local path of every URL that was fetched, and the reason for the failure of every URL that was not.
+        """
+        for bucket_name in set(parse_gcs_url(to_gcs_url(url))[0] for url in urls if url.startswith(('gs://', PUBLIC_URL_PREFIX))):
+            get_client(bucket_name, pool_size=max_workers * slice_workers)
+
+        paths, errors = {}, {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(self.fetch, url, dests[i] if dests else None, slice_workers=slice_workers, chunk_size=chunk_size): url for i, url in enumerate(urls)}
+            for future in tqdm(as_completed(futures), total=len(futures), desc=desc, disable=desc is None):
+                try:
+                    paths[futures[future]] = future.result()
+                except Exception as e:
+                    errors[futures[future]] = f"{type(e).__name__}: {e}"
+        return paths, errors
+
+    def _place(self, path: Path, dest: Path) -> str:
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        temp_dest = dest.with_name(f'.{dest.name}.{os.getpid()}-{threading.get_ident()}.tmp')
+        try:
+            os.link(path, temp_dest)
+        except OSError:
+            if not self._warned_copy:
+                self._warned_copy = True
+                print(f"WARNING: unable to hard-link from the clip cache at {self.root} to {dest.parent}, so files are copied and stored twice; "
+                      f"set CLIP_CACHE_DIR to a directory on the same filesystem as {dest.parent}.")
+            shutil.copyfile(path, temp_dest)
+        os.replace(temp_dest, dest)
+        return str(dest)
+
+    def _entries(self) -> list[tuple[float, int, Path]]:
+        """
+        Returns the (last use, size, directory) of every entry.
+        """
+        entries = []
+        for entry_dir in self.root.glob('??/*'):
+            if not entry_dir.is_dir():
+                continue
+            files = [f.stat() for f in entry_dir.iterdir() if f.is_file()]
+            if files:
+                entries.append((max(s.st_mtime for s in files), sum(s.st_size for s in files), entry_dir))
+        return entries
+
+    def size(self) -> int:
+        """
+        Returns the total size in bytes of the cached files.
+        """
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self) -> None:
+        """
+        Evicts the least recently used entries until the cache fits its budget. Entries in use by another process are skipped, and
+        if another process is already evicting, this returns immediately.
+        """
+        with _locked(self.root / '.evict.lock', blocking=False) as acquired:
+            if not acquired:
+                return
+            entries = sorted(self._entries())
+            excess = sum(size for _, size, _ in entries) - self.max_bytes
+            for last_used, size, entry_dir in entries:
+                if excess <= 0 or last_used > time.time() - self.min_age:
+                    break
+                with _locked(entry_dir.with_suffix('.lock'), blocking=False) as acquired:
+                    if acquired:
+                        shutil.rmtree(entry_dir, ignore_errors=True)
+                        excess -= size
+
+    def clear(self) -> None:
+        for _, _, entry_dir in self._entries():
+            with _locked(entry_dir.with_suffix('.lock')):
+                shutil.rmtree(entry_dir, ignore_errors=True)
@@ -0,0 +1,237 @@
+"""
+Utilities for cutting clips out of longer videos with FFmpeg.
+
+Only depends on the standard library (and the `ffmpeg`/`ffprobe` binaries) so that the data preparation scripts in `prep/` can use it
+on nodes that do not have the model dependencies installed.
+"""
+from pathlib import Path
+from subprocess import CompletedProcess
+import subprocess, tempfile, bisect
+
+from src.utils import media_probe
+
+# encoders used to re-encode the partial GOPs at the head and tail of a keyframe-aware cut; they must produce the same codec as the source,
+# with parameter sets that can be repeated in-band (see `_reencode_args`), so other codecs are always cut in 'accurate' mode
+REENCODERS = {'h264': 'libx264', 'hevc': 'libx265'}
+AUDIO_ENCODERS = {'.mp4': 'aac', '.mkv': 'aac'}
+# MP4 sample entries that allow parameter sets to change in-band, as they do at the joins of a keyframe-aware cut
+IN_BAND_TAGS = {'h264': 'avc3', 'hevc': 'hev1'}
+# FFprobe profile names, mapped to the names the encoders accept
+X264_PROFILES = {'Constrained Baseline': 'baseline', 'Baseline': 'baseline', 'Main': 'main', 'High': 'high', 'High 10': 'high10',
+                 'High 4:2:2': 'high422', 'High 4:4:4 Predictive': 'high444'}
+X265_PROFILES = {'Main': 'main', 'Main 10': 'main10'}
+# how far past a keyframe a stream-copy seek aims, so that rounding cannot land it on the previous keyframe
+KEYFRAME_EPSILON = 1e-3
+
+# a keyframe-aware cut only pays off if at least this many seconds of the clip can be stream-copied
+MIN_COPY_DURATION = 1.0
+
+CUT_MODES = ('accurate', 'keyframe')
+
+def _run_ffmpeg(cmd: list[str], description: str) -> CompletedProcess:
+    """
+    Runs an FFmpeg/FFprobe command. Prints `description` along with FFmpeg's stderr and raises a `CalledProcessError` if it fails.
+    """
+    result: CompletedProcess = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode:
+        print(f'Encountered the following error while trying to {description}: {result.stderr}')
+        result.check_returncode()
+    return result
+
+def cut_clip(video_path: str | Path, clip_path: str | Path, start: float | int, stop: float | int, mode: str = 'accurate', overwrite: bool = False) -> None:
+    """
+    Cuts the segment from `start` to `stop` seconds of the video at `video_path` and saves it at `clip_path`.
+
+    Two modes are supported:
+        - 'accurate' decodes and re-encodes the whole clip (the slowest, but simplest, option).
+        - 'keyframe' stream-copies the GOP-aligned middle of the clip and re-encodes only the partial GOPs at its head and tail,
+          which keeps the cut frame-accurate at a fraction of the CPU cost. Only H.264 and HEVC sources in MP4/MKV clips qualify.
+          The joined clip is decoded once to verify it, and the cut falls back to 'accurate' whenever the clip does not span
+          enough keyframes, the source cannot be re-encoded to match, or verification fails.
+
+    Raises a `FileExistsError` if a file already exists at `clip_path` and `overwrite` is set to False (default),
+    and a `subprocess.CalledProcessError` if FFmpeg fails.
+    """
+    if mode not in CUT_MODES:
+        raise ValueError(f'`mode` must be one of {CUT_MODES}.')
+    if stop <= start:
+        raise ValueError('Stop time must come after the start time.')
+    video_path, clip_path = str(video_path), str(clip_path)
+    if Path(clip_path).exists() and not overwrite:
+        raise FileExistsError(f'Attempted to save a clip at the following location, but a file already exists there: {clip_path}')
+
+    if mode == 'keyframe' and _cut_clip_keyframe(video_path, clip_path, start, stop):
+        return
+
+    # note: far more efficient ffmpeg commands for cutting videos exist, but they are far less accurate; see the 'keyframe' mode
+    cmd = ['ffmpeg', '-v', 'error', '-i', video_path, '-ss', str(start), '-to', str(stop), '-y', clip_path]
+    _run_ffmpeg(cmd, f'clip segment from {start} seconds to {stop} seconds of video at {video_path}')
+
+def _reencode_args(codec_name: str, stream: dict) -> list[str]:
+    """
+    Encoder arguments that make re-encoded partial GOPs decodable as part of the same stream as the stream-copied middle: the source's
+    pixel format, profile and level, with the parameter sets repeated in-band since they cannot match the source's byte for byte.
+    """
+    args = ['-c:v', REENCODERS[codec_name], '-pix_fmt', stream.get('pix_fmt', 'yuv420p')]
+    profile, level = stream.get('profile', ''), int(stream.get('level', -99))
+    if codec_name == 'h264':
+        if profile in X264_PROFILES:
+            args += ['-profile:v', X264_PROFILES[profile]]
+        if level > 0:
+            args += ['-level:v', f'{level / 10:g}']
+        args += ['-bsf:v', 'dump_extra=freq=keyframe']
+    else:
+        if profile in X265_PROFILES:
+            args += ['-profile:v', X265_PROFILES[profile]]
+        x265_params = 'repeat-headers=1' + (f':level-idc={level / 30:g}' if level > 0 else '')
+        args += ['-x265-params', x265_params]
+    return args
+
+def _verify_clip(clip_path: str, duration: float, tolerance: float) -> bool:
+    """
+    Returns whether the clip at `clip_path` lasts `duration` seconds (give or take `tolerance`) and its video decodes without errors.
+    """
+    result = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', clip_path], capture_output=True, text=True)
+    try:
+        if result.returncode or abs(float(result.stdout.strip()) - duration) > tolerance:
+            return False
+    except ValueError:
+        return False
+    result = subprocess.run(['ffmpeg', '-v', 'error', '-i', clip_path, '-map', '0:v:0', '-f', 'null', '-'], capture_output=True, text=True)
+    return not result.returncode and not result.stderr.strip()
+
+def _cut_clip_keyframe(video_path: str, clip_path: str, start: float | int, stop: float | int) -> bool:
+    """
+    Keyframe-aware cut used by `cut_clip`. Returns False, without writing anything, if the clip should instead be cut in 'accurate' mode:
+    because it does not span enough keyframes, because the source cannot be re-encoded to match, or because the joined clip failed to
+    verify (e.g., open GOPs whose leading frames reference the previous GOP).
+
+    The video is cut in three parts (re-encoded head, stream-copied middle, re-encoded tail) that are joined without re-encoding,
+    while the audio is re-encoded in one piece and muxed in at the end, so there are no encoder priming gaps at the joins.
+    """
+    codec_name, stream = media_probe.get_codec_name(video_path), media_probe.get_stream(video_path, 'video')
+    suffix = Path(clip_path).suffix.lower()
+    if codec_name not in REENCODERS or suffix not in AUDIO_ENCODERS:
+        return False
+
+    # find the GOP-aligned middle of the clip: from the first keyframe at/after `start` to the last keyframe at/before `stop`
+    keyframes = media_probe.get_keyframes(video_path)
+    first_idx = bisect.bisect_left(keyframes, start)
+    last_idx = bisect.bisect_right(keyframes, stop) - 1
+    if first_idx >= len(keyframes) or last_idx < first_idx:
+        return False
+    copy_start, copy_stop = keyframes[first_idx], keyframes[last_idx]
+    if copy_stop - copy_start < MIN_COPY_DURATION:
+        return False
+
+    # every video part keeps the source's timebase, so their timestamps line up when joined
+    timescale = stream.get('time_base', '1/0').split('/')[-1]
+    mux = ['-video_track_timescale', timescale] if suffix == '.mp4' and timescale.isdigit() and int(timescale) else []
+    reencode = _reencode_args(codec_name, stream)
+    # stream-copying from an input seek starts at the last keyframe at/before the seek point, so seek just past the keyframe we want
+    # and stop just short of the next one; keyframe timestamps are rounded to the microsecond by FFprobe
+    copy = ['-c:v', 'copy', '-bsf:v', 'dump_extra=freq=keyframe']
+    try:
+        with tempfile.TemporaryDirectory(prefix='cut_', dir=Path(clip_path).parent) as tmp_dir:
+            parts = []
+            # (seek point, duration, codec arguments)
+            for part_start, part_duration, codecs in [(start, copy_start - start, reencode),
+                                                      (copy_start + KEYFRAME_EPSILON, copy_stop - copy_start - 2 * KEYFRAME_EPSILON, copy),
+                                                      (copy_stop, stop - copy_stop, reencode)]:
+                if part_duration <= 1e-3:
+                    continue
+                part_path = str(Path(tmp_dir) / f'part_{len(parts)}{suffix}')
+                cmd = ['ffmpeg', '-v', 'error', '-ss', str(part_start), '-i', video_path, '-t', str(part_duration), '-map', '0:v:0', '-an',
+                       *codecs, *mux, '-avoid_negative_ts', 'make_zero', '-y', part_path]
+                _run_ffmpeg(cmd, f'clip video segment from {part_start} seconds to {part_start + part_duration} seconds of video at {video_path}')
+                parts.append(part_path)
+
+            # the audio, re-encoded in one piece
+            inputs, maps = [], ['-map', '0:v:0']
+            if media_probe.get_stream(video_path, 'audio'):
+                audio_path = str(Path(tmp_dir) / f'audio{suffix}')
+                cmd = ['ffmpeg', '-v', 'error', '-i', video_path, '-ss', str(start), '-to', str(stop), '-map', '0:a:0', '-vn',
+                       '-c:a', AUDIO_ENCODERS[suffix], '-y', audio_path]
+                _run_ffmpeg(cmd, f'clip audio segment from {start} seconds to {stop} seconds of video at {video_path}')
+                inputs, maps = ['-i', audio_path], maps + ['-map', '1:a:0']
+
+            # join the video parts and mux in the audio without re-encoding; the sample entry must allow in-band parameter sets
+            concat_list = Path(tmp_dir) / 'parts.txt'
+            concat_list.write_text(''.join(f"file '{p}'\n" for p in parts))
+            tag = ['-tag:v', IN_BAND_TAGS[codec_name]] if suffix == '.mp4' else []
+            joined_path = str(Path(tmp_dir) / f'joined{suffix}')
+            cmd = ['ffmpeg', '-v', 'error', '-f', 'concat', '-safe', '0', '-i', str(concat_list), *inputs, *maps, '-c', 'copy', *tag, '-y', joined_path]
+            _run_ffmpeg(cmd, f'join the parts of the clip from {start} seconds to {stop} seconds of video at {video_path}')
+
+            fps = media_probe.get_fps(video_path)
+            if not _verify_clip(joined_path, stop - start, max(0.1, 2 / fps) if fps else 0.1):
+                print(f'Keyframe-aware cut of the segment from {start} seconds to {stop} seconds of video at {video_path} failed to verify; re-encoding it instead.')
+                return False
+            Path(joined_path).replace(clip_path)
+    except subprocess.CalledProcessError:
+        return False
+    return True
+
+def cut_clips(video_path: str | Path, cuts: list[tuple[float | int, float | int, str | Path]], mode: str = 'accurate',
+              overwrite: bool = False, max_outputs_per_pass: int = 16) -> dict[str, str | None]:
+    """
+    Cuts many clips out of the same video at `video_path`. Each entry of `cuts` is a (start, stop, clip_path) triple, with times in seconds.
+
+    In 'accurate' mode, the source is opened, demuxed and decoded once for up to `max_outputs_per_pass` clips at a time:
+    a single FFmpeg invocation seeks to the earliest start time and writes every clip as its own output.
+    In 'keyframe' mode, clips are cut one at a time by `cut_clip`, since stream-copying does not decode the source anyway.
+
+    Returns a map from each clip path (as a string) to None if that clip was saved successfully, or to an error message if it was not.
+    Errors never propagate; if a single-pass invocation fails, its clips are retried one by one so that failures can be attributed to individual clips.
+    """
+    if mode not in CUT_MODES:
+        raise ValueError(f'`mode` must be one of {CUT_MODES}.')
+    video_path = str(video_path)
+    results: dict[str, str | None] = {}
+
+    # validate every cut up front so that one bad cut does not sink the others in its pass
+    pending: list[tuple[float | int, float | int, str]] = []
+    for start, stop, clip_path in cuts:
+        clip_path = str(clip_path)
+        if stop <= start:
+            results[clip_path] = 'Stop time must come after the start time.'
+        elif Path(clip_path).exists() and not overwrite:
+            results[clip_path] = f'Attempted to save a clip at the following location, but a file already exists there: {clip_path}'
+        else:
+            pending.append((start, stop, clip_path))
+
+    if mode == 'keyframe':
+        for start, stop, clip_path in pending:
+            results[clip_path] = _cut_clip_or_error(video_path, clip_path, start, stop, mode)
+        return results
+
+    pending.sort()
+    for idx in range(0, len(pending), max_outputs_per_pass):
+        group = pending[idx : idx + max_outputs_per_pass]
+
+        # seek the input once to the earliest start; every output's times are then relative to that point
+        offset = group[0][0]
+        cmd = ['ffmpeg', '-v', 'error', '-ss', str(offset), '-i', video_path]
+        for start, stop, clip_path in group:
+            cmd += ['-ss', str(start - offset), '-to', str(stop - offset), '-y', clip_path]
+        result: CompletedProcess = subprocess.run(cmd, capture_output=True, text=True)
+
+        for start, stop, clip_path in group:
+            written = Path(clip_path).is_file() and Path(clip_path).stat().st_size > 0
+            if not result.returncode and written:
+                results[clip_path] = None
+            else:
+                # attribute the failure: retry this clip on its own
+                results[clip_path] = _cut_clip_or_error(video_path, clip_path, start, stop, 'accurate')
+
+    return results
+
+def _cut_clip_or_error(video_path: str, clip_path: str, start: float | int, stop: float | int, mode: str) -> str | None:
+    """
+    Calls `cut_clip`, returning None on success and an error message instead of raising on failure.
+    """
+    try:
+        cut_clip(video_path, clip_path, start, stop, mode=mode, overwrite=True)
+        return None
+    except subprocess.CalledProcessError as e:
+        return f'FFmpeg failed to cut the segment from {start} seconds to {stop} seconds of video at {video_path}: {e.stderr}'
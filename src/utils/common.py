@@ -1,17 +1,23 @@
 from pathlib import Path
-from subprocess import CompletedProcess
-import subprocess, re, json, cv2
+import subprocess, tempfile, re, json, cv2
+import numpy as np
 
 from src.globals import ORIGINALS_DIR, CLIPS_DIR
+from src.utils.clipping import cut_clips
+from src.utils import media_probe
 
-def cut_video(video_name: str, cuts: list[tuple[float|int, float|int]], overwrite=False) -> None:
+def cut_video(video_name: str, cuts: list[tuple[float|int, float|int]], overwrite=False, mode: str = 'accurate') -> None:
     """
     Given a video located at `data/originals/{video_name}.mp4`, creates clips of video as specified by `cuts` and
     saves them in `data/clips/{video_name}_clip_i.mp4` where i is the index of the clip's start/stop time pair in `cuts` (1-indexed).
 
     Start and stop times should be provided in seconds.
+
+    `mode` is passed on to `src.utils.clipping.cut_clips`: 'accurate' (default) re-encodes every clip in full, decoding the source
+    only once for all of them, while 'keyframe' stream-copies the GOP-aligned middle of each clip and only re-encodes its head and tail.
     
-    Raises a `FileExistsError` if a file already exists where an output clip is to be saved and `overwrite` is set to False (default).
+    Raises a `FileExistsError` if a file already exists where an output clip is to be saved and `overwrite` is set to False (default),
+    and a `RuntimeError` listing every clip that FFmpeg failed to save.
     """
     # Determine video path and its validity
     video_path: Path = ORIGINALS_DIR / f'{video_name}.mp4'
@@ -19,35 +25,103 @@ def cut_video(video_name: str, cuts: list[tuple[float|int, float|int]], overwrit
         raise FileNotFoundError(f'Instructed to create cuts of MP4 video at following location, but no such video exists: {str(video_path)}')
     
     # Get length of video
-    # https://trac.ffmpeg.org/wiki/FFprobeTips#Formatcontainerduration
-    ffmpeg_length_command = ['ffprobe', '-v', 'quiet', '-show_entries', 'format=duration', '-print_format', 'default=noprint_wrappers=1:nokey=1', str(video_path)]
-    length_result: CompletedProcess = subprocess.run(ffmpeg_length_command, capture_output=True, text=True)
-    if length_result.returncode:
-        print(f"Encountered the following error while trying to get length of video at {video_path} using FFprobe: {length_result.stderr}")
-        length_result.check_returncode()
-    video_duration = float(length_result.stdout)
-
-    # For each desired clip...
+    video_duration = media_probe.get_duration(video_path)
+
+    # Validate each desired clip and find where to save it to
+    clip_cuts = []
     for i in range(len(cuts)):
-        # Find where to save the clip to
         clip_path = CLIPS_DIR / f'{video_name}_clip_{i+1}.mp4'
         if clip_path.exists() and not overwrite:
             raise FileExistsError(f'Attempted to save a clip at the following location, but a file already exists there: {str(clip_path)}')
 
-        # Validate start and stop times
         start, stop = cuts[i]
         if stop <= start:
             raise ValueError('Stop time must come after the start time.')
         if stop > video_duration:
             raise ValueError('Stop time must come before the end of the video.')
-        
-        # Extract clip
-        ffmpeg_clip_extraction_commad = ['ffmpeg',  '-i', str(video_path), '-ss', str(start), '-to', str(stop), str(clip_path)] # note: far more efficient ffmpeg commands for cutting videos exist, but they are far less accurate
-        if overwrite: ffmpeg_clip_extraction_commad.insert(-1, '-y')
-        clip_extraction_result: CompletedProcess = subprocess.run(ffmpeg_clip_extraction_commad, capture_output=True, text=True)
-        if clip_extraction_result.returncode:
-            print(f'Encountered an error while trying to clip segment from {start} seconds to {stop} seconds of video at {video_path}')
-            clip_extraction_result.check_returncode()
+        clip_cuts.append((start, stop, clip_path))
+
+    # Extract all clips, decoding the source video as few times as possible
+    results = cut_clips(video_path, clip_cuts, mode=mode, overwrite=overwrite)
+    errors = [err for err in results.values() if err]
+    if errors:
+        raise RuntimeError(f'Failed to extract {len(errors)} of {len(cuts)} clips from {video_path}:\n' + '\n'.join(errors))
+
+def get_video_resolution(video_path: str | Path) -> tuple[int, int]:
+    """
+    Returns the (width, height) of the first video stream of the video at `video_path`, as reported by FFprobe (and cached by `media_probe`).
+    """
+    return media_probe.get_resolution(video_path)
+
+def decode_video_frames(video_path: str | Path, fps: float, size: tuple[int, int] | None = None) -> np.ndarray:
+    """
+    Decodes the entire video at `video_path` exactly once, sampling it at `fps` frames per second,
+    and returns its frames as a uint8 array of shape (T, H, W, C) in RGB order.
+
+    If `size` is provided as (width, height), frames are resized to it during decoding; otherwise, the native resolution is kept.
+    Frame `k` of the returned array corresponds to timestamp `k / fps` seconds; see `slice_frames`.
+    """
+    video_path = Path(video_path)
+    if not video_path.exists():
+        raise FileNotFoundError(f'Instructed to decode video at following location, but no such video exists: {str(video_path)}')
+    width, height = size if size else get_video_resolution(video_path)
+
+    filters = f'fps={fps}' + (f',scale={width}:{height}' if size else '')
+    ffmpeg_decode_command = ['ffmpeg', '-v', 'error', '-i', str(video_path), '-vf', filters, '-f', 'rawvideo', '-pix_fmt', 'rgb24', 'pipe:1']
+
+    # decode straight into a (writable) buffer sized from the duration, growing it if that was short, so the frames are never copied
+    frame_bytes = width * height * 3
+    try:
+        expected_frames = int(media_probe.get_duration(video_path) * fps) + 2
+    except (KeyError, ValueError):
+        expected_frames = 64
+    buffer, filled = bytearray(expected_frames * frame_bytes), 0
+    with tempfile.TemporaryFile() as stderr, subprocess.Popen(ffmpeg_decode_command, stdout=subprocess.PIPE, stderr=stderr) as process:
+        while True:
+            if filled == len(buffer):
+                buffer.extend(bytes(max(len(buffer) // 4, 64 * frame_bytes)))
+            with memoryview(buffer) as view:
+                read = process.stdout.readinto(view[filled:])
+            if not read:
+                break
+            filled += read
+        if process.wait():
+            stderr.seek(0)
+            message = stderr.read().decode(errors='replace')
+            print(f"Encountered the following error while trying to decode video at {video_path} using FFmpeg: {message}")
+            raise subprocess.CalledProcessError(process.returncode, ffmpeg_decode_command, stderr=message)
+
+    return np.frombuffer(buffer, dtype=np.uint8, count=filled - filled % frame_bytes).reshape(-1, height, width, 3)
+
+def slice_frames(frames, fps: float, start: float | int, stop: float | int, frame_factor: int = 2):
+    """
+    Given frames decoded at `fps` (as a NumPy array or torch tensor with time as the first axis), returns a view (not a copy) of the frames between `start` and `stop` seconds.
+
+    The number of returned frames is rounded down to a multiple of `frame_factor` (but never below `frame_factor`),
+    since Qwen2.5-VL groups consecutive frames into temporal patches of that size.
+    """
+    if stop <= start:
+        raise ValueError('Stop time must come after the start time.')
+    first = min(int(round(start * fps)), frames.shape[0] - 1)
+    last = min(int(round(stop * fps)), frames.shape[0])
+    count = max(frame_factor, (last - first) // frame_factor * frame_factor)
+    first = max(0, min(first, frames.shape[0] - count))
+    return frames[first : first + count]
+
+def subsample_frames(frames, src_fps: float, fps: float, frame_factor: int = 2):
+    """
+    Given frames decoded at `src_fps` (as a NumPy array or torch tensor with time as the first axis), returns the frames that
+    decoding at a lower `fps` would have produced: every (`src_fps` / `fps`)-th frame. Integer ratios return a strided view (not a copy).
+
+    As in `slice_frames`, the number of returned frames is rounded down to a multiple of `frame_factor` (but never below `frame_factor`).
+    """
+    if fps > src_fps:
+        raise ValueError('Cannot subsample frames to a higher fps than they were decoded at.')
+    ratio = src_fps / fps
+    count = max(frame_factor, int(frames.shape[0] / ratio) // frame_factor * frame_factor)
+    if ratio.is_integer() and (count - 1) * int(ratio) < frames.shape[0]:
+        return frames[::int(ratio)][:count]
+    return frames[[min(int(i * ratio), frames.shape[0] - 1) for i in range(count)]]
 
 def parse_segments(text: str) -> list[tuple[int, int]]:
     """
@@ -1,14 +1,30 @@
 import os
-from typing import List, Tuple
+import io
+from typing import Iterable, List, Tuple
 from google.cloud import storage
-from concurrent.futures import ThreadPoolExecutor
+from google.cloud.exceptions import NotFound
+from concurrent.futures import ThreadPoolExecutor, as_completed, Future
 import time
 import json
 from pathlib import Path
 from loguru import logger
 from tqdm import tqdm
 from google.oauth2 import service_account
+from google.auth.transport.requests import AuthorizedSession
+import google.auth
+import requests
+import threading
 import math
+import base64
+import mimetypes
+import uuid
+import random
+import queue
+import shutil
+import hashlib
+import google_crc32c
+
+from src.globals import CACHE_DIR
 
 
 BUCKET_NAME_TO_SERVICE_ACCOUNT_CREDENTIALS_PATH = {
@@ -16,12 +32,55 @@ BUCKET_NAME_TO_SERVICE_ACCOUNT_CREDENTIALS_PATH = {
     "action_atlas": os.getenv("GOOGLE_APPLICATION_CREDENTIALS_ACTION_ATLAS"),
 }
 
+# default size of the HTTP connection pool of each client; raised automatically when a caller asks for more workers
+DEFAULT_POOL_SIZE = 16
+
+# process-wide storage clients, keyed by the credentials file used to authenticate them (None for application default credentials)
+_CLIENTS: dict[str | None, tuple[storage.Client, int]] = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def _reset_clients():
+    # a forked child must not reuse the parent's connections (or a lock some parent thread held while forking)
+    global _CLIENTS_LOCK
+    _CLIENTS.clear()
+    _CLIENTS_LOCK = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_clients)
+
+
+def get_client(bucket_name: str | None = None, pool_size: int = DEFAULT_POOL_SIZE) -> storage.Client:
+    """
+    Returns the process-wide storage client for `bucket_name`, authenticated with the service account listed for it in
+    `BUCKET_NAME_TO_SERVICE_ACCOUNT_CREDENTIALS_PATH` (or application default credentials for other buckets).
+
+    Credentials are read and the HTTP session is set up once per process instead of once per call, and the session keeps
+    up to `pool_size` connections alive, so pass the number of threads that will share the client. Clients are safe to share across threads.
+    """
+    credentials_path = BUCKET_NAME_TO_SERVICE_ACCOUNT_CREDENTIALS_PATH.get(bucket_name)
+    with _CLIENTS_LOCK:
+        if credentials_path in _CLIENTS and _CLIENTS[credentials_path][1] >= pool_size:
+            return _CLIENTS[credentials_path][0]
+
+        if credentials_path:
+            credentials = service_account.Credentials.from_service_account_file(credentials_path, scopes=storage.Client.SCOPE)
+            project = credentials.project_id
+        else:
+            credentials, project = google.auth.default(scopes=storage.Client.SCOPE)
+        session = AuthorizedSession(credentials)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        client = storage.Client(project=project, credentials=credentials, _http=session)
+        _CLIENTS[credentials_path] = (client, pool_size)
+        return client
+
+
 def get_file_extension(url: str) -> str:
     return os.path.splitext(url)[1]
 
 def create_bucket(bucket_name, storage_class="STANDARD", location="US"):
     """Creates a new bucket."""
-    storage_client = storage.Client()
+    storage_client = get_client(bucket_name)
 
     bucket = storage_client.bucket(bucket_name)
     bucket.storage_class = storage_class
@@ -32,48 +91,174 @@ def create_bucket(bucket_name, storage_class="STANDARD", location="US"):
 
 def list_blobs(bucket_name):
     """Lists all the blobs in the bucket."""
-    storage_client = storage.Client()
+    storage_client = get_client(bucket_name)
     bucket = storage_client.bucket(bucket_name)
     blobs = bucket.list_blobs()
      
     return blobs
 
 
-def list_blobs_by_prefix(bucket_name, prefix, delimiter=None):
-    """Lists all the blobs in the bucket under a specified directory (prefix)."""
-    credentials_path = BUCKET_NAME_TO_SERVICE_ACCOUNT_CREDENTIALS_PATH.get(bucket_name)
-    if not credentials_path:
-        logger.error(f"No credentials path found for bucket {bucket_name}.")
-        return []
+# listings can be cached on disk; this is the lifetime (in seconds) that callers opting in with `ttl=LISTING_CACHE_TTL` get; see `iter_blobs`
+LISTING_CACHE_DIR = CACHE_DIR / 'gcs_listings'
+LISTING_CACHE_TTL = float(os.environ.get('GCS_LISTING_TTL', 600))
+DEFAULT_LISTING_WORKERS = 16
+# first characters (after the prefix) at which large listings are split into key ranges that are paged through in parallel
+_LISTING_SPLIT_POINTS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+_LISTING_DONE = object()
 
-    credentials = service_account.Credentials.from_service_account_file(credentials_path)
-    storage_client = storage.Client(credentials=credentials)
-    bucket = storage_client.bucket(bucket_name)
+
+def _listing_cache_path(bucket_name: str, prefix: str, delimiter: str | None) -> Path:
+    key = hashlib.sha256(json.dumps([prefix, delimiter]).encode()).hexdigest()
+    return LISTING_CACHE_DIR / bucket_name / f"{key}.jsonl"
+
+
+def invalidate_listing_cache(bucket_name: str):
+    """Forgets every cached listing of `bucket_name`. The upload and delete helpers in this module call it for you."""
+    shutil.rmtree(LISTING_CACHE_DIR / bucket_name, ignore_errors=True)
+
+
+def _list_pages(bucket_name: str, prefix: str, delimiter: str | None, max_workers: int):
+    """
+    Yields the listing of `prefix` one page at a time, as (blob resources, prefixes) pairs. The first page is fetched directly, so small
+    listings cost a single request; if there are more, the rest of the key space is split into ranges (by the character following `prefix`)
+    that are paged through by up to `max_workers` threads, and pages are yielded in whatever order they arrive. Every sub-prefix falls
+    within a single range, so a prefix is only ever reported by one range (or by both the first page and the range that resumes after it).
+    """
+    storage_client = get_client(bucket_name, pool_size=max_workers)
+    iterator = storage_client.list_blobs(bucket_name, prefix=prefix or None, delimiter=delimiter)
+    page = next(iterator.pages, None)
+    if page is None:
+        return
+    resources = [blob._properties for blob in page]
+    prefixes = list(page.prefixes)
+    yield resources, prefixes
+    if iterator.next_page_token is None:
+        return
+
+    # resume after the last key of the first page
+    last = max([resource['name'] for resource in resources] + prefixes)
+    bounds = [None] + [prefix + c for c in _LISTING_SPLIT_POINTS] + [None]
+    ranges = [(max(start, last) if start else last, end) for start, end in zip(bounds[:-1], bounds[1:]) if end is None or end > last]
+
+    results = queue.Queue(maxsize=2 * max_workers)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def list_range(start_offset, end_offset):
+        try:
+            range_iterator = storage_client.list_blobs(bucket_name, prefix=prefix or None, delimiter=delimiter,
+                                                       start_offset=start_offset, end_offset=end_offset)
+            for range_page in range_iterator.pages:
+                if stop.is_set():
+                    return
+                put(([blob._properties for blob in range_page if blob.name != last], list(range_page.prefixes)))
+        except Exception as e:
+            put(e)
+        finally:
+            put(_LISTING_DONE)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(ranges)))) as executor:
+        for start_offset, end_offset in ranges:
+            executor.submit(list_range, start_offset, end_offset)
+        try:
+            remaining = len(ranges)
+            while remaining:
+                item = results.get()
+                if item is _LISTING_DONE:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            # also reached when the consumer stops early, so the listing threads stop after their current page
+            stop.set()
+
+
+def _list_pages_cached(bucket_name: str, prefix: str, delimiter: str | None, max_workers: int, ttl: float):
+    """
+    `_list_pages`, served from the on-disk listing cache if it was listed less than `ttl` seconds ago. Pages are still yielded as they
+    arrive; the listing is only cached once it completes.
+    """
+    cache_path = _listing_cache_path(bucket_name, prefix, delimiter)
+    if ttl > 0 and cache_path.is_file() and time.time() - cache_path.stat().st_mtime < ttl:
+        with open(cache_path, 'r') as f:
+            for line in f:
+                yield tuple(json.loads(line))
+        return
+    if ttl <= 0:
+        yield from _list_pages(bucket_name, prefix, delimiter, max_workers)
+        return
+
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+    try:
+        with open(temp_path, 'w') as f:
+            for page in _list_pages(bucket_name, prefix, delimiter, max_workers):
+                f.write(json.dumps(page) + '\n')
+                yield page
+        os.replace(temp_path, cache_path)
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
+
+
+def iter_blobs(
+    bucket_name: str,
+    prefix: str = '',
+    delimiter: str | None = None,
+    max_workers: int = DEFAULT_LISTING_WORKERS,
+    ttl: float = 0,
+    ):
+    """
+    Yields every blob under `prefix` (only those directly under it if `delimiter` is '/') as soon as its page of the listing arrives,
+    so callers can start working on the first blobs while the rest are still being listed. Large listings are paged through in
+    parallel by up to `max_workers` threads, so blobs come in no particular order.
+
+    By default, every call lists the bucket afresh. Callers that can tolerate a stale listing may pass `ttl` (e.g., `LISTING_CACHE_TTL`,
+    which is `GCS_LISTING_TTL` or 10 minutes) to reuse a listing cached on disk by any process in the last `ttl` seconds, so tools run one
+    after another do not re-list the same prefix. Only uploads and deletes made by the calling process invalidate the cache, so blobs
+    written by other processes or machines within that window are missed.
+    """
+    bucket = get_client(bucket_name).bucket(bucket_name)
+    for resources, _ in _list_pages_cached(bucket_name, prefix, delimiter, max_workers, ttl):
+        for resource in resources:
+            # the same way the client library turns listed resources into blobs
+            blob = bucket.blob(resource['name'])
+            blob._set_properties(resource)
+            yield blob
+
+
+def list_blobs_by_prefix(bucket_name, prefix, delimiter=None, ttl: float = 0):
+    """Lists all the blobs in the bucket under a specified directory (prefix), as a generator; see `iter_blobs`."""
     # Note: The delimiter argument ensures that only blobs in the 'directory' are listed
-    blobs = bucket.list_blobs(prefix=prefix, delimiter=delimiter)
-    return blobs
+    return iter_blobs(bucket_name, prefix, delimiter=delimiter, ttl=ttl)
 
 
-def list_directories(bucket_name, prefix='', delimiter='/'):
+def list_directories(bucket_name, prefix='', delimiter='/', ttl: float = 0):
     """
     Lists unique 'directories' in a given bucket.
     Note that directories do not have a meaning in cloud storage context
     and they are just part of the prefix of a blob path. However, still 
     in some use cases it's helpful to have a list of immediate directories
-    within a blob path prefix.
+    within a blob path prefix. Large listings are paged through in parallel, and can opt in to caching, like `iter_blobs`.
     """
-    storage_client = storage.Client()
-    iterator = storage_client.list_blobs(bucket_name, prefix=prefix, delimiter=delimiter)
     prefixes = set()
 
-    for page in iterator.pages:
-        prefixes.update(page.prefixes)
+    for _, page_prefixes in _list_pages_cached(bucket_name, prefix, delimiter, DEFAULT_LISTING_WORKERS, ttl):
+        prefixes.update(page_prefixes)
 
     prefixes = [p.split(delimiter)[-2] for p in prefixes]
     
     return prefixes
 
-
 def download_blob(
     bucket_name,
     source_blob_name,
@@ -84,16 +269,9 @@ def download_blob(
     # handle_exception=False,
     ):
     """Downloads a blob from the bucket."""
-    credentials_path = BUCKET_NAME_TO_SERVICE_ACCOUNT_CREDENTIALS_PATH.get(bucket_name)
-    if not credentials_path:
-        logger.error(f"No credentials path found for bucket {bucket_name}.")
-        return -1
-
+    storage_client = get_client(bucket_name)
     for retry in range(max_retries):
         try:
-            credentials = service_account.Credentials.from_service_account_file(credentials_path)
-            storage_client = storage.Client(credentials=credentials)
-            # storage_client = storage.Client()
             bucket = storage_client.bucket(bucket_name)
             blob = bucket.blob(source_blob_name)
             if check_existence:
@@ -111,6 +289,190 @@ def download_blob(
     return -1
 
 
+# blobs larger than this are transferred in slices of this many bytes, several at a time
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+DEFAULT_TRANSFER_WORKERS = 8
+# sliced downloads stream each slice to disk through a buffer of this size, so a download holds about
+# `max_workers * STREAM_BUFFER_SIZE` bytes in memory however large `chunk_size` is
+STREAM_BUFFER_SIZE = 1024 * 1024
+# maximum number of source objects that a single GCS compose request accepts
+MAX_COMPOSE_SOURCES = 32
+
+
+def _retry_delay(retry: int, base: float = 1.) -> float:
+    """
+    Returns how long to sleep before retry number `retry` (0-based): exponential backoff, capped at a minute and jittered by +/-50%
+    so that the many threads of a bulk transfer that fail together do not all retry in lockstep.
+    """
+    return min(base * 2 ** retry, 60.) * random.uniform(0.5, 1.5)
+
+
+def file_crc32c(path: str) -> str:
+    """Returns the CRC32C of a local file, base64-encoded the way GCS reports it in `Blob.crc32c`."""
+    checksum = google_crc32c.Checksum()
+    with open(path, 'rb') as f:
+        while chunk := f.read(8 * 1024 * 1024):
+            checksum.update(chunk)
+    return base64.b64encode(checksum.digest()).decode('utf-8')
+
+
+def download_blob_sliced(
+    bucket_name,
+    source_blob_name,
+    destination_file_name,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    max_workers: int = DEFAULT_TRANSFER_WORKERS,
+    max_retries: int = 5,
+    verify: bool = True,
+    generation: int | None = None,
+    raise_errors: bool = False,
+    verbose=False,
+    ):
+    """
+    Downloads a blob with up to `max_workers` concurrent range requests of `chunk_size` bytes each, streamed straight into place in
+    a temporary file that is renamed to `destination_file_name` only once the download is complete, its size matches the blob's and
+    (if `verify`) its CRC32C matches too. Blobs no larger than `chunk_size` are downloaded in a single request. Every slice pins the
+    blob's generation (`generation`, if given, or else the latest), so an object overwritten mid-download cannot produce a mix of two versions.
+    Slices are never buffered whole: peak memory is about `max_workers * STREAM_BUFFER_SIZE` bytes per call.
+
+    Returns -1 on failure, like `download_blob`; with `raise_errors`, raises the reason for the failure instead.
+    """
+    storage_client = get_client(bucket_name, pool_size=max_workers)
+    temp_file_name = f"{destination_file_name}.part"
+    try:
+        for retry in range(max_retries):
+            try:
+                blob = storage_client.bucket(bucket_name).get_blob(source_blob_name, generation=generation)
+                break
+            except Exception as e:
+                if retry == max_retries - 1:
+                    raise IOError(f"unable to get metadata: {e}") from e
+                time.sleep(_retry_delay(retry))
+        if blob is None:
+            raise FileNotFoundError("blob does not exist" + (f" at generation {generation}" if generation else ""))
+
+        os.makedirs(os.path.dirname(os.path.abspath(destination_file_name)), exist_ok=True)
+        ranges = [(start, min(start + chunk_size, blob.size) - 1) for start in range(0, blob.size, chunk_size)]
+
+        def download_range(start, end):
+            # each slice streams through its own handle, seeked to the slice's offset, so it is never held in memory whole
+            with open(temp_file_name, 'r+b', buffering=STREAM_BUFFER_SIZE) as f:
+                for retry in range(max_retries):
+                    try:
+                        f.seek(start)
+                        blob.download_to_file(f, start=start, end=end, checksum=None)
+                        return
+                    except Exception as e:
+                        if retry == max_retries - 1:
+                            raise e
+                        logger.info(f"Retrying bytes {start}-{end} of blob {source_blob_name} from bucket {bucket_name}...")
+                        time.sleep(_retry_delay(retry))
+
+        with open(temp_file_name, 'wb') as f:
+            f.truncate(blob.size)
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(ranges)))) as executor:
+            for future in [executor.submit(download_range, start, end) for start, end in ranges]:
+                future.result()
+        if os.path.getsize(temp_file_name) != blob.size:
+            raise IOError(f"expected {blob.size} bytes but got {os.path.getsize(temp_file_name)}")
+        if verify and blob.crc32c and file_crc32c(temp_file_name) != blob.crc32c:
+            raise IOError("CRC32C mismatch")
+        os.replace(temp_file_name, destination_file_name)
+    except Exception as e:
+        logger.warning(f"Failed to download blob {source_blob_name} from bucket {bucket_name}: {e}")
+        if os.path.exists(temp_file_name):
+            os.remove(temp_file_name)
+        if raise_errors:
+            raise e
+        return -1
+
+    if verbose:
+        logger.info(f"Blob {source_blob_name} downloaded to {destination_file_name} in {len(ranges)} slices.")
+
+def upload_blob_composite(
+    bucket_name,
+    source_file_name,
+    destination_blob_name,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    max_workers: int = DEFAULT_TRANSFER_WORKERS,
+    max_retries: int = 5,
+    content_type: str | None = None,
+    predefined_acl: str | None = None,
+    verbose=False,
+    ):
+    """
+    Parallel composite upload: uploads a file as `chunk_size`-byte parts on up to `max_workers` threads, composes the parts into
+    `destination_blob_name` (in rounds, since a compose request accepts at most 32 sources), then deletes the parts.
+    Files no larger than `chunk_size` are uploaded with `upload_blob` in a single request.
+
+    Note that composite objects have a CRC32C but no MD5 hash. Returns -1 on failure, like `upload_blob`.
+    Only `predefined_acl='publicRead'` is supported for composite uploads (compose requests cannot set ACLs, so it is granted afterwards).
+    """
+    file_size = os.path.getsize(source_file_name)
+    if file_size <= chunk_size:
+        return upload_blob(bucket_name, source_file_name, destination_blob_name, max_retries=max_retries, verbose=verbose, predefined_acl=predefined_acl)
+    if predefined_acl not in (None, 'publicRead'):
+        raise ValueError("Composite uploads only support `predefined_acl='publicRead'`.")
+
+    storage_client = get_client(bucket_name, pool_size=max_workers)
+    bucket = storage_client.bucket(bucket_name)
+    parts_prefix = f"{destination_blob_name}.parts-{uuid.uuid4().hex}/"
+    content_type = content_type or mimetypes.guess_type(source_file_name)[0] or 'application/octet-stream'
+    created = []
+
+    def upload_part(fd, idx, start):
+        part = bucket.blob(f"{parts_prefix}{idx:05d}")
+        data = os.pread(fd, min(chunk_size, file_size - start), start)
+        for retry in range(max_retries):
+            try:
+                part.upload_from_string(data, content_type=content_type)
+                created.append(part)
+                return part
+            except Exception as e:
+                if retry == max_retries - 1:
+                    raise e
+                logger.info(f"Retrying part {idx} of {source_file_name}...")
+                time.sleep(_retry_delay(retry))
+
+    try:
+        fd = os.open(source_file_name, os.O_RDONLY)
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [executor.submit(upload_part, fd, idx, start) for idx, start in enumerate(range(0, file_size, chunk_size))]
+                parts = [future.result() for future in futures]
+        finally:
+            os.close(fd)
+
+        # compose up to 32 objects at a time until one remains
+        level = 0
+        while len(parts) > MAX_COMPOSE_SOURCES:
+            composed = []
+            for idx in range(0, len(parts), MAX_COMPOSE_SOURCES):
+                intermediate = bucket.blob(f"{parts_prefix}compose-{level}-{idx // MAX_COMPOSE_SOURCES:05d}")
+                intermediate.content_type = content_type
+                intermediate.compose(parts[idx:idx + MAX_COMPOSE_SOURCES])
+                composed.append(intermediate)
+            created += composed
+            parts, level = composed, level + 1
+        destination = bucket.blob(destination_blob_name)
+        destination.content_type = content_type
+        destination.compose(parts)
+        destination.reload()
+        if destination.size != file_size:
+            raise IOError(f"expected {file_size} bytes but the composed object has {destination.size}")
+        if predefined_acl == 'publicRead' and make_blobs_public(bucket_name, [destination_blob_name]):
+            raise IOError("unable to make the composed object public")
+    except Exception as e:
+        logger.warning(f"Failed to upload {source_file_name} to gs://{bucket_name}/{destination_blob_name}: {e}")
+        return -1
+    finally:
+        bucket.delete_blobs(created, on_error=lambda blob: None)
+    invalidate_listing_cache(bucket_name)
+
+    if verbose:
+        logger.info(f"File {source_file_name} uploaded to gs://{bucket_name}/{destination_blob_name} in {math.ceil(file_size / chunk_size)} parts.")
+
+
 def download_blobs_by_prefix(
     bucket_name, 
     destination_dir, 
@@ -118,7 +480,7 @@ def download_blobs_by_prefix(
     verbose=False,
     ):
     """Downloads all the blobs in the bucket that are filtered by prefix."""
-    storage_client = storage.Client()
+    storage_client = get_client(bucket_name)
     bucket = storage_client.bucket(bucket_name)
 
     blobs = bucket.list_blobs(prefix=prefix)  # Get blobs in the bucket
@@ -201,6 +563,8 @@ def upload_blobs_multithread(
 
     if verbose:
         logger.info(f"Uploading {len(files_to_upload)} files to gs://{bucket_name}/{destination_blob_prefix}.")
+    # size the shared client's connection pool for all the threads below
+    get_client(bucket_name, pool_size=max_workers)
 
     if shard_size is not None:
         num_shards = math.ceil(len(files_to_upload) / shard_size)
@@ -250,13 +614,13 @@ def _download_blobs_single_thread(
     bucket_name: str,
     download_dir: str,
     shard_info=None,
-    verbose=False
+    verbose=False,
+    expected_size: int | None = None,
 ):
     """
-    This function should only be called by upload_blobs_multithread so 
-    please don't use it directly. If you want to upload files to 
-    GCS, please use upload_blobs_multithread, upload_blob, or 
-    upload_directory_to_gcs.
+    This function should only be called by download_blobs_multi_thread so
+    please don't use it directly. If you want to download files from
+    GCS, please use download_blobs_multi_thread, sync_prefix, or download_blob.
     """
     if shard_info is not None:
         idx, shard_size, num_shards = shard_info
@@ -265,17 +629,21 @@ def _download_blobs_single_thread(
         download_dir = os.path.join(download_dir, shard_prefix)
     os.makedirs(download_dir, exist_ok=True)
     dest_fname = os.path.join(download_dir, blob_path.split('/')[-1])
-    if os.path.exists(dest_fname):
+    # a file of the wrong size is a leftover from an interrupted or outdated download
+    if os.path.exists(dest_fname) and (expected_size is None or os.path.getsize(dest_fname) == expected_size):
         if verbose:
             logger.info(f"File {dest_fname} already exists. Skipping download.")
     else:
-        ret = download_blob(
+        # downloads into a temporary file that only replaces `dest_fname` once complete
+        ret = download_blob_sliced(
             bucket_name=bucket_name,
             source_blob_name=str(blob_path),
             destination_file_name=dest_fname,
             verbose=verbose,
             max_retries=5
         )
+        if ret == -1:
+            logger.warning(f"Failed to download blob {blob_path} from bucket {bucket_name}.")
 
 
 def download_blobs_multi_thread(
@@ -292,90 +660,172 @@ def download_blobs_multi_thread(
     Either provide the prefix so we can list the blobs and find the
     blobs under that prefix.
     Otherwise just give a list of blobs to download. 
+
+    With `keep_hierarchy`, files are laid out under `download_dir` by their path relative to `prefix`
+    (or by their full blob path, when a list of blobs is given). Existing files are only skipped if their size
+    matches the blob's (when listing by prefix); see `sync_prefix` for checksum-based incremental downloads.
     """
     if prefix:
         assert blobs is None
-        blobs_to_download = list_blobs_by_prefix(bucket_name, prefix)
-        if keep_hierarchy:
-            logger.info("Downloading blobs with keep_hierarchy=True.")
-            # files_to_upload = sorted(list(Path(source_dir).glob("**/*")))
-            # files_to_upload = [fpath for fpath in files_to_upload if fpath.is_file()]
-            # get the relative path of each file to the source_dir
-            # rel_paths = [str(fpath.relative_to(source_dir)) for fpath in files_to_upload]
-            # destination_blob_prefixes = [os.path.join(destination_blob_prefix, rel_path) for rel_path in rel_paths]
-            try:
-                blob_paths = [blob.name for blob in blobs_to_download]
-                # get the rel path of blob_path to the prefix
-                rel_paths = [blob_path.split(prefix)[1] for blob_path in blob_paths]
-                rel_dirs = [os.path.dirname(rel_path) for rel_path in rel_paths]
-            except Exception as e:
-                logger.info(f"Error: {e}")
-                logger.info(f"prefix: {prefix}")
-                raise e
-                
-            download_dirs = [os.path.join(download_dir, rel_dir) for rel_dir in rel_dirs]
-            assert shard_size is None, "shard_size is not supported when keep_hierarchy is True."
+        # downloads start as soon as the first page of the listing arrives
+        to_download = ((blob.name, blob.size) for blob in list_blobs_by_prefix(bucket_name, prefix) if not blob.name.endswith('/'))
     else:
         assert prefix is None
         assert blobs is not None
-        blob_paths = blobs
+        to_download = ((blob_path, None) for blob_path in blobs)
 
-    if verbose:
-        logger.info(f"Downloading {len(blob_paths)} files to {download_dir}")
+    if keep_hierarchy:
+        assert shard_size is None, "shard_size is not supported when keep_hierarchy is True."
+        logger.info("Downloading blobs with keep_hierarchy=True.")
+
+    # size the shared client's connection pool for all the threads below
+    get_client(bucket_name, pool_size=max_workers)
 
     if shard_size is not None:
-        num_shards = math.ceil(len(blob_paths) / shard_size)
+        # sharding needs the total number of blobs up front
+        to_download = list(to_download)
+        num_shards = math.ceil(len(to_download) / shard_size)
         if verbose:
-            logger.info(f"Sharding {len(blob_paths)} files into {num_shards} shards.")
+            logger.info(f"Sharding {len(to_download)} files into {num_shards} shards.")
 
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
         futures = []
-        if shard_size is None:
-            if keep_hierarchy:
-                for i, blob_path in enumerate(blob_paths):
-                    futures.append(executor.submit(
-                        _download_blobs_single_thread,
-                        blob_path,
-                        bucket_name,
-                        download_dirs[i],
-                        verbose=verbose,
-                    ))
+        for i, (blob_path, expected_size) in enumerate(to_download):
+            if shard_size is not None:
+                args, blob_verbose = (download_dir, (i, shard_size, num_shards)), False
+            elif keep_hierarchy:
+                # get the rel path of the blob to the prefix
+                rel_path = blob_path[len(prefix):].lstrip('/') if prefix else blob_path
+                args, blob_verbose = (os.path.join(download_dir, os.path.dirname(rel_path)),), verbose
             else:
-                for i, blob_path in enumerate(blob_paths):
-                    futures.append(executor.submit(
-                        _download_blobs_single_thread,
-                        blob_path,
-                        bucket_name,
-                        download_dir,
-                        verbose=True
-                    )) 
-        else:
-            for i, file_path in enumerate(blob_paths):
-                futures.append(executor.submit(
-                    _download_blobs_single_thread,
-                    blob_path,
-                    bucket_name,
-                    download_dir,
-                    (i, shard_size, num_shards),
-                    verbose=False
-                ))
-        for future in tqdm(futures, total=len(blob_paths), desc="Downloading blobs"):
+                args, blob_verbose = (download_dir,), True
+            futures.append(executor.submit(
+                _download_blobs_single_thread,
+                blob_path,
+                bucket_name,
+                *args,
+                verbose=blob_verbose,
+                expected_size=expected_size,
+            ))
+        if verbose:
+            logger.info(f"Downloading {len(futures)} files to {download_dir}")
+        for future in tqdm(futures, total=len(futures), desc="Downloading blobs"):
             future.result()
 
+# name of the file, inside each directory synced by `sync_prefix`, recording the remote version of every synced file
+SYNC_MANIFEST_NAME = '.gcs_manifest.json'
+
+
+def _load_sync_manifest(local_dir: str) -> dict:
+    manifest_path = os.path.join(local_dir, SYNC_MANIFEST_NAME)
+    if not os.path.isfile(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        logger.warning(f"Ignoring unreadable sync manifest at {manifest_path}: {e}")
+        return {}
+
+
+def _save_sync_manifest(local_dir: str, manifest: dict):
+    manifest_path = os.path.join(local_dir, SYNC_MANIFEST_NAME)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def sync_prefix(
+    bucket_name: str,
+    prefix: str,
+    local_dir: str,
+    max_workers: int = 16,
+    delete_extraneous: bool = False,
+    verbose=False,
+) -> dict:
+    """
+    rsync-like, one-way sync of every blob under `prefix` into `local_dir`, keeping the hierarchy below `prefix`.
+
+    The remote side is listed once and compared against a manifest stored in `local_dir` (see `SYNC_MANIFEST_NAME`) that records
+    the (name, size, crc32c, generation) of every file synced so far; only new or changed blobs are downloaded, in parallel,
+    each into a temporary file that is renamed into place once its checksum is verified. Local files that predate the manifest
+    are adopted without downloading if their size and CRC32C already match. With `delete_extraneous`, files synced earlier
+    whose blobs no longer exist are deleted.
+
+    Returns a summary dict with the number of 'downloaded', 'skipped' and 'deleted' files and the blob names that 'failed'.
+    """
+    os.makedirs(local_dir, exist_ok=True)
+    manifest = _load_sync_manifest(local_dir)
+    summary = {'downloaded': 0, 'skipped': 0, 'deleted': 0, 'failed': []}
+
+    # list the remote side once and work out the delta
+    remote = {}
+    for blob in list_blobs_by_prefix(bucket_name, prefix, ttl=0):
+        if blob.name.endswith('/'):
+            continue
+        rel_path = blob.name[len(prefix):].lstrip('/') if prefix else blob.name
+        remote[rel_path] = {'name': blob.name, 'size': blob.size, 'crc32c': blob.crc32c, 'generation': blob.generation}
+
+    to_download = []
+    for rel_path, entry in remote.items():
+        local_path = os.path.join(local_dir, rel_path)
+        local_size = os.path.getsize(local_path) if os.path.isfile(local_path) else None
+        if local_size == entry['size'] and manifest.get(rel_path) == entry:
+            summary['skipped'] += 1
+        elif local_size == entry['size'] and rel_path not in manifest and file_crc32c(local_path) == entry['crc32c']:
+            manifest[rel_path] = entry
+            summary['skipped'] += 1
+        else:
+            to_download.append(rel_path)
+    if verbose:
+        logger.info(f"{len(remote)} blobs under gs://{bucket_name}/{prefix}: {len(to_download)} to download, {summary['skipped']} up to date.")
+
+    # transfer the delta, recording each file in the manifest as soon as it lands
+    get_client(bucket_name, pool_size=max_workers)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                # pinned to the listed generation, so an object overwritten mid-sync fails (and is retried on the next sync) rather than
+                # being recorded under a generation it does not match
+                executor.submit(download_blob_sliced, bucket_name, remote[rel_path]['name'], os.path.join(local_dir, rel_path),
+                                generation=remote[rel_path]['generation'], verbose=verbose): rel_path
+                for rel_path in to_download
+            }
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Syncing blobs"):
+                rel_path = futures[future]
+                if future.result() == -1:
+                    manifest.pop(rel_path, None)
+                    summary['failed'].append(remote[rel_path]['name'])
+                else:
+                    manifest[rel_path] = remote[rel_path]
+                    summary['downloaded'] += 1
+
+        if delete_extraneous:
+            for rel_path in [rel_path for rel_path in manifest if rel_path not in remote]:
+                local_path = os.path.join(local_dir, rel_path)
+                if os.path.isfile(local_path):
+                    os.remove(local_path)
+                del manifest[rel_path]
+                summary['deleted'] += 1
+    finally:
+        _save_sync_manifest(local_dir, manifest)
+
+    if summary['failed']:
+        logger.warning(f"Failed to sync {len(summary['failed'])} blobs from gs://{bucket_name}/{prefix}: {summary['failed']}")
+    return summary
+
 
 def upload_blob(
     bucket_name, source_file_name, 
     destination_blob_name, max_retries=5, 
-    verbose=False, remove_original_file=False
+    verbose=False, remove_original_file=False,
+    predefined_acl=None
 ):
-    """Uploads a file to the bucket."""
-    credentials_path = BUCKET_NAME_TO_SERVICE_ACCOUNT_CREDENTIALS_PATH.get(bucket_name)
-    if not credentials_path:
-        logger.error(f"No credentials path found for bucket {bucket_name}.")
-        return -1
-
-    credentials = service_account.Credentials.from_service_account_file(credentials_path)
-    storage_client = storage.Client(credentials=credentials)
+    """
+    Uploads a file to the bucket.
+    `predefined_acl` (e.g., 'publicRead') is applied in the same request, which saves a separate ACL call per blob.
+    """
+    storage_client = get_client(bucket_name)
     bucket = storage_client.bucket(bucket_name)
     blob = bucket.blob(destination_blob_name)
 
@@ -383,7 +833,8 @@ def upload_blob(
         try:
             if verbose:
                 logger.info(f"Uploading blob {destination_blob_name} to bucket {bucket_name}...")
-            blob.upload_from_filename(source_file_name)
+            blob.upload_from_filename(source_file_name, predefined_acl=predefined_acl)
+            invalidate_listing_cache(bucket_name)
             if verbose:
                 logger.info(f"File {source_file_name} uploaded to gs://{bucket_name}/{destination_blob_name}.")
             if remove_original_file:
@@ -400,8 +851,8 @@ def upload_blob(
 
 def upload_json_to_gcs(bucket_name, destination_blob_name, data, verbose=False):
     """Uploads a JSON object to the specified GCS bucket"""
-    # Initialize a client
-    storage_client = storage.Client()
+    # Get the shared client
+    storage_client = get_client(bucket_name)
     # Get the bucket
     bucket = storage_client.bucket(bucket_name)
     # Initialize a blob or create one if it doesn’t exist
@@ -411,6 +862,7 @@ def upload_json_to_gcs(bucket_name, destination_blob_name, data, verbose=False):
     json_string = json.dumps(data)
     # Upload the string to GCS
     blob.upload_from_string(json_string, content_type='application/json')
+    invalidate_listing_cache(bucket_name)
     if verbose:
         logger.info(f"File {destination_blob_name} uploaded to {bucket_name}.")
  
@@ -439,33 +891,115 @@ def upload_directory_to_gcs(
 
 def delete_blob_by_prefix(bucket_name, prefix, verbose=False):
     """
-    Delete all blobs with the specified prefix (folder_path) in the bucket.
+    Delete all blobs with the specified prefix (folder_path) in the bucket, up to 100 per batch request.
     
     :param bucket_name: Name of the GCS bucket.
     :param folder_path: Prefix (i.e., "folder") to be deleted.
     """
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    
     # Note: The list_blobs method uses a flat namespace under the hood,
     # so you can think of folder_path as a prefix here.
-    blobs = bucket.list_blobs(prefix=prefix)
-    
-    for blob in blobs:
-        blob.delete()
-        if verbose:
-            logger.info(f"Blob {blob.name} from bucket {bucket_name} deleted.")
+    blob_names = sorted(list_blob_names(bucket_name, prefix))
+    failed = delete_blobs(bucket_name, blob_names)
+    if verbose:
+        logger.info(f"Deleted {len(blob_names) - len(failed)} blobs under gs://{bucket_name}/{prefix}.")
+    return failed
 
 
 def delete_blob(bucket_name, blob_name):
     """Deletes a blob from the bucket."""
-    storage_client = storage.Client()
+    storage_client = get_client(bucket_name)
     bucket = storage_client.bucket(bucket_name)
     blob = bucket.blob(blob_name)
     blob.delete() 
+    invalidate_listing_cache(bucket_name)
     logger.info(f"Blob {blob_name} from bucket {bucket_name} deleted.")
 
 
+# maximum number of calls that GCS accepts in a single batch request
+MAX_BATCH_SIZE = 100
+
+
+def _batched(bucket_name: str, blob_names: Iterable[str], op, description: str) -> List[str]:
+    """
+    Calls `op(client, blob)` for every blob (in any iterable of names), grouping the resulting requests into batch requests of up to `MAX_BATCH_SIZE` calls.
+    If a batch fails, its calls are retried one at a time so that failures can be attributed to individual blobs.
+    Returns the names of the blobs whose call failed.
+    """
+    storage_client = get_client(bucket_name)
+    bucket = storage_client.bucket(bucket_name)
+    blob_names, failed = list(blob_names), []
+    for idx in range(0, len(blob_names), MAX_BATCH_SIZE):
+        blobs = [bucket.blob(blob_name) for blob_name in blob_names[idx:idx + MAX_BATCH_SIZE]]
+        try:
+            with storage_client.batch():
+                for blob in blobs:
+                    op(storage_client, blob)
+        except Exception as e:
+            logger.info(f"Batch request to {description} failed ({e}); retrying its {len(blobs)} calls one at a time...")
+            for blob in blobs:
+                try:
+                    op(storage_client, blob)
+                except Exception as e:
+                    logger.warning(f"Unable to {description} gs://{bucket_name}/{blob.name}: {e}")
+                    failed.append(blob.name)
+    return failed
+
+
+def delete_blobs(bucket_name: str, blob_names: Iterable[str]) -> List[str]:
+    """Deletes many blobs with batch requests. Blobs that do not exist count as deleted. Returns the names of blobs that could not be deleted."""
+    def delete(client, blob):
+        try:
+            blob.delete(client=client)
+        except NotFound:
+            pass
+    failed = _batched(bucket_name, blob_names, delete, 'delete')
+    invalidate_listing_cache(bucket_name)
+    return failed
+
+
+def make_blobs_public(bucket_name: str, blob_names: Iterable[str]) -> List[str]:
+    """
+    Grants public read access to many blobs with batch requests. Returns the names of blobs that could not be made public.
+    """
+    # `Blob.make_public` reloads the ACL before saving it, which cannot be batched; adding the one ACL entry directly can be
+    def grant(client, blob):
+        client._post_resource(f"{blob.path}/acl", {"entity": "allUsers", "role": "READER"})
+    return _batched(bucket_name, blob_names, grant, 'make public')
+
+
+def patch_blobs_metadata(bucket_name: str, blob_names: Iterable[str], metadata: dict | None = None, **properties) -> List[str]:
+    """
+    Patches the custom `metadata` and/or other writable properties (e.g., content_type='video/mp4', cache_control='no-cache')
+    of many blobs with batch requests. Returns the names of blobs that could not be patched.
+    """
+    def patch(client, blob):
+        if metadata is not None:
+            blob.metadata = metadata
+        for key, value in properties.items():
+            setattr(blob, key, value)
+        blob.patch(client=client)
+    return _batched(bucket_name, blob_names, patch, 'patch metadata of')
+
+
+def list_blob_names(bucket_name: str, prefix: str = '', delimiter: str | None = None) -> set[str]:
+    """
+    Returns the names of all blobs under `prefix` (only those directly under it if `delimiter` is '/'), fetching only names,
+    1,000 per request. Use it instead of calling `Blob.exists()` on each of many blobs: one listing replaces one request per blob.
+    """
+    storage_client = get_client(bucket_name)
+    blobs = storage_client.list_blobs(bucket_name, prefix=prefix or None, delimiter=delimiter, fields='items(name),prefixes,nextPageToken')
+    return set(blob.name for blob in blobs)
+
+
+def blobs_exist(bucket_name: str, blob_names: List[str]) -> dict[str, bool]:
+    """
+    Returns whether each of `blob_names` exists, listing each distinct parent "directory" once instead of probing every blob.
+    """
+    parents = {blob_name: blob_name[:blob_name.rfind('/') + 1] for blob_name in blob_names}
+    listings = {parent: list_blob_names(bucket_name, parent, delimiter='/') for parent in set(parents.values())}
+    return {blob_name: blob_name in listings[parent] for blob_name, parent in parents.items()}
+
+
 def download_blob_as_bytes(
     bucket_name: str,
     file_name: str,
@@ -475,7 +1009,7 @@ def download_blob_as_bytes(
     content = None
     for retry in range(max_retries):
         try:
-            storage_client = storage.Client()
+            storage_client = get_client(bucket_name)
             bucket = storage_client.bucket(bucket_name)
             blob = bucket.blob(file_name)
             content = blob.download_as_bytes()
@@ -487,6 +1021,113 @@ def download_blob_as_bytes(
     return content
 
 
+# size of each range request made by `GCSReader`; it keeps at most `read_ahead + 2` of them in memory
+DEFAULT_STREAM_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class GCSReader(io.RawIOBase):
+    """
+    A read-only, seekable file object over a blob, for handing GCS media straight to decoders (ffmpeg through a pipe, PyAV's `av.open`,
+    decord's `VideoReader`, ...) without first writing it to disk or holding it all in memory.
+
+    Data is fetched in ranges of `chunk_size` bytes, and the `read_ahead` ranges after the one being read are downloaded in the background,
+    so sequential reads rarely wait on the network. Only the current, previous and read-ahead ranges are kept, so memory stays at a few
+    chunks regardless of the blob's size. Every range pins the blob's generation, so an object overwritten mid-read cannot produce a mix of versions.
+    """
+    def __init__(
+        self,
+        bucket_name: str,
+        blob_name: str,
+        chunk_size: int = DEFAULT_STREAM_CHUNK_SIZE,
+        read_ahead: int = 2,
+        max_retries: int = 5,
+        ):
+        super().__init__()
+        self._blob = get_client(bucket_name, pool_size=read_ahead + 1).bucket(bucket_name).get_blob(blob_name)
+        if self._blob is None:
+            raise FileNotFoundError(f"Blob {blob_name} does not exist in bucket {bucket_name}.")
+        self.name = f"gs://{bucket_name}/{blob_name}"
+        self.size: int = self._blob.size
+        self.chunk_size, self.read_ahead, self.max_retries = chunk_size, read_ahead, max_retries
+        self._pos = 0
+        self._chunks: dict[int, Future] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max(1, read_ahead))
+
+    def _fetch(self, idx: int) -> bytes:
+        start = idx * self.chunk_size
+        end = min(start + self.chunk_size, self.size) - 1
+        for retry in range(self.max_retries):
+            try:
+                return self._blob.download_as_bytes(start=start, end=end, checksum=None)
+            except Exception as e:
+                if retry == self.max_retries - 1:
+                    raise e
+                logger.info(f"Retrying bytes {start}-{end} of {self.name}...")
+                time.sleep(_retry_delay(retry))
+
+    def _chunk(self, idx: int) -> bytes:
+        last = (self.size - 1) // self.chunk_size
+        for i in range(idx, min(idx + self.read_ahead, last) + 1):
+            if i not in self._chunks:
+                self._chunks[i] = self._executor.submit(self._fetch, i)
+        # keep the previous chunk around for decoders that seek back a little
+        for i in [i for i in self._chunks if i < idx - 1 or i > idx + self.read_ahead]:
+            self._chunks.pop(i).cancel()
+        return self._chunks[idx].result()
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence ({whence})")
+        if pos < 0:
+            raise ValueError(f"Negative seek position {pos}")
+        self._pos = pos
+        return pos
+
+    def readinto(self, b) -> int:
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        # fill `b` across chunk boundaries, so callers reading a few bytes at a time (e.g., box headers) never get short reads
+        filled = 0
+        while filled < len(b) and self._pos < self.size:
+            idx, offset = divmod(self._pos, self.chunk_size)
+            data = memoryview(self._chunk(idx))
+            n = min(len(b) - filled, len(data) - offset)
+            b[filled:filled + n] = data[offset:offset + n]
+            filled += n
+            self._pos += n
+        return filled
+
+    def close(self):
+        if not self.closed:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._chunks.clear()
+        super().close()
+
+
+def open_gcs_file(gcs_url: str, **kwargs) -> GCSReader:
+    """
+    Opens the blob at `gcs_url` (e.g., 'gs://bucket/video.mp4') as a seekable, read-ahead file object; see `GCSReader` for `kwargs`.
+    Use this instead of `load_gcs_file` for anything a decoder can read incrementally.
+    """
+    bucket_name, blob_name = parse_gcs_url(gcs_url)
+    return GCSReader(bucket_name, blob_name, **kwargs)
+
+
 def parse_gcs_url(gcs_url: str):
     """Parses a GCS URL into (bucket_name, blob_name)."""
     # Remove the 'gs://' prefix
@@ -513,8 +1154,13 @@ def load_gcs_file(video_path: str, extension: str) -> bytes:
     return download_blob_as_bytes(bucket_name, blob_name)
 
 
-def load_gcs_video(video_path: str) -> bytes:
-    return load_gcs_file(video_path, extension='.mp4')
+def load_gcs_video(video_path: str) -> GCSReader:
+    """
+    Opens the video at `video_path` as a seekable, read-ahead file object (see `open_gcs_file`) instead of downloading it whole.
+    Decoders that seek (PyAV, decord, ...) can read any video from it. To pipe it into ffmpeg, first check `media_probe.is_streamable`;
+    videos that are not streamable can be fetched to disk with `ClipCache().fetch`, as `transcription.pipeline` does.
+    """
+    return open_gcs_file(video_path)
 
 
 def load_gcs_gif(video_path: str) -> bytes:
@@ -522,7 +1168,13 @@ def load_gcs_gif(video_path: str) -> bytes:
 
 
 def load_gcs_frame(video_path: str) -> bytes:
-    return load_gcs_file(video_path, extension='.jpg')
+    """
+    Returns the bytes of the frame (e.g., a JPEG) at `video_path`. Frames are read through the machine-wide `ClipCache`, so frames that
+    are loaded repeatedly are only downloaded once; a frame is small and has to be decoded whole, so it is not streamed.
+    """
+    from src.utils.clip_cache import ClipCache      # imported here, since `clip_cache` imports this module
+    with open(ClipCache().fetch(video_path), 'rb') as f:
+        return f.read()
 
 
 def list_gcs_files(gcs_url: str) -> List[str]:
@@ -532,7 +1184,14 @@ def list_gcs_files(gcs_url: str) -> List[str]:
 
 
 if __name__ == "__main__":
-    download_blobs_multi_thread(
-        prefix=""
-    )
-    pass
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(description="Sync every blob under a GCS prefix into a local directory, downloading only what changed.")
+    parser.add_argument('gcs_url', help="e.g., gs://bucket/some/prefix/")
+    parser.add_argument('local_dir')
+    parser.add_argument('--max-workers', type=int, default=16)
+    parser.add_argument('--delete', action='store_true', help="delete previously synced files whose blobs no longer exist")
+    args = parser.parse_args()
+
+    bucket_name, prefix = parse_gcs_url(args.gcs_url)
+    summary = sync_prefix(bucket_name, prefix, args.local_dir, max_workers=args.max_workers, delete_extraneous=args.delete, verbose=True)
+    logger.info(f"Downloaded {summary['downloaded']}, skipped {summary['skipped']}, deleted {summary['deleted']}, failed {len(summary['failed'])}.")
@@ -0,0 +1,131 @@
+"""
+Content-addressed cache of model responses, so that re-running an experiment on the same media with the same prompt and settings
+costs nothing: no uploads to Gemini and no generation with Qwen.
+
+Responses are keyed by (model id, prompt, a hash of each media file's *contents*, and any settings that change the output such as fps,
+max_pixels and the generation config), stored in a local SQLite database, and evicted least-recently-used first once the database
+grows past a size budget. This is only sound for deterministic decoding, which is what both of our models use.
+"""
+from pathlib import Path
+from functools import lru_cache
+from contextlib import closing
+from typing import Any
+import sqlite3, hashlib, json, time, os
+
+from src.globals import CACHE_DIR
+
+INFERENCE_CACHE_PATH = Path(os.environ.get('INFERENCE_CACHE', CACHE_DIR / 'inference.sqlite'))
+INFERENCE_CACHE_MAX_BYTES = int(os.environ.get('INFERENCE_CACHE_MAX_BYTES', 1 << 30))
+
+@lru_cache(maxsize=4096)
+def _hash_file(path: str, size: int, mtime_ns: int) -> str:
+    """
+    Returns the SHA-256 of the contents of the file at `path`. `size` and `mtime_ns` are part of the memoization key only.
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def hash_media(media: Any) -> str:
+    """
+    Returns a hash identifying the contents of one piece of media:
+        - local files (optionally prefixed with 'file://') are hashed by content, so renamed or copied files still hit the cache;
+        - arrays and tensors (e.g., decoded frames) are hashed by shape, dtype and raw bytes;
+        - anything else (e.g., URLs) is hashed by its string representation.
+    """
+    if hasattr(media, 'numpy'):     # torch tensors
+        media = media.detach().cpu().numpy()
+    if hasattr(media, 'tobytes'):   # numpy arrays
+        sha = hashlib.sha256(f'{media.shape}|{media.dtype}|'.encode())
+        sha.update(media.tobytes())
+        return sha.hexdigest()
+
+    if isinstance(media, tuple):    # (path, MIME type) pairs, as passed to Gemini
+        return hashlib.sha256('|'.join(hash_media(m) for m in media).encode()).hexdigest()
+    if isinstance(media, (str, Path)):
+        path = Path(str(media).removeprefix('file://'))
+        if path.is_file():
+            stat = path.resolve().stat()
+            return _hash_file(str(path.resolve()), stat.st_size, stat.st_mtime_ns)
+    return hashlib.sha256(str(media).encode()).hexdigest()
+
+class InferenceCache:
+    def __init__(self, path: str | Path = INFERENCE_CACHE_PATH, max_bytes: int = INFERENCE_CACHE_MAX_BYTES):
+        """
+        Opens (creating, if needed) the response cache at `path`. Once the stored responses exceed `max_bytes`,
+        the least recently used ones are evicted.
+        """
+        self.path, self.max_bytes = Path(path), max_bytes
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS Responses(
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )""")
+            conn.execute('CREATE INDEX IF NOT EXISTS ResponsesByLastUse ON Responses(last_used)')
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30.0)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    @staticmethod
+    def key(model_id: str, prompt: str, media: list | None = None, **settings) -> str:
+        """
+        Returns the cache key of a request: `media` is a list of files, URLs or decoded frames (see `hash_media`), and `settings` are
+        any other JSON-serializable parameters that affect the response (fps, max_pixels, generation config, system instruction, ...).
+        """
+        request = {
+            'model': model_id,
+            'prompt': prompt,
+            'media': [hash_media(m) for m in media or []],
+            'settings': settings,
+        }
+        return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, key: str) -> Any | None:
+        """
+        Returns the cached response for `key`, or None on a miss.
+        """
+        try:
+            with closing(self._connect()) as conn, conn:
+                row = conn.execute('SELECT response FROM Responses WHERE key = ?', (key,)).fetchone()
+                if row:
+                    conn.execute('UPDATE Responses SET last_used = ? WHERE key = ?', (time.time(), key))
+        except sqlite3.Error as e:
+            print(f"WARNING: unable to read inference cache at {self.path}: {e}")
+            return None
+        return json.loads(row[0]) if row else None
+
+    def put(self, key: str, response: Any) -> None:
+        """
+        Caches the JSON-serializable `response` under `key`, then evicts the least recently used responses until the cache fits its budget.
+        """
+        serialized = json.dumps(response)
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute('INSERT OR REPLACE INTO Responses (key, response, size, last_used) VALUES (?, ?, ?, ?)',
+                             (key, serialized, len(serialized), time.time()))
+                self._evict(conn)
+        except sqlite3.Error as e:
+            print(f"WARNING: unable to write inference cache at {self.path}: {e}")
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        excess = conn.execute('SELECT COALESCE(SUM(size), 0) FROM Responses').fetchone()[0] - self.max_bytes
+        if excess <= 0:
+            return
+        evicted = []
+        for key, size in conn.execute('SELECT key, size FROM Responses ORDER BY last_used'):
+            if excess <= 0:
+                break
+            evicted.append((key,))
+            excess -= size
+        conn.executemany('DELETE FROM Responses WHERE key = ?', evicted)
+
+    def clear(self) -> None:
+        with closing(self._connect()) as conn, conn:
+            conn.execute('DELETE FROM Responses')
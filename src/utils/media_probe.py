@@ -0,0 +1,155 @@
+"""
+Memoized FFprobe metadata (duration, codecs, frame rate, resolution, keyframe index) for local media files.
+
+Every file is probed at most once: results are kept in an in-process LRU cache, backed by an on-disk SQLite cache
+keyed by the file's absolute path, size and modification time, so editing or replacing a file invalidates its entry.
+Like `src.utils.clipping`, this module only depends on the standard library so the scripts in `prep/` can use it.
+"""
+from pathlib import Path
+from subprocess import CompletedProcess
+from functools import lru_cache
+from contextlib import closing
+from typing import BinaryIO
+import subprocess, sqlite3, struct, json, os
+
+from src.globals import CACHE_DIR
+
+PROBE_CACHE_PATH = Path(os.environ.get('MEDIA_PROBE_CACHE', CACHE_DIR / 'media_probe.sqlite'))
+
+# kinds of probes and the FFprobe arguments (minus the input path) that produce them as JSON
+_PROBE_COMMANDS = {
+    'info': ['ffprobe', '-v', 'error', '-show_format', '-show_streams', '-of', 'json'],
+    'keyframes': ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags', '-of', 'json'],
+}
+
+def _connect() -> sqlite3.Connection:
+    PROBE_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(PROBE_CACHE_PATH, timeout=30.0)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute("""CREATE TABLE IF NOT EXISTS Probes(
+        path TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        result TEXT NOT NULL,
+        PRIMARY KEY (path, size, mtime_ns, kind)
+    )""")
+    return conn
+
+@lru_cache(maxsize=4096)
+def _probe(path: str, size: int, mtime_ns: int, kind: str) -> dict:
+    """
+    Returns the parsed FFprobe output of `kind` for the file at `path`. `size` and `mtime_ns` are part of the cache key only.
+    """
+    try:
+        with closing(_connect()) as conn:
+            row = conn.execute('SELECT result FROM Probes WHERE path = ? AND size = ? AND mtime_ns = ? AND kind = ?', (path, size, mtime_ns, kind)).fetchone()
+        if row:
+            return json.loads(row[0])
+    except sqlite3.Error as e:
+        print(f"WARNING: unable to read media probe cache at {PROBE_CACHE_PATH}: {e}")
+
+    result: CompletedProcess = subprocess.run(_PROBE_COMMANDS[kind] + [path], capture_output=True, text=True)
+    if result.returncode:
+        print(f"Encountered the following error while trying to probe media at {path} using FFprobe: {result.stderr}")
+        result.check_returncode()
+
+    try:
+        with closing(_connect()) as conn, conn:
+            # drop entries for older versions of this file before caching the new one
+            conn.execute('DELETE FROM Probes WHERE path = ? AND kind = ?', (path, kind))
+            conn.execute('INSERT INTO Probes (path, size, mtime_ns, kind, result) VALUES (?, ?, ?, ?, ?)', (path, size, mtime_ns, kind, result.stdout))
+    except sqlite3.Error as e:
+        print(f"WARNING: unable to write media probe cache at {PROBE_CACHE_PATH}: {e}")
+    return json.loads(result.stdout)
+
+def _probe_file(path: str | Path, kind: str) -> dict:
+    path = Path(path).resolve()
+    stat = path.stat()     # raises FileNotFoundError for missing files, which FFprobe would only report vaguely
+    return _probe(str(path), stat.st_size, stat.st_mtime_ns, kind)
+
+def probe(path: str | Path) -> dict:
+    """
+    Returns FFprobe's full description of the media file at `path`: a dict with a 'format' entry and a 'streams' list,
+    exactly as printed by `ffprobe -show_format -show_streams -of json`.
+    """
+    return _probe_file(path, 'info')
+
+def get_stream(path: str | Path, codec_type: str = 'video') -> dict | None:
+    """
+    Returns the first stream of `codec_type` ('video', 'audio', ...) in the media file at `path`, or None if it has no such stream.
+    """
+    return next((s for s in probe(path).get('streams', []) if s.get('codec_type') == codec_type), None)
+
+def get_duration(path: str | Path) -> float:
+    """
+    Returns the duration in seconds of the media file at `path`.
+    """
+    return float(probe(path)['format']['duration'])
+
+def get_codec_name(path: str | Path, codec_type: str = 'video') -> str:
+    """
+    Returns the codec name (e.g., 'h264' or 'aac') of the first stream of `codec_type` in the media file at `path`; '' if there is no such stream.
+    """
+    stream = get_stream(path, codec_type)
+    return stream.get('codec_name', '') if stream else ''
+
+def get_pix_fmt(path: str | Path) -> str:
+    """
+    Returns the pixel format (e.g., 'yuv420p') of the first video stream of the file at `path`; '' if it is unknown.
+    """
+    stream = get_stream(path, 'video')
+    return stream.get('pix_fmt', '') if stream else ''
+
+def get_resolution(path: str | Path) -> tuple[int, int]:
+    """
+    Returns the (width, height) of the first video stream of the file at `path`.
+    """
+    stream = get_stream(path, 'video')
+    if not stream:
+        raise ValueError(f'No video stream found in {path}')
+    return int(stream['width']), int(stream['height'])
+
+def get_fps(path: str | Path) -> float:
+    """
+    Returns the average frame rate of the first video stream of the file at `path`, rounded to two decimals (0. if it is unknown).
+    """
+    stream = get_stream(path, 'video')
+    num, denom = map(int, (stream or {}).get('avg_frame_rate', '0/0').split('/'))
+    return round(num / denom, 2) if denom else 0.
+
+def get_keyframes(path: str | Path) -> tuple[float, ...]:
+    """
+    Returns the sorted presentation timestamps (in seconds) of every keyframe in the first video stream of the file at `path`.
+    Only packet headers are read (nothing is decoded).
+    """
+    packets = _probe_file(path, 'keyframes').get('packets', [])
+    return tuple(sorted(set(float(p['pts_time']) for p in packets if 'K' in p.get('flags', '') and p.get('pts_time', 'N/A') != 'N/A')))
+
+def is_streamable(f: BinaryIO) -> bool:
+    """
+    Returns whether the media in the seekable binary file object `f` can be decoded front to back from a pipe (i.e., without seeking).
+    MP4/MOV files are only streamable if their index (the 'moov' box) precedes the media data ('mdat'), as in files written with
+    `-movflags +faststart`; other containers (WebM, MKV, MPEG-TS, ...) always are. Only box headers are read. Leaves `f` at offset 0.
+    """
+    pos = 0
+    try:
+        while True:
+            f.seek(pos)
+            header = f.read(8)
+            if len(header) < 8:
+                return True
+            size, kind = struct.unpack('>I4s', header)
+            if pos == 0 and kind != b'ftyp':
+                return True     # not an ISO base media file
+            if kind == b'moov':
+                return True
+            if kind == b'mdat':
+                return False
+            if size == 1:       # 64-bit box size
+                size = struct.unpack('>Q', f.read(8))[0]
+            if size < 8:        # box extends to the end of the file (0) or is malformed
+                return False
+            pos += size
+    finally:
+        f.seek(0)
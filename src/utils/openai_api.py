@@ -1,21 +1,29 @@
 import ast
+import asyncio
 import base64
 import io
 import json
 import os
+import random
 import sys
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait as futures_wait
+from collections import OrderedDict
 from typing import Dict, List, Optional, Union
 from pathlib import Path
 
 import backoff
 import requests
 from loguru import logger
-from openai import APIConnectionError, BadRequestError, OpenAI, RateLimitError, NOT_GIVEN
+from openai import APIConnectionError, APIStatusError, BadRequestError, OpenAI, AsyncOpenAI, DefaultAsyncHttpxClient, RateLimitError, NOT_GIVEN
 from openai.types.completion_usage import CompletionUsage
 from PIL import Image
 from pydantic import BaseModel
 from tqdm import tqdm
+import httpx
+
+from src.utils.rate_limiter import TokenBucket, FileTokenBucket
 
 
 class Message(BaseModel):
@@ -71,6 +79,25 @@ API_COST = {
     }
 }
 BATCH_FILE_LIMIT = 200 # MB
+BYTES_PER_MB = 1_000_000 # the API counts decimal megabytes
+BATCH_REQUEST_LIMIT = 50000 # requests per batch
+BATCH_TERMINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+# formats the API accepts as-is, keyed by their leading magic bytes
+IMAGE_MIME_TYPES = {
+    b'\xff\xd8\xff': 'image/jpeg',
+    b'\x89PNG\r\n\x1a\n': 'image/png',
+    b'GIF87a': 'image/gif',
+    b'GIF89a': 'image/gif',
+}
+DEFAULT_IMAGE_QUALITY = 85
+DEFAULT_IMAGE_MAX_SIDE = 2048 # the API downscales anything larger to fit 2048x2048 anyway
+# memo of base64 payloads of image files, bounded by their total size; see `_encode_file_cached`
+PAYLOAD_CACHE_MAX_BYTES = 64 << 20
+PAYLOAD_CACHE_MAX_ENTRY_BYTES = 1 << 20
+_payload_cache: OrderedDict[tuple, tuple[str, str]] = OrderedDict()
+_payload_cache_bytes = 0
+_payload_cache_lock = threading.Lock()
 
 ### Helper functions
 def read_image(filepath) -> Image.Image:
@@ -82,28 +109,88 @@ def read_image(filepath) -> Image.Image:
     
     return raw_image
 
-def encode_image(image_input: Union[str, Image.Image]):
-    if isinstance(image_input, str):  # if it's a file path
-        with open(image_input, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
-    elif isinstance(image_input, Image.Image):  # if it's a PIL Image object
-        byte_arr = io.BytesIO()
-        image_input.save(byte_arr, format='PNG')  # you can change the format if you like
-        return base64.b64encode(byte_arr.getvalue()).decode('utf-8')
-    else:
-        raise ValueError(f"Invalid image input: {image_input}. Must be a file path or PIL Image object.")
-
-def prepare_image_payload(image_input: str | Image.Image) -> str:
-    """ Prepare image payload for API call """
-    if isinstance(image_input, str):
-        if ('https://' in image_input or 'http://' in image_input):
-            image_content = image_input
-        else: # local file
-            assert os.path.isfile(image_input)
-            image_content = f"data:image/jpeg;base64,{encode_image(image_input)}"
-    else:
-        image_content = f"data:image/jpeg;base64,{encode_image(image_input)}"
-    return image_content
+def _sniff_mime_type(data: bytes) -> Optional[str]:
+    for magic, mime_type in IMAGE_MIME_TYPES.items():
+        if data.startswith(magic):
+            return mime_type
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+def _to_jpeg(image: Image.Image, quality: int, max_side: Optional[int]) -> bytes:
+    if max_side and max(image.size) > max_side:
+        image = image.copy()
+        image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    byte_arr = io.BytesIO()
+    image.save(byte_arr, format='JPEG', quality=quality)
+    return byte_arr.getvalue()
+
+def _encode_file(path: str, quality: int, max_side: Optional[int]) -> tuple[str, str]:
+    """ Returns the base64 payload and MIME type of the image file at `path`. """
+    with open(path, 'rb') as f:
+        data = f.read()
+    mime_type = _sniff_mime_type(data)
+    if mime_type is not None:
+        with Image.open(io.BytesIO(data)) as image:     # only parses the header
+            fits = not max_side or max(image.size) <= max_side
+        if fits:
+            return base64.b64encode(data).decode('utf-8'), mime_type
+    with Image.open(io.BytesIO(data)) as image:
+        return base64.b64encode(_to_jpeg(image, quality, max_side)).decode('utf-8'), 'image/jpeg'
+
+def _encode_file_cached(path: str, size: int, mtime_ns: int, quality: int, max_side: Optional[int]) -> tuple[str, str]:
+    """
+    `_encode_file`, memoized so that an image that is sent many times (e.g., the same few-shot examples in every prompt) is read and
+    encoded once. `size` and `mtime_ns` are part of the memoization key only. The memo is bounded by the total size of the payloads
+    (least recently used first), and payloads over `PAYLOAD_CACHE_MAX_ENTRY_BYTES` (e.g., frames used once) are never kept.
+    """
+    global _payload_cache_bytes
+    key = (path, size, mtime_ns, quality, max_side)
+    with _payload_cache_lock:
+        if key in _payload_cache:
+            _payload_cache.move_to_end(key)
+            return _payload_cache[key]
+
+    payload, mime_type = _encode_file(path, quality, max_side)
+    if len(payload) <= PAYLOAD_CACHE_MAX_ENTRY_BYTES:
+        with _payload_cache_lock:
+            if key not in _payload_cache:
+                _payload_cache[key] = (payload, mime_type)
+                _payload_cache_bytes += len(payload)
+            while _payload_cache_bytes > PAYLOAD_CACHE_MAX_BYTES:
+                _, (evicted, _) = _payload_cache.popitem(last=False)
+                _payload_cache_bytes -= len(evicted)
+    return payload, mime_type
+
+def encode_image_with_type(image_input, quality: int = DEFAULT_IMAGE_QUALITY, max_side: Optional[int] = DEFAULT_IMAGE_MAX_SIDE) -> tuple[str, str]:
+    """
+    Returns the base64 payload and MIME type of an image given as a file path, a PIL Image, or an (H, W[, C]) uint8 array (e.g., a decoded frame).
+    Files already in a format the API accepts (JPEG, PNG, GIF, WebP) and no larger than `max_side` are sent byte-for-byte; everything else
+    is downscaled to fit `max_side` (if set) and encoded as JPEG at `quality`. Payloads of files are memoized until the file changes.
+    """
+    if isinstance(image_input, (str, Path)):  # if it's a file path
+        stat = os.stat(image_input)
+        return _encode_file_cached(os.path.realpath(image_input), stat.st_size, stat.st_mtime_ns, quality, max_side)
+    if hasattr(image_input, '__array_interface__') and not isinstance(image_input, Image.Image):  # numpy arrays
+        image_input = Image.fromarray(image_input)
+    if isinstance(image_input, Image.Image):  # if it's a PIL Image object
+        return base64.b64encode(_to_jpeg(image_input, quality, max_side)).decode('utf-8'), 'image/jpeg'
+    raise ValueError(f"Invalid image input: {image_input}. Must be a file path, PIL Image object or array.")
+
+def encode_image(image_input, quality: int = DEFAULT_IMAGE_QUALITY, max_side: Optional[int] = DEFAULT_IMAGE_MAX_SIDE) -> str:
+    """ Returns the base64 payload of an image; see `encode_image_with_type` for the accepted inputs and its MIME type. """
+    return encode_image_with_type(image_input, quality, max_side)[0]
+
+def prepare_image_payload(image_input, quality: int = DEFAULT_IMAGE_QUALITY, max_side: Optional[int] = DEFAULT_IMAGE_MAX_SIDE) -> str:
+    """ Prepare image payload for API call: URLs are passed through, anything else becomes a data URL (see `encode_image_with_type`) """
+    if isinstance(image_input, str) and ('https://' in image_input or 'http://' in image_input):
+        return image_input
+    if isinstance(image_input, str): # local file
+        assert os.path.isfile(image_input)
+    payload, mime_type = encode_image_with_type(image_input, quality, max_side)
+    return f"data:{mime_type};base64,{payload}"
 
 def is_json_schema(response_format) -> bool:
     if isinstance(response_format, dict):
@@ -115,18 +202,41 @@ def is_json_schema(response_format) -> bool:
 ### 
 class OpenaiAPI:
 
-    def __init__(self, api_key=None, backoff_seconds=3, max_tries=3):
+    def __init__(self, api_key=None, backoff_seconds=3, max_tries=3, image_quality=DEFAULT_IMAGE_QUALITY, image_max_side=DEFAULT_IMAGE_MAX_SIDE):
         """ 
         Initializes the OpenAI API client with the provided API key and retry settings.
         Args:
             api_key (str, optional): The API key for authenticating with the OpenAI service. Defaults to None.
             backoff_time (int, optional): The time in seconds to wait between retry attempts when a request fails. Defaults to 3.
             max_tries (int, optional): The maximum number of retry attempts for a failed request. Defaults to 3.
+            image_quality (int, optional): JPEG quality of images that have to be re-encoded (PIL images, arrays, oversized files). Defaults to 85.
+            image_max_side (int, optional): Images are downscaled to fit this many pixels per side; no limit if None. Defaults to 2048.
         """
         self.client = OpenAI(api_key=api_key)
         self.backoff_seconds = backoff_seconds
         self.max_tries = max_tries
+        self.image_quality = image_quality
+        self.image_max_side = image_max_side
         self.logger = logger
+        # running totals over every call made through this instance; see `record_usage`
+        self.usage_totals = {'requests': 0, 'input_tokens': 0, 'cached_input_tokens': 0, 'output_tokens': 0, 'total_tokens': 0, 'cost': 0.}
+        self._usage_lock = threading.Lock()
+
+    def record_usage(self, model: str, usage=None, cost: float | None = None) -> None:
+        ''' Adds a call's token usage (and its cost, computed with `get_api_cost` unless given) to `usage_totals`. Thread-safe. '''
+        tokens = self._extract_tokens(usage.model_dump() if isinstance(usage, BaseModel) else usage or {})
+        if cost is None:
+            cost = self.get_api_cost(model, usage) if model in API_COST and usage else 0.
+        with self._usage_lock:
+            self.usage_totals['requests'] += 1
+            for k, v in tokens.items():
+                self.usage_totals[k] += v
+            self.usage_totals['cost'] += cost
+
+    @property
+    def total_cost(self) -> float:
+        ''' Total cost in USD of every call made through this instance so far. '''
+        return self.usage_totals['cost']
     
     def retry_api_call(self, fn, *args, **kwargs):
         ''' Retry API call with exponential backoff '''
@@ -141,6 +251,7 @@ class OpenaiAPI:
                 model=model, file=audio_input, response_format='verbose_json')
             response = response.model_dump()
             response['cost'] = API_COST[model]['cost_per_minute'] * (response['duration'] / 60)
+            self.record_usage(model, cost=response['cost'])
             return response
 
         return self.retry_api_call(_run_asr)
@@ -175,7 +286,7 @@ class OpenaiAPI:
     def _extract_tokens(self, usage: dict) -> dict:
         """Extract token counts from API usage info."""
         prompt_tokens = usage.get('prompt_tokens', 0)
-        cached_input_tokens = usage.get('prompt_tokens_details', {}).get('cached_tokens', 0)
+        cached_input_tokens = (usage.get('prompt_tokens_details') or {}).get('cached_tokens', 0)
         input_tokens = prompt_tokens - cached_input_tokens
         output_tokens = usage.get('completion_tokens', 0)
         total_tokens = usage.get('total_tokens', 0)
@@ -233,6 +344,42 @@ class OpenaiAPI:
 
         return images
 
+    @staticmethod
+    def _chat_request(client, messages, model, max_tokens, response_format, top_p, temperature, n, stop,
+                      reasoning_effort, reasoning_max_tokens, frequency_penalty, presence_penalty):
+        """ Returns the chat completion function of `client` to call (the parsing endpoint for JSON schemas) and its keyword arguments. """
+        if is_json_schema(response_format):
+            completions_fn = client.beta.chat.completions.parse
+        else:
+            completions_fn = client.chat.completions.create
+        
+        def is_reasoning_model(model):
+            return model.startswith("o")
+        
+        # Set as NOT_GIVEN for default values
+        if max_tokens is None:
+            max_tokens = NOT_GIVEN
+        if stop is None:
+            # stop = ["\n\n\n"]
+            stop = NOT_GIVEN
+        if reasoning_effort is None:
+            reasoning_effort = NOT_GIVEN
+        if reasoning_max_tokens is None:
+            reasoning_max_tokens = NOT_GIVEN
+
+        if is_reasoning_model(model):
+            request = dict(
+                messages=messages, model=model, max_completion_tokens=reasoning_max_tokens,
+                temperature=temperature, top_p=float(top_p), reasoning_effort=reasoning_effort,
+            )
+        else:
+            request = dict(
+                messages=messages, model=model, max_completion_tokens=max_tokens, response_format=response_format,
+                temperature=temperature, top_p=float(top_p), n=n, stop=stop,
+                frequency_penalty=frequency_penalty, presence_penalty=presence_penalty
+            )
+        return completions_fn, request
+
     def _complete_chat(self, messages, model='gpt-4o-2024-08-06', 
                        max_tokens=256, response_format=None, 
                        top_p = 1.0, temperature=1.0, n=1, 
@@ -264,40 +411,15 @@ class OpenaiAPI:
         """
         response = None
         c = 0
-        
-        if is_json_schema(response_format):
-            completions_fn = self.client.beta.chat.completions.parse
-        else:
-            completions_fn = self.client.chat.completions.create
-        
-        def is_reasoning_model(model):
-            return model.startswith("o")
-        
-        # Set as NOT_GIVEN for default values
-        if max_tokens is None:
-            max_tokens = NOT_GIVEN
-        if stop is None:
-            # stop = ["\n\n\n"]
-            stop = NOT_GIVEN
-        if reasoning_effort is None:
-            reasoning_effort = NOT_GIVEN
-        if reasoning_max_tokens is None:
-            reasoning_max_tokens = NOT_GIVEN
+        completions_fn, request = self._chat_request(
+            self.client, messages, model, max_tokens, response_format, top_p, temperature, n, stop,
+            reasoning_effort, reasoning_max_tokens, frequency_penalty, presence_penalty,
+        )
                     
         while c < self.max_tries:
             try:
                 self.logger.debug("sending request...")
-                if is_reasoning_model(model):
-                    response = completions_fn(
-                        messages=messages, model=model, max_completion_tokens=reasoning_max_tokens,
-                        temperature=temperature, top_p=float(top_p), reasoning_effort=reasoning_effort,
-                    )
-                else:
-                    response = completions_fn(
-                        messages=messages, model=model, max_completion_tokens=max_tokens, response_format=response_format,
-                        temperature=temperature, top_p=float(top_p), n=n, stop=stop,
-                        frequency_penalty=frequency_penalty, presence_penalty=presence_penalty
-                    )
+                response = completions_fn(**request)
                 self.logger.debug("response received")
                 
                 return response
@@ -360,7 +482,7 @@ class OpenaiAPI:
                 visual_content.append({
                     "type": "image_url",
                     "image_url": {
-                        "url": prepare_image_payload(im),
+                        "url": prepare_image_payload(im, self.image_quality, self.image_max_side),
                         "detail": image_detail[idx],
                     }
                 })
@@ -428,7 +550,7 @@ class OpenaiAPI:
             model (str): Model version to be used.
             sys_prompt (str, optional): System-level prompt defining assistant behavior.
             usr_prompt (str, optional): User prompt that the assistant responds to.
-            image_input (str, Image.Image, or list, optional): URL, local file path, or PIL image(s) for image input.
+            image_input (str, Image.Image, array, or list, optional): URL, local file path, PIL image(s) or frame array(s) for image input.
                                                                The image(s) can be a single image or a list of images.
             image_detail (str or list, optional): Details corresponding to each image; defaults to 'auto'.
                                                   Must be a string or list of strings with the same length as image_input.
@@ -478,6 +600,7 @@ class OpenaiAPI:
                 return None
             
             result = parse_response(response)
+            self.record_usage(model, response.usage)
             return result, response.usage
 
         except AttributeError as e:
@@ -566,11 +689,18 @@ class OpenaiAPI:
         batch_info_log: str,
         batch_size: int = 1000,
         overwrite_batch_info: bool = False,
-        metadata: Optional[Dict] = None
-    ) -> None:
+        metadata: Optional[Dict] = None,
+        max_file_mb: float = BATCH_FILE_LIMIT,
+        max_workers: int = 8,
+    ) -> List[Dict]:
         """
         Submits tasks in batches to GPT and logs the batch info.
 
+        Tasks are split into consecutive shards that each hold at most `batch_size` tasks (and never more than the API's
+        `BATCH_REQUEST_LIMIT`) and whose serialized size stays within `max_file_mb`, so no shard is rejected by the Batch API.
+        Shards are uploaded and their batches created concurrently; once all of them have been submitted, one line per batch is
+        written to `batch_info_log`, in task order. Batches are sent to the endpoint in the tasks' "url" (e.g., "/v1/chat/completions").
+
         Args:
             tasks (List[dict]): The tasks to be processed in batches.
             batch_file_template (str): File path template for writing each batch to disk.
@@ -578,6 +708,15 @@ class OpenaiAPI:
             batch_size (int): Maximum number of tasks to include in a single batch.
             overwrite_batch_info (bool): Whether to overwrite the batch info log file.
             metadata (Optional[Dict]): Additional metadata to pass along with each batch request.
+            max_file_mb (float): Maximum size of a single batch file, in MB. Defaults to the API's limit, `BATCH_FILE_LIMIT`.
+            max_workers (int): Maximum number of shards uploaded and submitted at once.
+
+        Returns:
+            List[Dict]: The batch info of every submitted batch, as written to `batch_info_log`.
+
+        Raises:
+            ValueError: If a single task is larger than `max_file_mb`.
+            RuntimeError: If any shard could not be submitted; the batches that were submitted are still logged.
         """
 
         if metadata is None:
@@ -591,11 +730,9 @@ class OpenaiAPI:
         total_tasks = len(tasks)
         if total_tasks == 0:
             self.logger.warning("No tasks provided. Exiting without submitting any batches.")
-            return
+            return []
+        endpoint = tasks[0].get("url", "/v1/chat/completions")
 
-        if total_tasks > batch_size:
-            self.logger.info(f"Splitting {total_tasks} tasks into batches of size {batch_size}.")
-        
         def build_batch_file_path(file_template: str, batch_index: int) -> str:
             """
             Given an output file path template, returns a unique filename for each batch.
@@ -612,23 +749,34 @@ class OpenaiAPI:
             # Insert an 8-digit zero-padded index in the file stem before ".jsonl"
             new_stem = f"{file_path.stem}_{batch_index:08}"
             return str(file_path.with_name(new_stem).with_suffix(file_path.suffix))
-        
-        # Iterate over tasks in steps of batch_size
-        for batch_start_index in tqdm(range(0, total_tasks, batch_size), desc="Submitting batches"):
-            current_batch_tasks = tasks[batch_start_index : batch_start_index + batch_size]
 
-            # Build a unique batch file path per chunk
+        # Serialize every task once, then cut shards by task count and cumulative byte size
+        max_tasks = min(batch_size, BATCH_REQUEST_LIMIT)
+        max_bytes = int(max_file_mb * BYTES_PER_MB)
+        shards = []     # (start index, serialized lines)
+        current_lines, current_bytes = [], 0
+        for task_index, task in enumerate(tasks):
+            line = (json.dumps(task) + "\n").encode("utf-8")
+            if len(line) > max_bytes:
+                raise ValueError(f"Task {task_index} ({task.get('custom_id')}) alone is {len(line) / BYTES_PER_MB:.2f} MB, over the {max_file_mb} MB batch file limit.")
+            if current_lines and (len(current_lines) == max_tasks or current_bytes + len(line) > max_bytes):
+                shards.append((task_index - len(current_lines), current_lines))
+                current_lines, current_bytes = [], 0
+            current_lines.append(line)
+            current_bytes += len(line)
+        shards.append((total_tasks - len(current_lines), current_lines))
+        self.logger.info(f"Split {total_tasks} tasks into {len(shards)} batches of at most {max_tasks} tasks and {max_file_mb} MB.")
+
+        def submit_shard(batch_start_index: int, lines: List[bytes]) -> Dict:
+            # Build a unique batch file path per shard and write its tasks to file
             current_batch_file_path = build_batch_file_path(
                 file_template=batch_file_template,
                 batch_index=batch_start_index
             )
-
-            # Write current batch tasks to file
             if os.path.exists(current_batch_file_path):
                 self.logger.warning(f"Overwriting existing batch file: {current_batch_file_path}")
-            with open(current_batch_file_path, "w", encoding="utf-8") as f:
-                for task in current_batch_tasks:
-                    f.write(json.dumps(task) + "\n")
+            with open(current_batch_file_path, "wb") as f:
+                f.writelines(lines)
             self.logger.info(f"Saved batch tasks to: {current_batch_file_path}")
 
             # Upload file & create GPT batch
@@ -636,26 +784,46 @@ class OpenaiAPI:
             response = self.upload_and_submit_batch(
                 local_file_path=current_batch_file_path,
                 # metadata=metadata
+                endpoint=endpoint,
             )
+            self.logger.info(f"Sent Batch ID: {response.id} with {len(lines)} tasks.")
 
             # Collect metadata about this batch
-            batch_info = {
+            return {
                 "batch_id": response.id,
                 "batch_file": current_batch_file_path,
                 "batch_index": batch_start_index,
-                "num_samples": len(current_batch_tasks),
+                "num_samples": len(lines),
                 **metadata
             }
 
-            # Log to console and to batch info file
-            self.logger.info(f"Sent Batch ID: {response.id} with {len(current_batch_tasks)} tasks.")
-            with open(batch_info_log, write_mode, encoding="utf-8") as f:
+        batch_infos, failures = [], {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(submit_shard, start, lines): start for start, lines in shards}
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Submitting batches"):
+                try:
+                    batch_infos.append(future.result())
+                except Exception as e:
+                    self.logger.error(f"Failed to submit the batch starting at task {futures[future]}: {e}")
+                    failures[futures[future]] = e
+
+        # Log every submitted batch to the batch info file at once, in task order
+        batch_infos.sort(key=lambda info: info["batch_index"])
+        with open(batch_info_log, write_mode, encoding="utf-8") as f:
+            for batch_info in batch_infos:
                 f.write(json.dumps(batch_info) + "\n")
+        self.logger.info(f"Logged {len(batch_infos)} batch IDs to: {batch_info_log}")
+
+        if failures:
+            raise RuntimeError(f"Failed to submit {len(failures)} of {len(shards)} batches (starting at tasks {sorted(failures)}); "
+                               f"the other {len(batch_infos)} were submitted and logged to {batch_info_log}.")
+        return batch_infos
 
     def upload_and_submit_batch(
         self,
         local_file_path: str,
-        metadata: Optional[Dict] = None
+        metadata: Optional[Dict] = None,
+        endpoint: str = "/v1/chat/completions",
     ):
         """
         Uploads a local file to GPT and submits a batch creation request.
@@ -663,6 +831,7 @@ class OpenaiAPI:
         Args:
             local_file_path (str): Path to the local file containing tasks in JSONL format.
             metadata (Optional[Dict]): Additional metadata for the batch.
+            endpoint (str): The endpoint every task in the file is sent to (e.g., "/v1/responses"); must match the tasks' "url".
 
         Returns:
             response: The response object from the batch creation request.
@@ -670,6 +839,10 @@ class OpenaiAPI:
         if metadata is None:
             metadata = {}
 
+        file_size = os.path.getsize(local_file_path) / BYTES_PER_MB
+        if file_size > BATCH_FILE_LIMIT:
+            self.logger.warning(f"File size exceeds {BATCH_FILE_LIMIT} MB limit: {file_size:.2f} MB")
+
         # Upload file to GPT
         with open(local_file_path, "rb") as f:
             uploaded_file = self.client.files.create(file=f, purpose="batch")
@@ -678,33 +851,400 @@ class OpenaiAPI:
         self.logger.info(f"Scheduling batch job for input file: {local_file_path}")
         response = self.client.batches.create(
             input_file_id=uploaded_file.id,
-            endpoint="/v1/chat/completions",
+            endpoint=endpoint,
             completion_window="24h",
             metadata=metadata
         )
 
-        file_size = os.path.getsize(local_file_path) / (1024 * 1024)
         self.logger.info(f"Batch creation response: {response}")
         self.logger.info(f"Created GPT batch job ID: {response.id} for input file: {local_file_path} ({file_size:.2f} MB)")
 
-        if file_size > BATCH_FILE_LIMIT:
-            self.logger.warning(f"File size exceeds {BATCH_FILE_LIMIT} MB limit: {file_size:.2f} MB")
-
         return response
     
-    def download_batch(self, batch_id: str, output_file):
-        """ Download results from a GPT batch API call to a file. 
-        If batch is not completed, print the status.
+    def download_file(self, file_id: str, output_file: str, chunk_size: int = 1 << 20) -> str:
+        """
+        Streams a file from the OpenAI Files API to `output_file` in chunks of `chunk_size` bytes, so memory use does not grow with the file.
+        The file only appears at `output_file` once it is complete; if a file of the right size is already there, it is not downloaded again.
+        """
+        expected_size = self.client.files.retrieve(file_id).bytes
+        if os.path.isfile(output_file) and os.path.getsize(output_file) == expected_size:
+            self.logger.info(f'Already downloaded {file_id} to: {output_file}')
+            return output_file
+
+        temp_file = f'{output_file}.{os.getpid()}-{threading.get_ident()}.tmp'
+        try:
+            with self.client.files.with_streaming_response.content(file_id) as response, open(temp_file, 'wb') as f:
+                for chunk in response.iter_bytes(chunk_size):
+                    f.write(chunk)
+            os.replace(temp_file, output_file)
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+        self.logger.info(f'Downloaded {file_id} to: {output_file}')
+        return output_file
+
+    def download_batch(self, batch_id: str, output_file, error_file=None) -> str:
+        """ Download results from a GPT batch API call to a file, and its errors (if any) to `error_file`, if given.
+        If batch is not completed, print the status. Returns the status of the batch.
         """
         self.logger.info('Retrieving batch: {}'.format(batch_id))
         response = self.client.batches.retrieve(batch_id)
         if response.status == 'completed':
-            file_id = response.output_file_id
-            file_response = self.client.files.content(file_id)
-            with open(output_file, 'wb') as f:
-                f.write(file_response.content)
+            self.download_file(response.output_file_id, output_file)
+            if error_file and response.error_file_id:
+                self.download_file(response.error_file_id, error_file)
             self.logger.info('Downloaded batch {} to: {}'.format(batch_id, output_file))
         else:
-            self.logger.info('Response Status:', response.status)
-            self.logger.info('Response:', response)
-            self.logger.info('Still processing: {}'.format(batch_id))
\ No newline at end of file
+            self.logger.info(f'Response Status: {response.status}')
+            self.logger.info(f'Response: {response}')
+            self.logger.info('Still processing: {}'.format(batch_id))
+        return response.status
+
+    @staticmethod
+    def read_batch_info_log(batch_info_log: str) -> List[Dict]:
+        """ Reads the batch info written by `submit_tasks_in_batches`, one batch per line. """
+        with open(batch_info_log, 'r', encoding='utf-8') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def _download_batch_files(self, batch, output_dir: str) -> Dict[str, str]:
+        """ Downloads the output and error files (whichever exist) of a finished batch to `output_dir`, returning their paths. """
+        paths = {'output_file': '', 'error_file': ''}
+        if batch.output_file_id:
+            paths['output_file'] = self.download_file(batch.output_file_id, os.path.join(output_dir, f'{batch.id}.jsonl'))
+        if batch.error_file_id:
+            paths['error_file'] = self.download_file(batch.error_file_id, os.path.join(output_dir, f'{batch.id}_errors.jsonl'))
+        return paths
+
+    def monitor_batches(
+        self,
+        batches: str | List[str | Dict],
+        output_dir: str,
+        wait: bool = True,
+        poll_seconds: float = 30,
+        max_poll_seconds: float = 600,
+        max_workers: int = 16,
+        timeout: Optional[float] = None,
+    ) -> List[Dict]:
+        """
+        Supervises a set of GPT batch jobs until all of them have finished, downloading the results of each as soon as it does.
+
+        All unfinished batches are polled concurrently. Whenever a round of polling shows no progress, the wait until the next round doubles
+        (from `poll_seconds` up to `max_poll_seconds`); any progress resets it. Once a batch finishes (completed, failed, expired or
+        cancelled), its output file is streamed to `{output_dir}/{batch_id}.jsonl` and its error file, if any, to
+        `{output_dir}/{batch_id}_errors.jsonl`, while polling of the others continues. The status of every batch is
+        written to `{output_dir}/batch_status.tsv` whenever it changes. Failed polls and downloads are retried in the next round, and re-running the monitor
+        on the same `output_dir` skips files that were already downloaded.
+
+        Args:
+            batches (str or list): A batch info log written by `submit_tasks_in_batches`, or a list of batch ids or batch info dicts.
+            output_dir (str): Directory where results and the status table are written.
+            wait (bool): Whether to keep polling until every batch has finished; if False, polls once and downloads whatever has finished.
+            poll_seconds (float): Initial (and minimum) wait between rounds of polling.
+            max_poll_seconds (float): Maximum wait between rounds of polling.
+            max_workers (int): Maximum number of concurrent polls and downloads.
+            timeout (float, optional): Give up waiting after this many seconds.
+
+        Returns:
+            List[Dict]: One row per batch (as in the status table): batch id, batch file, status, request counts and local result files.
+        """
+        if isinstance(batches, str):
+            batches = self.read_batch_info_log(batches)
+        batches = [{'batch_id': batch} if isinstance(batch, str) else batch for batch in batches]
+        os.makedirs(output_dir, exist_ok=True)
+        status_table = os.path.join(output_dir, 'batch_status.tsv')
+
+        rows = {
+            batch['batch_id']: {
+                'batch_id': batch['batch_id'], 'batch_file': batch.get('batch_file', ''), 'status': 'unknown',
+                'completed': 0, 'failed': 0, 'total': 0, 'output_file': '', 'error_file': '',
+            }
+            for batch in batches
+        }
+        pending = set(rows)     # batches that have not finished, or whose results have not been downloaded yet
+        downloads = {}          # download future -> batch id
+        interval, start = poll_seconds, time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while True:
+                progressed = False
+
+                # collect finished downloads
+                for future in [future for future in downloads if future.done()]:
+                    batch_id = downloads.pop(future)
+                    try:
+                        rows[batch_id].update(future.result())
+                        pending.discard(batch_id)
+                        progressed = True
+                    except Exception as e:
+                        self.logger.warning(f"Failed to download the results of batch {batch_id}, will retry: {e}")
+
+                # poll every unfinished batch that is not being downloaded
+                downloading = set(downloads.values())
+                polls = {executor.submit(self.client.batches.retrieve, batch_id): batch_id for batch_id in pending - downloading}
+                for future in as_completed(polls):
+                    batch_id = polls[future]
+                    try:
+                        batch = future.result()
+                    except Exception as e:
+                        self.logger.warning(f"Failed to retrieve batch {batch_id}, will retry: {e}")
+                        continue
+                    counts = batch.request_counts
+                    update = {
+                        'status': batch.status,
+                        'completed': counts.completed if counts else 0,
+                        'failed': counts.failed if counts else 0,
+                        'total': counts.total if counts else 0,
+                    }
+                    progressed |= any(rows[batch_id][key] != value for key, value in update.items())
+                    rows[batch_id].update(update)
+                    if batch.status in BATCH_TERMINAL_STATUSES:
+                        downloads[executor.submit(self._download_batch_files, batch, output_dir)] = batch_id
+
+                if not pending or not wait:
+                    break
+                if progressed:
+                    self._write_batch_status(list(rows.values()), status_table)
+                if timeout is not None and time.monotonic() - start > timeout:
+                    self.logger.warning(f"Stopped waiting after {timeout} seconds with {len(pending)} batches unfinished.")
+                    break
+
+                interval = poll_seconds if progressed else min(2 * interval, max_poll_seconds)
+                if downloads:   # wake up early to record downloads as they finish
+                    futures_wait(downloads, timeout=interval, return_when=FIRST_COMPLETED)
+                else:
+                    time.sleep(interval)
+
+        # leaving the executor waits for downloads still in flight (e.g., those started by the last round); record them too
+        for future, batch_id in downloads.items():
+            try:
+                rows[batch_id].update(future.result())
+            except Exception as e:
+                self.logger.warning(f"Failed to download the results of batch {batch_id}: {e}")
+        self._write_batch_status(list(rows.values()), status_table)
+        return list(rows.values())
+
+    def _write_batch_status(self, rows: List[Dict], status_table: str) -> None:
+        """ Writes one tab-separated line per batch to `status_table`, and logs how many batches are in each status. """
+        columns = ['batch_id', 'batch_file', 'status', 'completed', 'failed', 'total', 'output_file', 'error_file']
+        with open(status_table, 'w', encoding='utf-8') as f:
+            f.write('\t'.join(columns) + '\n')
+            for row in rows:
+                f.write('\t'.join(str(row[column]) for column in columns) + '\n')
+
+        statuses = {}
+        for row in rows:
+            statuses[row['status']] = statuses.get(row['status'], 0) + 1
+        summary = ', '.join(f'{count} {status}' for status, count in sorted(statuses.items()))
+        self.logger.info(f"Batches: {summary} ({sum(row['completed'] for row in rows)} requests completed, "
+                         f"{sum(row['failed'] for row in rows)} failed); status written to {status_table}")
+
+class AsyncOpenaiAPI(OpenaiAPI):
+    """
+    Asynchronous counterpart of `OpenaiAPI`, for driving hundreds of concurrent chat/ASR requests from a single process.
+
+    Every request goes through one shared HTTP connection pool, and (optionally) through request- and token-per-minute budgets shared by
+    all tasks and threads using this instance; with `limiter_path`, the budgets are also shared by every process on the machine that
+    uses the same path. OpenAI's limits apply per model, so use one instance (or one `limiter_path`) per model.
+    The cost of every call is added to `usage_totals` as it completes. The synchronous methods of `OpenaiAPI` remain available.
+    """
+    def __init__(
+        self,
+        api_key=None,
+        backoff_seconds=3,
+        max_tries=3,
+        max_connections: int = 256,
+        requests_per_minute: int | None = None,
+        tokens_per_minute: int | None = None,
+        limiter_path: str | None = None,
+        image_quality=DEFAULT_IMAGE_QUALITY,
+        image_max_side=DEFAULT_IMAGE_MAX_SIDE,
+    ):
+        """
+        Args:
+            (api_key, backoff_seconds, max_tries, image_quality, image_max_side: see `OpenaiAPI`)
+            max_connections (int, optional): Size of the shared connection pool. Defaults to 256.
+            requests_per_minute (int, optional): Request budget; unlimited if None.
+            tokens_per_minute (int, optional): Token budget (prompt plus completion tokens); unlimited if None.
+            limiter_path (str, optional): If given, the budgets are kept in files at `{limiter_path}.requests` and `{limiter_path}.tokens`.
+        """
+        super().__init__(api_key, backoff_seconds, max_tries, image_quality, image_max_side)
+        # the SDK's own retries are disabled in favour of `_retry`, which retries the same errors (honouring retry-after) but also
+        # re-checks the request budget before every attempt
+        self.http_client = DefaultAsyncHttpxClient(limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections))
+        self.async_client = AsyncOpenAI(api_key=api_key, http_client=self.http_client, max_retries=0)
+        self.request_limiter = self._make_limiter(requests_per_minute, limiter_path, 'requests')
+        self.token_limiter = self._make_limiter(tokens_per_minute, limiter_path, 'tokens')
+
+    @staticmethod
+    def _make_limiter(per_minute: int | None, limiter_path: str | None, kind: str) -> TokenBucket | None:
+        if not per_minute:
+            return None
+        if limiter_path:
+            return FileTokenBucket(f"{limiter_path}.{kind}", per_minute, 60.)
+        return TokenBucket(per_minute, 60.)
+
+    @staticmethod
+    def _estimate_tokens(messages: List[Dict], max_tokens: int | None) -> int:
+        """ Rough estimate of a chat request's tokens: about 4 characters per token, 765 per image, plus the completion budget. """
+        chars, images = 0, 0
+        for message in messages:
+            content = message['content']
+            if isinstance(content, str):
+                chars += len(content)
+                continue
+            for part in content:
+                if part.get('type') == 'image_url':
+                    images += 1
+                else:
+                    chars += len(part.get('text', ''))
+        return chars // 4 + 765 * images + (max_tokens or 0)
+
+    @staticmethod
+    def _is_retryable(e: Exception) -> bool:
+        """ Rate limits, connection errors and timeouts, and the statuses the SDK itself retries (408, 409 and 5xx). """
+        if isinstance(e, RETRY_ERRORS):
+            return True
+        return isinstance(e, APIStatusError) and (e.status_code in (408, 409) or e.status_code >= 500)
+
+    @staticmethod
+    def _retry_after(e: Exception) -> float | None:
+        """ The delay (in seconds) the server asked for in a `retry-after-ms` or `retry-after` header, if any. """
+        response = getattr(e, 'response', None)
+        if response is None:
+            return None
+        try:
+            if 'retry-after-ms' in response.headers:
+                return float(response.headers['retry-after-ms']) / 1000
+            if 'retry-after' in response.headers:
+                return float(response.headers['retry-after'])
+        except ValueError:  # HTTP dates are not worth parsing; fall back to backoff
+            pass
+        return None
+
+    async def _retry(self, fn, description, tokens: int = 0, reraise: bool = False):
+        """
+        Awaits `fn()` within the budgets, retrying rate limits, connection errors, timeouts and server errors with jittered exponential
+        backoff (or after the delay the server asked for, if longer). Other errors (and exhausting the retries) return None, or are
+        raised if `reraise`. Every attempt takes one request from the request budget, but `tokens` are taken from the token budget only
+        once, and given back if the call fails.
+        """
+        if self.token_limiter and tokens:
+            await self.token_limiter.acquire_async(tokens)
+        succeeded = False
+        try:
+            for attempt in range(self.max_tries):
+                if self.request_limiter:
+                    await self.request_limiter.acquire_async()
+                try:
+                    response = await fn()
+                    succeeded = True
+                    return response
+                except BadRequestError as e:
+                    self.logger.error(f"BadRequestError\nQuery:\n\n{description}\n\n{e}")
+                    if reraise:
+                        raise e
+                    return None
+                except Exception as e:
+                    if not self._is_retryable(e):
+                        self.logger.error(f"Error: {e}")
+                        if reraise:
+                            raise e
+                        return None
+                    if attempt == self.max_tries - 1:
+                        self.logger.error(f"Error: {type(e).__name__} after {self.max_tries} tries")
+                        if reraise:
+                            raise e
+                        return None
+                    delay = self.backoff_seconds * 2 ** attempt * random.uniform(0.5, 1.5)
+                    delay = max(delay, self._retry_after(e) or 0.)
+                    self.logger.error(f"Error: {type(e).__name__}. Retrying after {delay:.1f} seconds ({attempt+1}/{self.max_tries})")
+                    await asyncio.sleep(delay)
+        finally:
+            if not succeeded and self.token_limiter and tokens:
+                self.token_limiter.adjust(-tokens)
+
+    async def run_asr_async(self, audio_input, model: str = 'whisper-1') -> dict:
+        ''' Async `run_asr`. '''
+        async def _run_asr():
+            response = await self.async_client.audio.translations.create(
+                model=model, file=audio_input, response_format='verbose_json')
+            response = response.model_dump()
+            response['cost'] = API_COST[model]['cost_per_minute'] * (response['duration'] / 60)
+            self.record_usage(model, cost=response['cost'])
+            return response
+
+        return await self._retry(_run_asr, f"ASR of {getattr(audio_input, 'name', audio_input)}", reraise=True)
+
+    async def _complete_chat_async(self, messages, model='gpt-4o-2024-08-06', max_tokens=256, response_format=None,
+                                   top_p=1.0, temperature=1.0, n=1, stop=None, reasoning_effort=None, reasoning_max_tokens=None,
+                                   frequency_penalty=None, presence_penalty=None):
+        ''' Async `_complete_chat`: returns the response, or None if the request failed. '''
+        completions_fn, request = self._chat_request(
+            self.async_client, messages, model, max_tokens, response_format, top_p, temperature, n, stop,
+            reasoning_effort, reasoning_max_tokens, frequency_penalty, presence_penalty,
+        )
+        estimate = self._estimate_tokens(messages, reasoning_max_tokens if model.startswith("o") else max_tokens)
+        response = await self._retry(lambda: completions_fn(**request), messages, tokens=estimate)
+        if response is not None and self.token_limiter and response.usage:
+            # settle the difference between the estimate and the tokens actually used
+            self.token_limiter.adjust(response.usage.total_tokens - estimate)
+        return response
+
+    async def call_chatgpt_async(
+        self,
+        model: str,
+        sys_prompt: str = None,
+        usr_prompt: str = None,
+        image_input: Union[str, Image.Image, List[str | Image.Image]] = None,
+        image_detail: str | List[str] = 'auto',
+        examples: Optional[List[Dict[str, str]]] = None,
+        response_format: str | BaseModel = None,
+        max_tokens=256,
+        top_p=1.0,
+        temperature=1.0,
+        reasoning_max_tokens=None,
+        reasoning_effort: str = None,
+        **kwargs,
+    ) -> tuple[str | BaseModel, CompletionUsage]:
+        """
+        Async `call_chatgpt`; see there for the parameters. Returns (response, usage), or None if the request failed.
+        """
+        # encoding local images reads files, so keep it off the event loop
+        messages = await asyncio.to_thread(self.build_messages, sys_prompt, usr_prompt, examples, image_input, image_detail)
+
+        response_format = self.get_response_format(response_format)
+        response = await self._complete_chat_async(
+            messages=messages,
+            model=model,
+            max_tokens=max_tokens,
+            response_format=response_format,
+            top_p=top_p,
+            temperature=temperature,
+            n=1,
+            reasoning_effort=reasoning_effort,
+            reasoning_max_tokens=reasoning_max_tokens,
+            **kwargs
+        )
+        if response is None:
+            return None
+
+        try:
+            if is_json_schema(response_format):
+                result: BaseModel = response.choices[0].message.parsed
+            else:
+                result: str = response.choices[0].message.content
+        except AttributeError as e:
+            self.logger.info(f"{e}")
+            return None
+        self.record_usage(model, response.usage)
+        return result, response.usage
+
+    async def aclose(self) -> None:
+        ''' Closes the shared connection pool. '''
+        await self.async_client.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
@@ -0,0 +1,86 @@
+"""
+Token-bucket rate limiters for calls to rate-limited APIs (e.g., Gemini's requests-per-minute and requests-per-day quotas,
+or OpenAI's requests- and tokens-per-minute limits).
+
+A bucket can be shared freely between threads and asyncio tasks: `acquire` blocks the calling thread,
+while `acquire_async` only suspends the calling coroutine. A `FileTokenBucket` is additionally shared by every process
+on the machine that opens the same file, so separately launched scripts stay within one budget.
+"""
+from pathlib import Path
+import asyncio, threading, fcntl, struct, time
+
+class TokenBucket:
+    def __init__(self, capacity: int, period: float):
+        """
+        Allows at most `capacity` acquisitions per `period` seconds. The bucket starts full and refills continuously,
+        so bursts of up to `capacity` calls go through immediately and sustained traffic is spread evenly over `period`.
+        """
+        if capacity < 1:
+            raise ValueError('`capacity` must be a positive integer.')
+        if period <= 0:
+            raise ValueError('`period` must be positive.')
+        self.capacity, self.period = capacity, period
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, amount: float = 1) -> float:
+        """
+        Takes `amount` tokens from the bucket, going into debt if it is empty. Returns how many seconds the caller must wait before its tokens are valid.
+        Reserving (rather than retrying once the bucket refills) keeps waiters first-come, first-served.
+        """
+        with self._lock:
+            now = time.monotonic()
+            # capped both after refilling and after taking `amount`, so neither idle time nor a refund (negative `amount`) can overfill the bucket
+            self._tokens = min(self.capacity, min(self.capacity, self._tokens + (now - self._updated) * self.capacity / self.period) - amount)
+            self._updated = now
+            return max(0., -self._tokens * self.period / self.capacity)
+
+    def acquire(self, amount: float = 1) -> None:
+        """
+        Blocks the calling thread until `amount` tokens (e.g., one request, or the tokens of a prompt) may be spent.
+        """
+        wait = self._reserve(amount)
+        if wait:
+            time.sleep(wait)
+
+    async def acquire_async(self, amount: float = 1) -> None:
+        """
+        Suspends the calling coroutine until `amount` tokens may be spent, without blocking the event loop.
+        """
+        wait = self._reserve(amount)
+        if wait:
+            await asyncio.sleep(wait)
+
+    def adjust(self, amount: float) -> None:
+        """
+        Takes `amount` more tokens without waiting (or gives them back, if negative), e.g., to correct an estimate once the actual cost of a call is known.
+        """
+        self._reserve(amount)
+
+class FileTokenBucket(TokenBucket):
+    def __init__(self, path: str | Path, capacity: int, period: float):
+        """
+        A `TokenBucket` whose state lives in the file at `path` (created if needed), so that every process on this machine using the
+        same file shares one budget. The file is locked for the duration of each (very short) update.
+        """
+        super().__init__(capacity, period)
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def _reserve(self, amount: float = 1) -> float:
+        # wall-clock time, since monotonic clocks are not comparable across processes
+        with self._lock, open(self.path, 'a+b') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                state = f.read(16)
+                now = time.time()
+                tokens, updated = struct.unpack('dd', state) if len(state) == 16 else (float(self.capacity), now)
+                tokens = min(self.capacity, min(self.capacity, tokens + max(0., now - updated) * self.capacity / self.period) - amount)
+                f.truncate(0)
+                f.write(struct.pack('dd', tokens, now))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return max(0., -tokens * self.period / self.capacity)
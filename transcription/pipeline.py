@@ -1,11 +1,12 @@
 """Unified transcription pipeline for processing video files (local or GCS)"""
 import time
-import tempfile
 import json
 
 from loguru import logger
 
-from src.utils.gcs import download_blob_as_bytes, parse_gcs_url, get_file_extension
+from src.utils.gcs import open_gcs_file
+from src.utils.clip_cache import ClipCache
+from src.utils.media_probe import is_streamable
 from transcription.verbalizer.whisper_verbalizer import WhisperTranscriber
 
 def transcribe_pipeline(
@@ -39,25 +40,35 @@ def transcribe_pipeline(
     load_time = time.time()
 
     if video_path.startswith('gs://'):
-        
-        # Download the video file from GCS
+
+        # Stream the video from GCS straight into the Whisper model's decoder
         try:
-            bucket_name, blob_name = parse_gcs_url(video_path)
-            content = download_blob_as_bytes(bucket_name, blob_name)
+            stream = open_gcs_file(video_path)
         except Exception as e:
-            logger.error(f"Failed to download video {video_path}: {e}")
+            logger.error(f"Failed to open video {video_path}: {e}")
             return None
-        if verbose:
-            logger.info('Time took to load video: {} seconds'.format(time.time() - load_time))
+        with stream:
+            try:
+                streamable = is_streamable(stream)
+                if streamable:
+                    transcription = whisper_verbalizer(stream)
+            except Exception as e:
+                logger.error(f'Error in verbalizing {video_path}: {e}')
+                return None
+
+        if not streamable:
+            # MP4s whose index comes after their media data cannot be decoded from a pipe, so read those from the
+            # machine-wide clip cache instead (large videos are fetched as parallel range requests)
+            try:
+                local_path = ClipCache().fetch(video_path)
+            except Exception as e:
+                logger.error(f"Failed to download video {video_path}: {e}")
+                return None
+            if verbose:
+                logger.info('Time took to load video: {} seconds'.format(time.time() - load_time))
 
-        # Store the downloaded audio file in a temporary local file
-        # as input to the Whisper model
-        suffix = get_file_extension(video_path)
-        with tempfile.NamedTemporaryFile(delete=True, suffix=suffix) as temp:
-            temp.write(content)
-            temp.flush()
             try:
-                transcription = whisper_verbalizer(temp.name)
+                transcription = whisper_verbalizer(local_path)
             except Exception as e:
                 logger.error(f'Error in verbalizing {video_path}: {e}')
                 return None
@@ -1,7 +1,6 @@
 import os
 import argparse
 import time
-from tqdm import tqdm
 from functools import partial
 from pathlib import Path
 import tempfile
@@ -12,7 +11,7 @@ from loguru import logger
 import warnings
 
 from src.utils.gcs import download_blob_as_bytes, parse_gcs_url
-from src.utils.async_caller import FutureThreadCaller
+from src.utils.async_caller import AsyncCaller, BatchCaller, CompletionIndex
 from transcription.verbalizer.whisper_verbalizer import WhisperTranscriber
 from transcription.pipeline import transcribe_pipeline
 
@@ -101,12 +100,6 @@ def load_parquet(file_path):
     data = df.to_dict(orient='records')
     return data
 
-def save_batch(results: list[dict], output_file: str):
-    """Save a batch of results to a jsonl file."""
-    with open(output_file, 'a') as f:
-        for result in results:
-            f.write(json.dumps(result, ensure_ascii=False)+'\n')
-
 if __name__ == '__main__':
 
     '''
@@ -142,7 +135,7 @@ if __name__ == '__main__':
 
     # API specific arguments
     parser.add_argument('--api_model', type=str, default='whisper-1', help='model to use for API jobs')
-    parser.add_argument('--num_workers', type=int, default=10, help='number of workers to use for api jobs')
+    parser.add_argument('--num_workers', type=int, default=10, help='maximum number of concurrent api calls (adapted to rate limits)')
 
     args = parser.parse_args()
 
@@ -190,18 +183,22 @@ if __name__ == '__main__':
     data = data[args.shard_index::args.num_shards]
     logger.info(f"Loaded {len(data)} URIs from shard {args.shard_index} of {args.num_shards} shards")
 
+    # the completion index next to the output file lists every uri whose transcription has been saved
+    index_file = args.output_file + '.done'
     if args.overwrite_output:
         logger.info(f"Overwriting {args.output_file}...")
-        with open(args.output_file, 'w') as f:
-            pass
+        for path in (args.output_file, index_file):
+            with open(path, 'w') as f:
+                pass
+    elif os.path.isfile(args.output_file) and not os.path.isfile(index_file):
+        # outputs saved before the index existed: index them once from their contents
+        with open(args.output_file) as f, open(index_file, 'w') as index:
+            for line in f:
+                index.write(json.loads(line)['uri'] + '\n')
 
     # Load and skip processed uris
-    uris_to_skip = set()
-    if os.path.isfile(args.output_file) and not args.overwrite_output:
-        with open(args.output_file) as f:
-            for line in f:
-                line = json.loads(line)
-                uris_to_skip.add(line['uri'])
+    uris_to_skip = CompletionIndex(index_file)
+    uris_to_skip.close()
     input_data = [datum for datum in data if datum['video_path'] not in uris_to_skip]
     logger.info(f"Skipping {len(uris_to_skip)} already processed URIs")
     logger.info(f"Processing {len(input_data)} new URIs")
@@ -210,26 +207,28 @@ if __name__ == '__main__':
     res = transcribe(input_data[0], verbose=True)
     logger.info(f"Example Transcription result: {res}")
 
-    # async callers automatically handles batching
+    # each transcription is saved (and its uri indexed) as soon as it completes, so an interrupted job resumes where it stopped
+    # the async caller keeps up to `num_workers` API calls in flight, backing off when rate limited
     if args.mode == 'whisper-api':
-        FutureThreadCaller.batch_process_save(
-            data,
+        AsyncCaller.batch_process_save(
+            input_data,
             transcribe,
             args.output_file,
             batch_size=args.batch_size,
-            max_workers=args.num_workers
+            max_workers=args.num_workers,
+            key=lambda datum: datum['video_path'],
+            keep_results=False
         )
  
-    # Transcribe every batch of videos with the GPU model
+    # Transcribe videos one at a time with the GPU model
     else:
-        for idx in tqdm(range(0, len(input_data), args.batch_size)):
-            batch = input_data[idx:idx+args.batch_size]
-            results = []
-            for datum in tqdm(batch):
-                result = transcribe(datum)
-                if result is not None:
-                    results.append(result)
-            save_batch(results, args.output_file)
-            logger.info(f"Saved {len(results)} transcriptions to {args.output_file}")
+        BatchCaller.batch_process_save(
+            input_data,
+            transcribe,
+            args.output_file,
+            batch_size=args.batch_size,
+            key=lambda datum: datum['video_path'],
+            keep_results=False
+        )
     
     logger.success(f"Transcription completed for {len(input_data)} URIs")
@@ -1,13 +1,16 @@
 import os
 import numpy as np
 import tempfile
-from typing import Any, Union, Dict
+import shutil
+import subprocess
+import threading
+from typing import Any, Union, Dict, BinaryIO
 from pydub import AudioSegment
 import whisper
-import ffmpeg
 
 from loguru import logger
 
+from src.utils import media_probe
 from .base_verbalizer import Verbalizer
 
 try:
@@ -16,6 +19,7 @@ except ImportError:
     logger.warning("WhisperX not installed. Please run `pip install whisperx` if you want to use WhisperX transcriber.")
 
 WHISPER_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "whisper")
+SAMPLE_RATE = 16000     # the sample rate Whisper expects
 
 def parse_segments(segments: list[dict]):
     return [{k:v for k,v in seg.items() if k in ['id', 'start', 'end', 'text']} for seg in segments]
@@ -24,9 +28,51 @@ def get_duration(video_input: str) -> float:
     """
     Get the duration of the video in seconds.
     """
-    probe = ffmpeg.probe(video_input)
-    duration = float(probe['format']['duration'])
-    return duration
+    return media_probe.get_duration(video_input)
+
+def load_audio_pcm(video_input: BinaryIO, sr: int = SAMPLE_RATE) -> bytes:
+    """
+    Decodes the audio of a video given as a binary file object (e.g., a `src.utils.gcs.GCSReader`) into mono 16-bit PCM at `sr` Hz,
+    streaming it into FFmpeg's stdin so decoding starts as soon as the first bytes arrive and the video is never written to disk.
+    The video must be streamable (see `src.utils.media_probe.is_streamable`).
+    """
+    cmd = ['ffmpeg', '-threads', '0', '-i', 'pipe:0', '-f', 's16le', '-ac', '1', '-acodec', 'pcm_s16le', '-ar', str(sr), '-']
+    with tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr)
+
+        read_errors = []
+        def feed():
+            try:
+                shutil.copyfileobj(video_input, proc.stdin, 1 << 20)
+            except BrokenPipeError:
+                pass    # FFmpeg exited early; its return code says why
+            except Exception as e:
+                read_errors.append(e)
+            finally:
+                try:
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        pcm = proc.stdout.read()
+        proc.wait()
+        feeder.join()
+        if read_errors:
+            raise read_errors[0]
+        if proc.returncode:
+            stderr.seek(0)
+            raise RuntimeError(f"Failed to load audio: {stderr.read().decode(errors='replace')}")
+    return pcm
+
+def load_audio(video_input: Union[str, BinaryIO]) -> np.ndarray:
+    """
+    Loads the audio of a video given as a path or a binary file object as a float32 waveform at `SAMPLE_RATE` Hz, like `whisper.load_audio`.
+    """
+    if isinstance(video_input, str):
+        return whisper.load_audio(video_input)
+    return np.frombuffer(load_audio_pcm(video_input), np.int16).flatten().astype(np.float32) / 32768.0
 
 class WhisperTranscriber(Verbalizer):
     """ Abstract class for Whisper transcribers. """
@@ -88,13 +134,16 @@ class WhisperAPI(WhisperTranscriber):
         self.segment_length = segment_length
         self.whisper_model = api_model
 
-    def __call__(self, video_input: str) -> Dict:
+    def __call__(self, video_input: Union[str, BinaryIO]) -> Dict:
         """
-        Runs Whisper API to specified video path. 
+        Runs Whisper API to specified video path (or streamable binary file object). 
         Split audio into `segment_length` segments (length 1000 = 1 sec) to deal with file limits.
         """
 
-        audio = AudioSegment.from_file(video_input)
+        if isinstance(video_input, str):
+            audio = AudioSegment.from_file(video_input)
+        else:
+            audio = AudioSegment(data=load_audio_pcm(video_input), sample_width=2, frame_rate=SAMPLE_RATE, channels=1)
         duration = audio.duration_seconds
         transcriptions = []
         with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as temp_file:
@@ -148,9 +197,9 @@ class WhisperGPU(WhisperTranscriber):
         print(f"Loaded Whisper model {whisper_model} from {download_root} on {device}")
         self.device = device
     
-    def __call__(self, video_input: str) -> Dict:
+    def __call__(self, video_input: Union[str, BinaryIO]) -> Dict:
         """
-        Use the local whisper model to transcribe video.
+        Use the local whisper model to transcribe video (given as a path or streamable binary file object).
         """
 
         audio_input: np.ndarray = self.load_audio(video_input)
@@ -160,7 +209,7 @@ class WhisperGPU(WhisperTranscriber):
         # detect the spoken language
         language = self.detect_language(audio_input)
 
-        duration = get_duration(video_input)
+        duration = get_duration(video_input) if isinstance(video_input, str) else len(audio_input) / SAMPLE_RATE
 
         return {
             'text': result['text'],
@@ -169,8 +218,8 @@ class WhisperGPU(WhisperTranscriber):
             'language': language
         }
     
-    def load_audio(self, video_input: str):
-        return whisper.load_audio(video_input)
+    def load_audio(self, video_input: Union[str, BinaryIO]):
+        return load_audio(video_input)
     
     def detect_language(self, audio_input: np.ndarray):
         audio = whisper.pad_or_trim(audio_input)
@@ -190,9 +239,9 @@ class WhisperX(WhisperTranscriber):
         print(f"Loaded WhisperX model {whisper_model} from {download_root} on {device}")
         self.device = device
     
-    def __call__(self, video_input: str, batch_size=128) -> Dict:
+    def __call__(self, video_input: Union[str, BinaryIO], batch_size=128) -> Dict:
         """
-        Use the local whisper model to transcribe video.
+        Use the local whisper model to transcribe video (given as a path or streamable binary file object).
         """
 
         audio_input: np.ndarray = self.load_audio(video_input)
@@ -204,7 +253,7 @@ class WhisperX(WhisperTranscriber):
 
         text = ' '.join([s['text'] for s in segments])
 
-        duration = get_duration(video_input)
+        duration = get_duration(video_input) if isinstance(video_input, str) else len(audio_input) / SAMPLE_RATE
 
         return {
             'text': text,
@@ -213,8 +262,10 @@ class WhisperX(WhisperTranscriber):
             'language': language
         }
     
-    def load_audio(self, video_input: str):
-        return whisperx.load_audio(video_input)
+    def load_audio(self, video_input: Union[str, BinaryIO]):
+        if isinstance(video_input, str):
+            return whisperx.load_audio(video_input)
+        return load_audio(video_input)
     
     def detect_language(self, audio_input: np.ndarray):
         return self.model.model.detect_language(audio_input)[0]